@@ -0,0 +1,674 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Portable archives of external snapshots of environments
+
+An archive is a gzip stream of records, so it can be written to a pipe
+and read from it without seeking. Every record is a JSON header prefixed
+by its length, optionally followed by data chunks prefixed by their
+length and terminated by an empty chunk. Records of an archive:
+
+- manifest: objects of the environment from the database, without
+  libvirt UUIDs, and the list of exported volumes. Nodes with memory
+  state keep the UUID of their domain, the state can be restored only
+  into a domain with the same UUID
+- volume: content of a volume from the backing chain of a disk in the
+  state of the snapshot, backing volumes go before their overlays
+- memory: memory state file of a node
+- end: marks a complete archive
+
+Every volume of a chain is streamed as is, so the archive keeps the
+deltas of snapshots and shared base images are written once. On import
+qcow2 headers of overlays are pointed to the new paths of their backing
+volumes while the data is uploaded.
+"""
+
+import json
+import os
+import struct
+import xml.etree.ElementTree as ET
+import zlib
+
+from django.conf import settings
+import libvirt
+
+from devops.driver.libvirt.libvirt_driver import LibvirtManager
+from devops.driver.libvirt.libvirt_driver import LibvirtVolume
+from devops.error import DevopsError
+from devops import logger
+from devops.models.environment import Environment
+from devops.models.network import Address
+from devops.models.network import AddressPool
+from devops.models.network import Interface
+from devops.models.volume import DiskDevice
+
+
+ARCHIVE_MAGIC = b'DEVOPS-SNAPSHOT-ARCHIVE\n'
+ARCHIVE_VERSION = 1
+CHUNK_SIZE = 1024 ** 2
+
+QCOW2_MAGIC = b'QFI\xfb'
+# The name of the backing file is stored in the first cluster
+QCOW2_HEADER_READ = 64 * 1024
+
+# Parameters of volumes which depend on the host or on the chain
+VOLUME_PARAMS_EXCLUDE = ('uuid', 'capacity', 'format', 'source_image',
+                         'base_image', 'storage_pool')
+
+_LENGTH = struct.Struct('>I')
+
+
+class ArchiveWriter(object):
+    """Writer of archive records to a file object"""
+
+    def __init__(self, fileobj, compresslevel=6):
+        self._file = fileobj
+        # wbits + 16 selects the gzip container
+        self._compressor = zlib.compressobj(
+            compresslevel, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        self._write(ARCHIVE_MAGIC + _LENGTH.pack(ARCHIVE_VERSION))
+
+    def _write(self, data):
+        data = self._compressor.compress(data)
+        if data:
+            self._file.write(data)
+
+    def add(self, header, chunks=None):
+        """Add a record
+
+        :param header: dict, 'type' is the type of the record
+        :param chunks: iterable of bytes, None if the record has no data
+        """
+        header = dict(header, data=chunks is not None)
+        data = json.dumps(header, sort_keys=True).encode('utf-8')
+        self._write(_LENGTH.pack(len(data)) + data)
+        if chunks is None:
+            return
+        for chunk in chunks:
+            if chunk:
+                self._write(_LENGTH.pack(len(chunk)))
+                self._write(chunk)
+        self._write(_LENGTH.pack(0))
+
+    def close(self):
+        """Add the end record and flush the compressed stream"""
+        self.add({'type': 'end'})
+        self._file.write(self._compressor.flush())
+        self._file.flush()
+
+
+class ArchiveReader(object):
+    """Reader of archive records from a file object
+
+    Iteration yields tuples of the header and an iterator over data
+    chunks (None if the record has no data). Data which is not read
+    before the next record is skipped.
+    """
+
+    def __init__(self, fileobj):
+        self._file = fileobj
+        self._decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        self._buffer = b''
+        if self._read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+            raise DevopsError('File is not a snapshot archive')
+        version = self._read_length()
+        if version != ARCHIVE_VERSION:
+            raise DevopsError(
+                'Version {0} of the snapshot archive is not supported'.format(
+                    version))
+
+    def _read(self, size):
+        while len(self._buffer) < size:
+            # Limit the output, zeroes of sparse images are compressed
+            # about a thousand times
+            data = self._decompressor.unconsumed_tail
+            if not data:
+                data = self._file.read(CHUNK_SIZE)
+                if not data:
+                    raise DevopsError('Snapshot archive is truncated')
+            try:
+                self._buffer += self._decompressor.decompress(
+                    data, CHUNK_SIZE)
+            except zlib.error as e:
+                raise DevopsError(
+                    'Snapshot archive is corrupted: {0}'.format(e))
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def _read_length(self):
+        return _LENGTH.unpack(self._read(_LENGTH.size))[0]
+
+    def _chunks(self):
+        while True:
+            size = self._read_length()
+            if not size:
+                return
+            yield self._read(size)
+
+    def __iter__(self):
+        while True:
+            header = json.loads(
+                self._read(self._read_length()).decode('utf-8'))
+            if header['type'] == 'end':
+                return
+            chunks = self._chunks() if header['data'] else None
+            yield header, chunks
+            if chunks is not None:
+                for _ in chunks:
+                    pass
+
+
+def set_qcow2_backing_file(header, path):
+    """Point the header of a qcow2 image to another backing file
+
+    qemu stores the name of the backing file after the header extensions
+    in the first cluster of the image, the rest of the cluster is unused.
+
+    :param header: bytes from the start of the image, at least up to
+        the end of the name of the backing file
+    :param path: new path of the backing file
+        :rtype : bytes
+    """
+    if header[:4] != QCOW2_MAGIC:
+        raise DevopsError('Volume is not a qcow2 image')
+    offset, size, cluster_bits = struct.unpack('>QII', header[8:24])
+    if not offset:
+        raise DevopsError('qcow2 image has no backing file')
+    path = path.encode('utf-8')
+    if offset + len(path) > 1 << cluster_bits:
+        raise DevopsError(
+            'Backing file path {0!r} does not fit into the first cluster '
+            'of the qcow2 image'.format(path))
+    end = offset + max(size, len(path))
+    if len(header) < end:
+        raise DevopsError('qcow2 image header is truncated')
+    return b''.join((
+        header[:16], struct.pack('>I', len(path)), header[20:offset],
+        path, b'\0' * (end - offset - len(path)), header[end:]))
+
+
+def _set_backing_file(chunks, path):
+    """Rewrite the backing file in the header of streamed qcow2 data"""
+    chunks = iter(chunks)
+    header = b''
+    for chunk in chunks:
+        header += chunk
+        if len(header) >= QCOW2_HEADER_READ:
+            break
+    yield set_qcow2_backing_file(header, path)
+    for chunk in chunks:
+        yield chunk
+
+
+def _read_file(path):
+    with open(path, 'rb') as fileobj:
+        while True:
+            chunk = fileobj.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def _download(conn, volume):
+    """Stream content of the libvirt volume"""
+    stream = conn.newStream(0)
+    volume.download(stream, 0, 0, 0)
+    try:
+        while True:
+            chunk = stream.recv(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    except BaseException:
+        stream.abort()
+        raise
+    stream.finish()
+
+
+def _upload(conn, volume, chunks):
+    """Write streamed content to the libvirt volume"""
+    def chunk_render(_, _size, _chunks):
+        return next(_chunks, b'')
+    stream = conn.newStream(0)
+    volume.upload(stream, 0, 0, 0)
+    stream.sendAll(chunk_render, iter(chunks))
+    stream.finish()
+
+
+def _get_volume_chain(conn, path):
+    """Get libvirt volumes of the backing chain of the path, base first"""
+    chain = []
+    while path:
+        volume = conn.storageVolLookupByPath(path)
+        chain.insert(0, volume)
+        path = ET.fromstring(volume.XMLDesc(0)).findtext('backingStore/path')
+    return chain
+
+
+def _describe_node(node, snapshot_name, layers):
+    """Get the node description for the manifest
+
+    :param layers: dict of exported volumes by (host, path), volumes
+        of the disks of the node which are not there yet are added
+        :rtype : dict
+    """
+    conn = node.driver.conn
+    host = node.driver.connection_string
+    snapshot_volumes = node.get_snapshot_volumes(snapshot_name)
+
+    disks = []
+    for disk in node.disk_devices:
+        root = disk.volume.get_backing_chain()[-1]
+        # Read-only devices like CD-ROMs are not a part of snapshots
+        path = snapshot_volumes.get(disk.target_dev, disk.volume.get_path())
+        chain_ids = []
+        owned = 0
+        for idx, volume in enumerate(_get_volume_chain(conn, path)):
+            key = (host, volume.path())
+            if key not in layers:
+                # The disk which exports the volume first owns it
+                # on import, shared base images are imported once
+                layers[key] = dict(
+                    id=len(layers),
+                    group=node.group.name,
+                    node=node.name,
+                    name=root.name if not owned else '{0}.import{1}'.format(
+                        root.name, idx),
+                    format=LibvirtVolume._get_libvirt_volume_format(volume),
+                    capacity=volume.info()[1],
+                    parent=chain_ids[-1] if chain_ids else None,
+                    volume=(node, volume),
+                )
+                owned += 1
+            chain_ids.append(layers[key]['id'])
+        disks.append(dict(
+            target_dev=disk.target_dev,
+            device=disk.device,
+            type=disk.type,
+            bus=disk.bus,
+            name=root.name,
+            params={key: value for key, value in root.params.items()
+                    if key not in VOLUME_PARAMS_EXCLUDE},
+            layers=chain_ids,
+        ))
+
+    return dict(
+        name=node.name,
+        role=node.role,
+        params={key: value for key, value in node.params.items()
+                if key not in ('uuid', 'snapshot_stats')},
+        interfaces=[dict(
+            label=interface.label,
+            l2_network_device=getattr(interface.l2_network_device, 'name',
+                                      None),
+            interface_model=interface.model,
+            mac_address=interface.mac_address,
+            addresses=[address.ip_address
+                       for address in interface.addresses],
+            params=interface.params,
+        ) for interface in node.interfaces],
+        network_configs=[dict(
+            label=network_config.label,
+            networks=network_config.networks,
+            aggregation=network_config.aggregation,
+            parents=network_config.parents,
+        ) for network_config in node.network_configs],
+        disks=disks,
+    )
+
+
+def get_manifest(env, snapshot_name):
+    """Describe the environment in the state of the external snapshot
+
+    :type env: Environment
+    :type snapshot_name: str
+        :rtype : tuple of the manifest, libvirt volumes to export by ID
+            and memory files by (group name, node name)
+    """
+    if not env.has_snapshot(snapshot_name):
+        raise DevopsError('Environment {0} has no snapshot {1}'.format(
+            env.name, snapshot_name))
+
+    layers = {}
+    memory_files = {}
+    snapshot = None
+    groups = []
+    for group in env.get_groups():
+        nodes = []
+        for node in group.get_nodes():
+            nodes.append(_describe_node(node, snapshot_name, layers))
+            snapshot = node._get_snapshot(snapshot_name)
+            if not snapshot.memory_file:
+                continue
+            if not os.path.isfile(snapshot.memory_file):
+                raise DevopsError(
+                    'Memory state file {0} of {1} is not found, snapshots '
+                    'can be exported on the host of libvirt only'.format(
+                        snapshot.memory_file, node.name))
+            memory_files[(group.name, node.name)] = snapshot.memory_file
+            nodes[-1]['uuid'] = node.uuid
+
+        groups.append(dict(
+            name=group.name,
+            driver=dict(name=group.driver.name, params=group.driver.params),
+            l2_network_devices=[dict(
+                name=l2_network_device.name,
+                address_pool=getattr(l2_network_device.address_pool, 'name',
+                                     None),
+                params={key: value for key, value
+                        in l2_network_device.params.items()
+                        if key != 'uuid'},
+            ) for l2_network_device in group.get_l2_network_devices()],
+            network_pools={
+                network_pool.name: network_pool.address_pool.name
+                for network_pool in group.get_network_pools()},
+            nodes=nodes,
+        ))
+
+    if snapshot is None:
+        raise DevopsError('Environment {0} has no nodes'.format(env.name))
+
+    layers = sorted(layers.values(), key=lambda layer: layer['id'])
+    volumes = {layer['id']: layer.pop('volume') for layer in layers}
+    manifest = dict(
+        environment=env.name,
+        snapshot=dict(
+            name=snapshot_name,
+            description=snapshot._xml_tree.findtext('description'),
+            created=snapshot.created.isoformat(),
+        ),
+        address_pools=[dict(
+            name=pool.name,
+            net=pool.net,
+            params=pool.params,
+        ) for pool in env.get_address_pools()],
+        groups=groups,
+        volumes=layers,
+    )
+    return manifest, volumes, memory_files
+
+
+def export_snapshot(env, snapshot_name, fileobj, compresslevel=6):
+    """Write the environment in the state of the snapshot to an archive
+
+    Volumes of snapshots are not changed by running domains, so the
+    environment can be used during the export.
+
+    :type env: Environment
+    :type snapshot_name: str
+    :param fileobj: binary file object opened for writing, e.g. a pipe
+    :type compresslevel: int
+    """
+    manifest, volumes, memory_files = get_manifest(env, snapshot_name)
+    archive = ArchiveWriter(fileobj, compresslevel)
+    archive.add({'type': 'manifest', 'manifest': manifest})
+    for layer in manifest['volumes']:
+        node, volume = volumes[layer['id']]
+        logger.info('Export volume {0}'.format(volume.path()))
+        archive.add({'type': 'volume', 'id': layer['id']},
+                    _download(node.driver.conn, volume))
+    for (group_name, node_name), path in sorted(memory_files.items()):
+        logger.info('Export memory state of {0}'.format(node_name))
+        archive.add({'type': 'memory', 'group': group_name,
+                     'node': node_name}, _read_file(path))
+    archive.close()
+
+
+class _SnapshotImporter(object):
+    """Recreates an environment from records of an archive"""
+
+    def __init__(self, manifest, name=None, connection_string=None):
+        self.manifest = manifest
+        self.name = name or manifest['environment']
+        self.connection_string = connection_string
+        self.layers = {layer['id']: layer for layer in manifest['volumes']}
+        self.nodes = {}
+        self.volumes = {}
+        self.memory_files = {}
+        self.env = None
+
+    def check(self):
+        """Check that addresses of the environment are not used"""
+        nets = [pool['net'] for pool in self.manifest['address_pools']]
+        used = AddressPool.objects.filter(net__in=nets)
+        if used.exists():
+            raise DevopsError(
+                'Networks {0} are used by environment {1}, the snapshot '
+                'keeps addresses of its nodes'.format(
+                    ', '.join(pool.net for pool in used),
+                    used[0].environment.name))
+        macs = [interface['mac_address']
+                for group in self.manifest['groups']
+                for node in group['nodes']
+                for interface in node['interfaces']]
+        if Interface.objects.filter(mac_address__in=macs).exists():
+            raise DevopsError(
+                'MAC addresses of the snapshot are used by another '
+                'environment')
+
+        for group in self.manifest['groups']:
+            conn = LibvirtManager.get_connection(
+                self.connection_string or
+                group['driver']['params']['connection_string'])
+            for node in group['nodes']:
+                if node.get('uuid') is None:
+                    continue
+                try:
+                    domain = conn.lookupByUUIDString(node['uuid'])
+                except libvirt.libvirtError as e:
+                    if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                        raise
+                    continue
+                raise DevopsError(
+                    'Memory state of {0} can be restored only into a domain '
+                    'with UUID {1}, it is used by domain {2}'.format(
+                        node['name'], node['uuid'], domain.name()))
+
+    def create_environment(self):
+        self.env = Environment.create(self.name)
+        for pool in self.manifest['address_pools']:
+            self.env.add_address_pool(
+                name=pool['name'],
+                net='{0}:{1}'.format(pool['net'],
+                                     pool['net'].split('/')[1]),
+                **pool['params'])
+
+        for group_data in self.manifest['groups']:
+            driver_params = dict(group_data['driver']['params'])
+            if self.connection_string is not None:
+                driver_params['connection_string'] = self.connection_string
+            group = self.env.add_group(
+                group_name=group_data['name'],
+                driver_name=group_data['driver']['name'],
+                **driver_params)
+            for device in group_data['l2_network_devices']:
+                params = dict(device['params'])
+                if device['address_pool'] is not None:
+                    params['address_pool'] = device['address_pool']
+                group.add_l2_network_device(name=device['name'], **params)
+            group.add_network_pools(group_data['network_pools'])
+
+        for group_data in self.manifest['groups']:
+            group = self.env.get_group(name=group_data['name'])
+            for node_data in group_data['nodes']:
+                self.nodes[(group.name, node_data['name'])] = (
+                    self._create_node(group, node_data))
+            group.define_networks()
+
+    @staticmethod
+    def _create_node(group, node_data):
+        params = dict(node_data['params'])
+        if node_data.get('uuid') is not None:
+            params['uuid'] = node_data['uuid']
+        node = group.add_node(name=node_data['name'], role=node_data['role'],
+                              **params)
+        for data in node_data['interfaces']:
+            interface = node.add_interface(
+                label=data['label'],
+                l2_network_device_name=data['l2_network_device'],
+                interface_model=data['interface_model'],
+                mac_address=data['mac_address'],
+                **data['params'])
+            # Keep addresses configured inside of the nodes
+            interface.address_set.all().delete()
+            for ip_address in data['addresses']:
+                Address.objects.create(ip_address=ip_address,
+                                       interface=interface)
+        for data in node_data['network_configs']:
+            node.add_network_config(**data)
+        return node
+
+    def _get_disk(self, layer):
+        for group_data in self.manifest['groups']:
+            for node_data in group_data['nodes']:
+                if (group_data['name'], node_data['name']) != (
+                        layer['group'], layer['node']):
+                    continue
+                for disk in node_data['disks']:
+                    if layer['id'] in disk['layers']:
+                        return disk
+
+    def add_volume(self, layer_id, chunks):
+        layer = self.layers[layer_id]
+        node = self.nodes[(layer['group'], layer['node'])]
+        params = dict(self._get_disk(layer)['params'])
+        parent = None
+        if layer['parent'] is not None:
+            parent = self.volumes[layer['parent']]
+            if parent.node_id == node.id:
+                params['backing_store'] = parent
+            else:
+                params['base_image'] = parent.get_path()
+
+        volume_cls = node.driver.get_model_class('Volume')
+        volume = volume_cls.objects.create(
+            node=node,
+            name=layer['name'],
+            format=layer['format'],
+            capacity=float(layer['capacity']) / 1024 ** 3,
+            **params)
+        volume.define()
+        logger.info('Import volume {0}'.format(volume.get_path()))
+        if parent is not None:
+            chunks = _set_backing_file(chunks, parent.get_path())
+        _upload(node.driver.conn, volume._libvirt_volume, chunks)
+        self.volumes[layer_id] = volume
+
+    def add_memory(self, group_name, node_name, chunks):
+        if not os.path.exists(settings.SNAPSHOTS_EXTERNAL_DIR):
+            os.makedirs(settings.SNAPSHOTS_EXTERNAL_DIR)
+        path = os.path.join(
+            settings.SNAPSHOTS_EXTERNAL_DIR,
+            'snapshot-memory-{0}_{1}.import'.format(self.name, node_name))
+        self.memory_files[(group_name, node_name)] = path
+        with open(path, 'wb') as fileobj:
+            for chunk in chunks:
+                fileobj.write(chunk)
+
+    def finish(self):
+        """Define nodes and recreate the snapshot
+
+        Nodes are left in the state of the snapshot, like after revert.
+        """
+        snapshot = self.manifest['snapshot']
+        for group_data in self.manifest['groups']:
+            group = self.env.get_group(name=group_data['name'])
+            group.start_networks()
+            for node_data in group_data['nodes']:
+                node = self.nodes[(group.name, node_data['name'])]
+                self._attach_disks(node, node_data['disks'])
+                node.define()
+
+                path = self.memory_files.get((group.name, node.name))
+                if path is not None and node_data.get('uuid') is None:
+                    # Archives of older versions don't keep the UUID
+                    logger.warning('Memory state of {0} is not imported, '
+                                   'the archive has no UUID of the '
+                                   'domain'.format(node.name))
+                elif path is not None:
+                    dxml = node._libvirt_node.XMLDesc(
+                        libvirt.VIR_DOMAIN_XML_SECURE)
+                    node.driver.conn.restoreFlags(
+                        path, dxml, libvirt.VIR_DOMAIN_SAVE_PAUSED)
+                node.snapshot(name=snapshot['name'],
+                              description=snapshot['description'],
+                              external=True)
+        self.remove_memory_files()
+
+    def _attach_disks(self, node, disks):
+        volume_cls = node.driver.get_model_class('Volume')
+        for disk in disks:
+            volume = self.volumes[disk['layers'][-1]]
+            if volume.node_id != node.id:
+                # The whole chain is owned by another node, e.g. a shared
+                # CD-ROM image
+                volume = volume_cls.objects.create(
+                    node=node,
+                    name=disk['name'],
+                    format='qcow2',
+                    base_image=volume.get_path(),
+                    **disk['params'])
+                volume.define()
+            DiskDevice.node_attach_volume(
+                node=node,
+                volume=volume,
+                device=disk['device'],
+                vol_type=disk['type'],
+                bus=disk['bus'],
+                target_dev=disk['target_dev'])
+
+    def remove_memory_files(self):
+        for path in self.memory_files.values():
+            if os.path.isfile(path):
+                os.remove(path)
+
+
+def import_snapshot(fileobj, name=None, connection_string=None):
+    """Recreate an environment and its snapshot from an archive
+
+    Networks and MAC addresses of the exported environment are kept
+    because they are configured inside of the nodes, libvirt names of
+    networks, bridges and volumes are new.
+
+    :param fileobj: binary file object opened for reading, e.g. a pipe
+    :param name: name of the new environment, the exported name if None
+    :param connection_string: libvirt URI for all groups, exported
+        driver parameters are used if None
+        :rtype : Environment
+    """
+    records = iter(ArchiveReader(fileobj))
+    header, _ = next(records)
+    if header['type'] != 'manifest':
+        raise DevopsError('Snapshot archive has no manifest')
+    importer = _SnapshotImporter(header['manifest'], name=name,
+                                 connection_string=connection_string)
+    importer.check()
+    try:
+        importer.create_environment()
+        for header, chunks in records:
+            if header['type'] == 'volume':
+                importer.add_volume(header['id'], chunks)
+            elif header['type'] == 'memory':
+                importer.add_memory(header['group'], header['node'], chunks)
+            else:
+                logger.warning('Unknown record {0} in the snapshot '
+                               'archive is skipped'.format(header['type']))
+        importer.finish()
+    except Exception:
+        logger.error('Import of {0} failed'.format(importer.name))
+        importer.remove_memory_files()
+        if importer.env is not None:
+            importer.env.erase()
+        raise
+    return importer.env
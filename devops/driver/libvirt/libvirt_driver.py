@@ -12,9 +12,17 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from contextlib import contextmanager
 import datetime
+import errno
+import hashlib
+import json
 import os
+import re
+import struct
 import subprocess
+import threading
+import time
 from time import sleep
 import uuid
 from warnings import warn
@@ -27,12 +35,23 @@ import netaddr
 # pylint: disable=redefined-builtin
 from six.moves import xrange
 # pylint: enable=redefined-builtin
+from six.moves.urllib.parse import urlparse
 
+from devops.driver.libvirt.libvirt_events import DomainEventWatcher
+from devops.driver.libvirt.libvirt_events import start_event_loop
+from devops.driver.libvirt import libvirt_placement
+from devops.driver.libvirt.libvirt_stats import DomainStatsCollector
 from devops.driver.libvirt.libvirt_xml_builder import LibvirtXMLBuilder
+from devops.error import DevopsEnvironmentError
 from devops.error import DevopsError
+from devops.error import TimeoutError
 from devops.helpers.helpers import deepgetattr
+from devops.helpers.helpers import file_lock
+from devops.helpers.helpers import get_file_checksum
 from devops.helpers.helpers import get_file_size
+from devops.helpers.helpers import run_parallel
 from devops.helpers.helpers import underscored
+from devops.helpers.helpers import wait
 from devops.helpers.retry import retry
 from devops.helpers import scancodes
 from devops import logger
@@ -50,6 +69,7 @@ class _LibvirtManager(object):
     def __init__(self):
         libvirt.virInitialize()
         self.connections = {}
+        self.event_watchers = {}
 
     def get_connection(self, connection_string):
         """Get libvirt connection for connection string
@@ -57,16 +77,76 @@ class _LibvirtManager(object):
         :type connection_string: str
         """
         if connection_string not in self.connections:
+            # Event loop must be registered before the connection is opened
+            events = settings.LIBVIRT_EVENTS and start_event_loop()
             conn = libvirt.open(connection_string)
             self.connections[connection_string] = conn
+            if not events:
+                self.event_watchers[connection_string] = None
         else:
             conn = self.connections[connection_string]
         return conn
 
+    def get_event_watcher(self, connection_string):
+        """Get watcher of domain events, or None if events are unavailable
+
+        :type connection_string: str
+            :rtype : DomainEventWatcher
+        """
+        conn = self.get_connection(connection_string)
+        if connection_string not in self.event_watchers:
+            try:
+                watcher = DomainEventWatcher(conn)
+            except libvirt.libvirtError as e:
+                logger.warning('Domain events are not available for {0}: '
+                               '{1}'.format(connection_string, e))
+                watcher = None
+            self.event_watchers[connection_string] = watcher
+        return self.event_watchers[connection_string]
+
 
 LibvirtManager = _LibvirtManager()
 
 
+SAVE_IMAGE_MAGIC = b'LibvirtQemudSave'
+SAVE_IMAGE_FORMATS = ('raw', 'gzip', 'bzip2', 'xz', 'lzop')
+
+# Filters of interfaces are named by environment, device and MAC address
+MAC_SUFFIX = re.compile(r'_([0-9a-fA-F]{2}:){5}[0-9a-fA-F]{2}$')
+
+
+def get_save_image_format(path):
+    """Get compression of a memory state file written by libvirt QEMU driver
+
+    The format is set by 'snapshot_image_format' and 'save_image_format'
+    in qemu.conf of the host.
+
+    :type path: str
+        :rtype : str or None if the file is not readable
+    """
+    try:
+        with open(path, 'rb') as save_image:
+            header = save_image.read(32)
+    except (IOError, OSError):
+        return None
+    if len(header) < 32 or header[:16] != SAVE_IMAGE_MAGIC:
+        return None
+    compressed = struct.unpack('=I', header[28:32])[0]
+    if compressed < len(SAVE_IMAGE_FORMATS):
+        return SAVE_IMAGE_FORMATS[compressed]
+    return None
+
+
+def is_nwfilter_blocking(nwfilter):
+    """Check whether a filter of devops drops the traffic
+
+    :type nwfilter: libvirt.virNWFilter
+        :rtype : bool
+    """
+    filter_xml = ET.fromstring(nwfilter.XMLDesc())
+    return filter_xml.find('./rule') is not None
+
+
 class Snapshot(object):
 
     def __init__(self, snapshot):
@@ -97,8 +177,8 @@ class Snapshot(object):
                                 snap_file))
                     except Exception:
                         logger.info(
-                            "Cannot delete external snapshot file {0}"
-                            " must be deleted from cron script".format(
+                            "Cannot delete external snapshot file {0}, "
+                            "it will be removed by 'dos.py gc'".format(
                                 snap_file))
 
     @property
@@ -143,11 +223,10 @@ class Snapshot(object):
     @property
     def disks(self):
         disks = {}
-        xml_snapshot_disks = self._xml_tree.find('./disks')
-        for xml_disk in xml_snapshot_disks:
-            if xml_disk.get('snapshot') == 'external':
-                disks[xml_disk.get('name')] = xml_disk.find(
-                    'source').get('file')
+        for xml_disk in self._xml_tree.findall('./disks/disk'):
+            source = xml_disk.find('source')
+            if xml_disk.get('snapshot') == 'external' and source is not None:
+                disks[xml_disk.get('name')] = source.get('file')
         return disks
 
     @property
@@ -191,6 +270,64 @@ class LibvirtDriver(Driver):
     :param use_host_cpu: When creating nodes, should libvirt's
         CPU "host-model" mode be used to set CPU settings. If set to False,
         default mode ("custom") will be used.  (default: True)
+    :param base_image_cache: Upload each 'source_image' only once into
+        the storage pool, as a shared base volume named by the checksum
+        of the image content. Volumes are created as qcow2 overlays over
+        this base volume. Unused base volumes are removed with
+        cleanup_base_images().  (default: False)
+    :param golden_image_cache: After successful deploy of the admin node,
+        store copies of its disks as a golden image, keyed by checksum of
+        the ISO and the node parameters. Next bootstrap of an admin node
+        with the same key starts it from overlays over the golden image
+        instead of installation from ISO. Golden images are removed with
+        cleanup_golden_images().  (default: False)
+    :param keys_batch_size: Maximum number of keys sent to a node with a
+        single sendKey call. Consecutive keys with the same modifier are
+        pressed together, 1 sends every key separately. Boot loaders
+        with a small keyboard buffer can lose keys of large batches.
+        (default: 1)
+    :param keys_hold_time: Time in milliseconds the keys are held pressed,
+        0 uses the default of the hypervisor.  (default: 0)
+    :param keys_wait_time: Seconds to wait for a <Wait> token in the keys,
+        use <WaitN> to wait N seconds.  (default: 1)
+    :param cpu_pinning: Pin every vcpu of a node to a dedicated host CPU
+        and bind memory of the node to the host NUMA cells of these CPUs.
+        Host CPUs pinned by domains of other environments are not reused,
+        the assignment is stored in the 'placement' parameter of the
+        node.  (default: False)
+    :param hugepage_size: Size of huge pages in KiB used for memory of
+        nodes if 'use_hugepages' is set, default size of the host is used
+        if not set.  (default: None)
+    :param storage_pools: List of storage pools for volumes of nodes,
+        each item is a pool name or a dict with 'name' and 'weight', for
+        example [{'name': 'ssd1', 'weight': 2}, 'hdd1']. Shared base
+        images are kept in 'storage_pool_name'.  (default: [] - all
+        volumes are in 'storage_pool_name')
+    :param storage_pool_policy: How volumes are spread across
+        'storage_pools': 'round-robin' - weighted round-robin per volume,
+        'least-used' - the pool with the least volumes per weight,
+        'node' - all volumes of a node in one pool, nodes are spread
+        with weighted round-robin. Overlays and snapshots are always
+        created in the pool of their backing volume.
+        (default: 'round-robin')
+    :param ephemeral_pool_path: Directory on a RAM-backed filesystem for
+        the storage pool of volumes with 'ephemeral' set. The pool is
+        created with the first ephemeral volume and removed with the
+        last one.  (default: '/dev/shm/fuel-devops')
+    :param ephemeral_memory_reserve: Free memory of the host in MiB which
+        is never used by ephemeral volumes, the volume is created in a
+        disk pool if its capacity doesn't fit into the rest of free
+        memory.  (default: 4096)
+    :param snapshot_memory_bypass_cache: Restore memory state of external
+        snapshots bypassing the page cache of the host, and drop the
+        written memory state file from the page cache after a snapshot
+        is created.  (default: False)
+    :param snapshot_memory_compression: Expected compression of memory
+        state files of external snapshots: 'raw', 'gzip', 'bzip2', 'xz'
+        or 'lzop'. The files are written by the hypervisor, so the format
+        has to be set by 'snapshot_image_format' in qemu.conf of the host,
+        a warning is logged if the written file has another format.
+        Restore detects the format itself.  (default: None)
 
     Note: This class is imported as Driver at .__init__.py
     """
@@ -204,8 +341,31 @@ class LibvirtDriver(Driver):
     reboot_timeout = ParamField()
     use_hugepages = ParamField(default=False)
     vnc_password = ParamField()
+    base_image_cache = ParamField(default=False)
+    golden_image_cache = ParamField(default=False)
+    keys_batch_size = ParamField(default=1)
+    keys_hold_time = ParamField(default=0)
+    keys_wait_time = ParamField(default=1)
+    cpu_pinning = ParamField(default=False)
+    hugepage_size = ParamField(default=None)
+    storage_pools = ParamField(default=[])
+    storage_pool_policy = ParamField(
+        default='round-robin', choices=('round-robin', 'least-used', 'node'))
+    ephemeral_pool_path = ParamField(default='/dev/shm/fuel-devops')
+    ephemeral_memory_reserve = ParamField(default=4096)
+    snapshot_memory_bypass_cache = ParamField(default=False)
+    snapshot_memory_compression = ParamField(
+        default=None, choices=(None,) + SAVE_IMAGE_FORMATS)
 
     _device_name_generators = {}
+    _device_name_lock = threading.Lock()
+    _storage_pool_weights = {}
+    _storage_pool_lock = threading.Lock()
+    _inventories = threading.local()
+
+    base_image_prefix = 'devops_base_'
+    golden_image_prefix = 'devops_golden_'
+    ephemeral_pool_name = 'devops_ephemeral'
 
     @cached_property
     def conn(self):
@@ -221,6 +381,11 @@ class LibvirtDriver(Driver):
         """
         return self.capabilities
 
+    @property
+    def event_watcher(self):
+        """Watcher of domain events, or None if events are unavailable"""
+        return LibvirtManager.get_event_watcher(self.connection_string)
+
     @cached_property
     @retry()
     def capabilities(self):
@@ -282,21 +447,1182 @@ class LibvirtDriver(Driver):
         :rtype : String
         """
         allocated_names = self.get_allocated_device_names()
-        if prefix not in self._device_name_generators:
-            self._device_name_generators[prefix] = (
-                prefix + str(i) for i in xrange(10000))
-        all_names = self._device_name_generators[prefix]
-
-        for name in all_names:
-            if name in allocated_names:
-                continue
-            return name
+        # Nodes of several groups can be defined in parallel threads
+        with self._device_name_lock:
+            if prefix not in self._device_name_generators:
+                self._device_name_generators[prefix] = (
+                    prefix + str(i) for i in xrange(10000))
+            all_names = self._device_name_generators[prefix]
+
+            for name in all_names:
+                if name in allocated_names:
+                    continue
+                return name
         raise DevopsError('All names with prefix {!r} are already in use'
                           .format(prefix))
 
     def get_libvirt_version(self):
         return self.conn.getLibVersion()
 
+    def host_call(self, cmd):
+        """Run a command on the host of the connection
+
+        Commands for a remote host are run over ssh with the user and
+        port of the connection URI, so the host should accept the key
+        of the current user.
+
+        :type cmd: list
+            :rtype : str
+        """
+        uri = urlparse(self.connection_string)
+        if uri.hostname:
+            if uri.scheme.partition('+')[2] not in ('ssh', 'libssh',
+                                                    'libssh2'):
+                raise DevopsError(
+                    'Commands can be run on host {0} only over ssh, '
+                    'use a qemu+ssh:// connection'.format(uri.hostname))
+            target = uri.hostname
+            if uri.username:
+                target = '{0}@{1}'.format(uri.username, uri.hostname)
+            ssh = ['ssh', '-o', 'BatchMode=yes']
+            if uri.port:
+                ssh += ['-p', str(uri.port)]
+            cmd = ssh + [target] + list(cmd)
+        logger.debug('Run on {0}: {1}'.format(
+            self.connection_string, ' '.join(cmd)))
+        return subprocess.check_output(cmd)
+
+    @retry(count=2)
+    def volume_upload(self, volume, path):
+        """Upload file content to libvirt volume
+
+        :type volume: libvirt.virStorageVol
+        :type path: str
+        """
+        def chunk_render(_, _size, _fd):
+            return _fd.read(_size)
+        size = get_file_size(path)
+        with open(path, 'rb') as fd:
+            stream = self.conn.newStream(0)
+            volume.upload(
+                stream=stream, offset=0,
+                length=size, flags=0)
+            stream.sendAll(chunk_render, fd)
+            stream.finish()
+
+    def _base_image_lock(self, name):
+        return file_lock(os.path.join(settings.BASE_IMAGES_LOCK_DIR,
+                                      '{0}.lock'.format(name)))
+
+    @contextmanager
+    def base_image(self, source_image, vol_format):
+        """Get shared base volume with the content of source_image
+
+        The image is uploaded into the storage pool only once, next calls
+        for an image with the same content return the existing volume.
+        The volume is locked while the context is active, so an overlay
+        created in the context can't lose its backing store to
+        cleanup_base_images() of another process.
+
+        :type source_image: str
+        :type vol_format: str
+        :rtype : libvirt.virStorageVol
+        """
+        name = '{0}{1}_{2}'.format(self.base_image_prefix, vol_format,
+                                   get_file_checksum(source_image))
+        pool = self.conn.storagePoolLookupByName(self.storage_pool_name)
+
+        # Another environment can upload the same image at the same time,
+        # so a partially uploaded volume must never be visible to it.
+        with self._base_image_lock(name):
+            try:
+                volume = pool.storageVolLookupByName(name)
+            except libvirt.libvirtError as e:
+                if e.get_error_code() != libvirt.VIR_ERR_NO_STORAGE_VOL:
+                    raise
+                volume = self._upload_base_image(
+                    pool, name, source_image, vol_format)
+            yield volume
+
+    def _upload_base_image(self, pool, name, source_image, vol_format):
+        logger.info('Upload {0} to the shared base volume {1}'.format(
+            source_image, name))
+        xml = LibvirtXMLBuilder.build_volume_xml(
+            name=name,
+            capacity=get_file_size(source_image),
+            vol_format=vol_format,
+            backing_store_path=None,
+            backing_store_format=None,
+        )
+        volume = pool.createXML(xml, 0)
+        try:
+            self.volume_upload(volume, source_image)
+        except Exception:
+            volume.delete(0)
+            raise
+        # Re-read the volume so the capacity of qcow2 images
+        # is taken from the image header
+        pool.refresh(0)
+        return pool.storageVolLookupByName(name)
+
+    def get_base_image(self, source_image, vol_format):
+        """Get shared base volume with the content of source_image
+
+        :type source_image: str
+        :type vol_format: str
+        :rtype : libvirt.virStorageVol
+        """
+        with self.base_image(source_image, vol_format) as volume:
+            return volume
+
+    @retry()
+    def get_base_images(self):
+        """Get reference counters of shared base volumes
+
+        A base volume is referenced by every volume in the storage pool
+        that uses it as a backing store, including volumes of the
+        environments from other fuel-devops databases on the same host.
+
+        :rtype : dict
+        """
+        return self._count_base_image_refs(self._get_volume_backings())
+
+    def _get_volume_backings(self, known=None):
+        """Get paths and backing stores of volumes in the storage pools
+
+        :param known: result of a previous call, the volumes in it are
+            not queried again
+            :rtype : dict of (path, name, backing store path or None)
+                by key of the volume
+        """
+        volumes = {}
+        for pool_name in self.get_storage_pool_names():
+            pool = self.conn.storagePoolLookupByName(pool_name)
+            for vol in pool.listAllVolumes():
+                if known is not None and vol.key() in known:
+                    volumes[vol.key()] = known[vol.key()]
+                    continue
+                backing = ET.fromstring(vol.XMLDesc(0)).find(
+                    'backingStore/path')
+                volumes[vol.key()] = (
+                    vol.path(), vol.name(),
+                    backing.text if backing is not None else None)
+        return volumes
+
+    def _count_base_image_refs(self, volumes):
+        refs = {path: 0 for path, name, _ in volumes.values()
+                if name.startswith(self.base_image_prefix)}
+        for _, _, backing in volumes.values():
+            if backing in refs:
+                refs[backing] += 1
+        return refs
+
+    @staticmethod
+    def _extract_iso_file(iso_path, path, dest):
+        tmp = '{0}.tmp'.format(dest)
+        cmd = ['isoinfo', '-R', '-i', iso_path, '-x', path]
+        try:
+            with open(tmp, 'wb') as f:
+                subprocess.check_call(cmd, stdout=f)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                raise DevopsEnvironmentError('isoinfo')
+            raise
+        # isoinfo succeeds with empty output for missing files
+        if os.path.getsize(tmp) == 0:
+            os.remove(tmp)
+            raise DevopsError('File {0} is not found in {1}'.format(
+                path, iso_path))
+        os.rename(tmp, dest)
+
+    def get_kernel_boot_files(self, iso_path, paths):
+        """Get volumes with files from the ISO image for direct kernel boot
+
+        Files are extracted only once for every ISO content and uploaded
+        into the storage pool as shared base volumes.
+
+        :type iso_path: str
+        :type paths: list
+            :rtype : list
+        """
+        cache_dir = os.path.join(settings.KERNEL_BOOT_DIR,
+                                 get_file_checksum(iso_path))
+        volumes = []
+        for path in paths:
+            dest = os.path.join(cache_dir, path.lstrip('/'))
+            with file_lock('{0}.lock'.format(dest)):
+                if not os.path.isfile(dest):
+                    logger.info('Extract {0} from {1}'.format(path, iso_path))
+                    self._extract_iso_file(iso_path, path, dest)
+            volumes.append(self.get_base_image(dest, 'raw').path())
+        return volumes
+
+    def get_storage_pools(self):
+        """Get names and weights of storage pools for volumes of nodes
+
+        :rtype : list of (name, weight) tuples
+        """
+        if not self.storage_pools:
+            return [(self.storage_pool_name, 1)]
+        pools = []
+        for pool in self.storage_pools:
+            if isinstance(pool, dict):
+                pools.append((pool['name'], pool.get('weight', 1)))
+            else:
+                pools.append((pool, 1))
+        return pools
+
+    def get_storage_pool_names(self):
+        """Get names of all storage pools used by the driver
+
+        :rtype : list
+        """
+        names = [self.storage_pool_name]
+        for name, _ in self.get_storage_pools():
+            if name not in names:
+                names.append(name)
+        return names
+
+    def _next_storage_pool(self, pools):
+        # Smooth weighted round-robin, the state is shared by all
+        # drivers of the connection
+        with self._storage_pool_lock:
+            current = self._storage_pool_weights.setdefault(
+                self.connection_string, {})
+            for name, weight in pools:
+                current[name] = current.get(name, 0) + weight
+            name = max(pools, key=lambda pool: current[pool[0]])[0]
+            current[name] -= sum(weight for _, weight in pools)
+            return name
+
+    def _get_ephemeral_pool(self):
+        try:
+            return self.conn.storagePoolLookupByName(self.ephemeral_pool_name)
+        except libvirt.libvirtError as e:
+            if e.get_error_code() != libvirt.VIR_ERR_NO_STORAGE_POOL:
+                raise
+            return None
+
+    @retry()
+    def get_ephemeral_storage_pool(self, capacity):
+        """Get RAM-backed storage pool for a volume, create it if missing
+
+        Existing ephemeral volumes can grow up to their capacity, so this
+        growth is subtracted from free memory of the host as well as
+        'ephemeral_memory_reserve'.
+
+        :param capacity: capacity of the volume in bytes
+            :rtype : str or None if the host has not enough free memory
+        """
+        lock_path = os.path.join(settings.BASE_IMAGES_LOCK_DIR,
+                                 '{0}.lock'.format(self.ephemeral_pool_name))
+        with file_lock(lock_path):
+            pool = self._get_ephemeral_pool()
+            growth = 0
+            if pool is not None:
+                for vol in pool.listAllVolumes():
+                    _, vol_capacity, allocation = vol.info()
+                    growth += max(vol_capacity - allocation, 0)
+            available = ((self.conn.getFreeMemory() - growth) // 1024 ** 2 -
+                         self.ephemeral_memory_reserve)
+            if capacity // 1024 ** 2 > available:
+                logger.warning(
+                    'Not enough free memory for an ephemeral volume of {0} '
+                    'MiB ({1} MiB available), a disk pool is used'.format(
+                        capacity // 1024 ** 2, available))
+                return None
+
+            if pool is None:
+                logger.info('Create storage pool {0} in {1}'.format(
+                    self.ephemeral_pool_name, self.ephemeral_pool_path))
+                pool = self.conn.storagePoolDefineXML(
+                    LibvirtXMLBuilder.build_storage_pool_xml(
+                        self.ephemeral_pool_name, self.ephemeral_pool_path),
+                    0)
+                pool.build(0)
+                pool.create(0)
+            return self.ephemeral_pool_name
+
+    @retry()
+    def release_ephemeral_storage_pool(self):
+        """Remove RAM-backed storage pool if it has no volumes"""
+        lock_path = os.path.join(settings.BASE_IMAGES_LOCK_DIR,
+                                 '{0}.lock'.format(self.ephemeral_pool_name))
+        with file_lock(lock_path):
+            pool = self._get_ephemeral_pool()
+            if pool is None or pool.numOfVolumes() > 0:
+                return
+            logger.info('Remove storage pool {0}'.format(
+                self.ephemeral_pool_name))
+            pool.destroy()
+            pool.delete(0)
+            pool.undefine()
+
+    @retry()
+    def select_storage_pool(self, volume, capacity=0):
+        """Select storage pool for a new volume
+
+        :type volume: LibvirtVolume
+        :param capacity: capacity of the volume in bytes
+            :rtype : str
+        """
+        if volume.storage_pool:
+            return volume.storage_pool
+        if volume.backing_store is not None:
+            return (volume.backing_store.storage_pool or
+                    self.storage_pool_name)
+        if volume.ephemeral:
+            pool_name = self.get_ephemeral_storage_pool(capacity)
+            if pool_name is not None:
+                return pool_name
+        pools = self.get_storage_pools()
+        if len(pools) == 1:
+            return pools[0][0]
+
+        if self.storage_pool_policy == 'node' and volume.node is not None:
+            for other in volume.node.get_volumes():
+                if other.pk != volume.pk and other.storage_pool:
+                    return other.storage_pool
+        elif self.storage_pool_policy == 'least-used':
+            def usage(pool):
+                libvirt_pool = self.conn.storagePoolLookupByName(pool[0])
+                return (float(libvirt_pool.numOfVolumes()) / pool[1],
+                        -libvirt_pool.info()[3])
+            return min(pools, key=usage)[0]
+        return self._next_storage_pool(pools)
+
+    @retry()
+    def get_storage_pools_free(self):
+        """Get free space in bytes in the storage pools for volumes
+
+        :rtype : int
+        """
+        return sum(self.conn.storagePoolLookupByName(name).info()[3]
+                   for name, _ in self.get_storage_pools())
+
+    @retry()
+    def get_host_capacity(self):
+        """Get free memory, CPUs and free space in the storage pool
+
+        :rtype : dict with 'memory' (MiB), 'vcpu' and 'disk' (GiB)
+        """
+        info = self.conn.getInfo()
+        return {
+            'memory': self.conn.getFreeMemory() // 1024 ** 2,
+            'vcpu': info[2],
+            'disk': self.get_storage_pools_free() // 1024 ** 3,
+        }
+
+    def _resource_row(self, resource, unit, required, available,
+                      hard=True):
+        if required <= available:
+            status = 'ok'
+        else:
+            status = 'insufficient' if hard else 'warning'
+        return {
+            'host': self.connection_string,
+            'resource': resource,
+            'unit': unit,
+            'required': required,
+            'available': available,
+            'status': status,
+            'hard': hard,
+        }
+
+    @retry()
+    def get_resources_report(self, nodes):
+        """Compare resources required by nodes with free resources
+
+        Only nodes which are not running are counted. Memory of running
+        domains, including domains of other environments, is counted as
+        used even if the guest has not touched it yet. Space of thin
+        volumes and vcpus can be overcommitted, so they are only warned.
+
+        :type nodes: list
+            :rtype : list
+        """
+        active = {dom.UUIDString(): dom for dom in self.conn.listAllDomains(
+            libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)}
+        nodes = [node for node in nodes if node.uuid not in active]
+        info = self.conn.getInfo()
+        used_memory = used_vcpus = 0
+        for dom in active.values():
+            dom_info = dom.info()
+            used_memory += dom_info[1] // 1024
+            used_vcpus += dom_info[3]
+        cells = libvirt_placement.get_host_cells(self.capabilities)
+        report = []
+
+        memory = sum(node.memory for node in nodes)
+        if self.use_hugepages:
+            free = 0
+            if cells and self.get_hugepage_size(cells):
+                free = sum(self.get_cells_free_memory(cells).values())
+            report.append(self._resource_row(
+                'hugepages', 'MiB', memory, free))
+        else:
+            free = min(self.conn.getFreeMemory() // 1024 ** 2,
+                       info[1] - used_memory)
+            report.append(self._resource_row('memory', 'MiB', memory, free))
+
+        vcpus = sum(node.vcpu for node in nodes)
+        if self.cpu_pinning:
+            free = (sum(len(cell['cpus']) for cell in cells) -
+                    len(self.get_pinned_cpus()))
+            report.append(self._resource_row(
+                'pinned cpus', 'CPUs', vcpus, free))
+        else:
+            report.append(self._resource_row(
+                'vcpus', 'CPUs', vcpus, info[2] - used_vcpus, hard=False))
+
+        allocation = capacity = 0
+        for node in nodes:
+            for volume in node.get_volumes():
+                if volume.uuid:
+                    continue
+                volume_allocation, volume_capacity = (
+                    volume.get_required_space())
+                allocation += volume_allocation
+                capacity += volume_capacity
+        free = self.get_storage_pools_free() // 1024 ** 2
+        report.append(self._resource_row(
+            'disk', 'MiB', allocation // 1024 ** 2, free))
+        report.append(self._resource_row(
+            'disk capacity', 'MiB', capacity // 1024 ** 2, free, hard=False))
+        return report
+
+    @retry()
+    def get_pinned_cpus(self, exclude=None):
+        """Get host CPUs to which vcpus of defined domains are pinned
+
+        :param exclude: UUID of domain which is skipped
+            :rtype : set
+        """
+        cpus = set()
+        for dom in self.conn.listAllDomains():
+            if dom.UUIDString() == exclude:
+                continue
+            cpus.update(libvirt_placement.get_pinned_cpus(
+                ET.fromstring(dom.XMLDesc(0))))
+        return cpus
+
+    def get_hugepage_size(self, cells):
+        """Get size of huge pages in KiB used for nodes
+
+        :type cells: list
+            :rtype : int
+        """
+        if self.hugepage_size:
+            return int(self.hugepage_size)
+        sizes = sorted(size for cell in cells
+                       for size, count in cell['pages'].items()
+                       if size > 4 and count)
+        return sizes[0] if sizes else None
+
+    @retry()
+    def get_cells_free_memory(self, cells):
+        """Get free memory in MiB of host NUMA cells
+
+        Free huge pages are counted instead if 'use_hugepages' is set.
+
+        :type cells: list
+            :rtype : dict
+        """
+        ids = [cell['id'] for cell in cells]
+        first, count = min(ids), max(ids) - min(ids) + 1
+        size = self.use_hugepages and self.get_hugepage_size(cells)
+        if size:
+            pages = self.conn.getFreePages([size], first, count)
+            return {cell_id: pages.get(cell_id, {}).get(size, 0) * size // 1024
+                    for cell_id in ids}
+        free = self.conn.getCellsFreeMemory(first, count)
+        return {cell_id: free[cell_id - first] // 1024 ** 2
+                for cell_id in ids}
+
+    @retry()
+    def get_reserved_memory(self, exclude=None, hugepages=False):
+        """Get memory of host NUMA cells bound to domains which are not running
+
+        Free memory of the host includes memory of defined domains which
+        are not running, but their numatune needs it on start.
+
+        :param exclude: UUID of domain which is skipped
+        :param hugepages: count domains backed by huge pages, otherwise
+            domains backed by normal memory
+            :rtype : dict of memory in MiB by host cell ID
+        """
+        reserved = {}
+        for dom in self.conn.listAllDomains(
+                libvirt.VIR_CONNECT_LIST_DOMAINS_INACTIVE):
+            if dom.UUIDString() == exclude:
+                continue
+            xml = ET.fromstring(dom.XMLDesc(0))
+            if (xml.find('memoryBacking/hugepages') is not None) != hugepages:
+                continue
+            for cell_id, memory in libvirt_placement.get_reserved_memory(
+                    xml).items():
+                reserved[cell_id] = reserved.get(cell_id, 0) + memory
+        return reserved
+
+    def plan_node_placement(self, node):
+        """Assign vcpus and memory of the node to host NUMA cells
+
+        CPUs pinned by other domains and memory bound to other domains
+        which are not running are not used.
+
+        :type node: LibvirtNode
+            :rtype : list
+        """
+        cells = libvirt_placement.get_host_cells(self.capabilities)
+        if not cells:
+            raise DevopsError('NUMA topology of the host is not available')
+        free_memory = self.get_cells_free_memory(cells)
+        reserved = self.get_reserved_memory(
+            exclude=node.uuid,
+            hugepages=bool(self.use_hugepages and
+                           self.get_hugepage_size(cells)))
+        return libvirt_placement.plan_placement(
+            host_cells=cells,
+            guest_cells=libvirt_placement.get_guest_cells(
+                node.vcpu, node.memory, node.numa),
+            pinned=self.get_pinned_cpus(exclude=node.uuid),
+            free_memory={cell_id: free - reserved.get(cell_id, 0)
+                         for cell_id, free in free_memory.items()})
+
+    @contextmanager
+    def placement_lock(self):
+        """Serialize placement of nodes between processes on the host"""
+        if not self.cpu_pinning:
+            yield
+            return
+        with file_lock(os.path.join(settings.BASE_IMAGES_LOCK_DIR,
+                                    'placement.lock')):
+            yield
+
+    def cleanup_base_images(self):
+        """Remove shared base volumes which are not used by any volume
+
+        :rtype : list
+        """
+        volumes = self._get_volume_backings()
+        removed = []
+        for path, refs in self._count_base_image_refs(volumes).items():
+            if refs > 0:
+                continue
+            volume = self.conn.storageVolLookupByKey(path)
+            # Another process can look up the image or create an overlay
+            # over it, so volumes created since the listing are checked
+            # under the lock of the image
+            with self._base_image_lock(volume.name()):
+                volumes = self._get_volume_backings(known=volumes)
+                if any(backing == path
+                       for _, _, backing in volumes.values()):
+                    continue
+                logger.info('Remove unused base volume {0}'.format(path))
+                volume.delete(0)
+            removed.append(path)
+        return removed
+
+    @staticmethod
+    def golden_image_meta_path(key):
+        return os.path.join(settings.GOLDEN_IMAGES_DIR,
+                            '{0}.json'.format(key))
+
+    def get_golden_images(self):
+        """Get metadata of golden images of admin nodes by their keys
+
+        :rtype : dict
+        """
+        images = {}
+        if not os.path.isdir(settings.GOLDEN_IMAGES_DIR):
+            return images
+        for name in os.listdir(settings.GOLDEN_IMAGES_DIR):
+            if name.endswith('.json'):
+                key = name[:-len('.json')]
+                with open(self.golden_image_meta_path(key)) as meta_file:
+                    images[key] = json.load(meta_file)
+        return images
+
+    def cleanup_golden_images(self, keys=None):
+        """Remove golden images of admin nodes
+
+        The metadata is removed, so the image is not used by new nodes.
+        Volumes of the image which are backing stores of existing nodes
+        are left, 'dos.py gc' removes them when they are not used.
+
+        :param keys: keys of the images to remove, all images if None
+            :rtype : list of paths of removed volumes
+        """
+        removed = []
+        for key, meta in self.get_golden_images().items():
+            if keys is not None and key not in keys:
+                continue
+            meta_path = self.golden_image_meta_path(key)
+            with file_lock(meta_path + '.lock'):
+                logger.info('Remove golden image {0}'.format(key))
+                os.remove(meta_path)
+                backings = set(
+                    backing for _, _, backing in
+                    self._get_volume_backings().values())
+                for path in meta['volumes'].values():
+                    if path in backings:
+                        continue
+                    try:
+                        volume = self.conn.storageVolLookupByKey(path)
+                    except libvirt.libvirtError as e:
+                        if (e.get_error_code() !=
+                                libvirt.VIR_ERR_NO_STORAGE_VOL):
+                            raise
+                        continue
+                    volume.delete(0)
+                    removed.append(path)
+        return removed
+
+    def _get_used_paths(self):
+        """Get paths of disks of all domains and of their snapshots"""
+        paths = set()
+        for domain in self.conn.listAllDomains():
+            xmls = [ET.fromstring(domain.XMLDesc(0))]
+            for snapshot in domain.listAllSnapshots(0):
+                snapshot_xml = ET.fromstring(snapshot.getXMLDesc(0))
+                for source in snapshot_xml.findall('disks/disk/source'):
+                    paths.add(source.get('file'))
+                if snapshot_xml.find('domain') is not None:
+                    xmls.append(snapshot_xml.find('domain'))
+            for xml in xmls:
+                for source in xml.findall('devices/disk/source'):
+                    paths.add(source.get('file'))
+        return paths
+
+    def _is_devops_volume(self, name, backing, node_prefixes):
+        if name.startswith((self.base_image_prefix,
+                            self.golden_image_prefix)):
+            return True
+        # Overlays of external snapshots, reverts and flattening are
+        # named <env>_<node>_<volume>.<suffix> after their backing store
+        if backing is not None and '.' in name:
+            prefix = name.split('.', 1)[0]
+            if (prefix.count('_') >= 2 and prefix ==
+                    os.path.basename(backing).split('.', 1)[0]):
+                return True
+        return name.startswith(node_prefixes)
+
+    @staticmethod
+    def _get_volume_age(vol_xml):
+        """Get seconds since the last change of the volume, or None"""
+        times = [float(item.text) for item in vol_xml.findall(
+            'target/timestamps/*') if item.tag in ('mtime', 'ctime')]
+        if times:
+            return time.time() - max(times)
+
+    @retry()
+    def get_garbage(self, known_volumes, env_nodes, min_age=3600):
+        """Find volumes which are left by erased snapshots and nodes
+
+        A volume of the storage pools of the driver is garbage if it is
+        not in the database, is not used by any domain of the host or by
+        its snapshots, is not a backing store of a used volume, was not
+        changed for min_age seconds, is not in a golden image, and was
+        created by fuel-devops: a shared base image, a volume of a
+        removed golden image, an overlay of an external snapshot or a
+        volume named after an existing node. Other volumes are never
+        touched, they can belong to another database.
+
+        :param known_volumes: set of keys of volumes in the database
+        :param env_nodes: dict of names of environments in the database
+            with lists of names of their nodes
+        :param min_age: seconds, newer volumes can be uploaded or be
+            saved to the database by another process
+            :rtype : list of dicts with 'type', 'path' and 'size' (bytes)
+        """
+        pool_names = set(self.get_storage_pool_names())
+        if self._get_ephemeral_pool() is not None:
+            pool_names.add(self.ephemeral_pool_name)
+
+        # All pools of the host are scanned, so a volume in another pool
+        # keeps its backing store
+        volumes = {}
+        recent = set()
+        for pool in self.conn.listAllStoragePools(
+                libvirt.VIR_CONNECT_LIST_STORAGE_POOLS_ACTIVE):
+            for vol in pool.listAllVolumes():
+                vol_xml = ET.fromstring(vol.XMLDesc(0))
+                backing = vol_xml.find('backingStore/path')
+                volumes[vol.path()] = (
+                    vol, pool.name(),
+                    backing.text if backing is not None else None)
+                age = self._get_volume_age(vol_xml)
+                if age is not None and age < min_age:
+                    recent.add(vol.path())
+
+        used = set(known_volumes) | self._get_used_paths() | recent
+        for meta in self.get_golden_images().values():
+            used.update(meta['volumes'].values())
+        # Volumes of nodes are named <env>_<node>_<volume>, a bare <env>_
+        # prefix would also match environments like <env>_<suffix>
+        node_prefixes = tuple(
+            '{0}_'.format(underscored(env_name, node_name))
+            for env_name, node_names in env_nodes.items()
+            for node_name in node_names)
+        pending = [
+            path for path, (vol, pool_name, backing) in volumes.items()
+            if path in used or pool_name not in pool_names or
+            not self._is_devops_volume(vol.name(), backing, node_prefixes)]
+        keep = set()
+        while pending:
+            path = pending.pop()
+            if path in keep or path not in volumes:
+                continue
+            keep.add(path)
+            pending.append(volumes[path][2])
+
+        return [{'type': 'volume', 'path': path,
+                 'size': volumes[path][0].info()[2]}
+                for path in sorted(volumes) if path not in keep]
+
+    @retry()
+    def get_snapshot_memory_files(self):
+        """Get memory state files used by snapshots on the host
+
+        :rtype : set
+        """
+        files = set()
+        for domain in self.conn.listAllDomains():
+            for snapshot in domain.listAllSnapshots(0):
+                memory = ET.fromstring(snapshot.getXMLDesc(0)).find('memory')
+                if memory is not None and memory.get('file'):
+                    files.add(memory.get('file'))
+        return files
+
+    @retry()
+    def remove_garbage(self, item):
+        """Remove a volume found by get_garbage()
+
+        A shared base image is removed under its lock only if it is still
+        not used, another process can create an overlay over it.
+        """
+        volume = self.conn.storageVolLookupByKey(item['path'])
+        if not volume.name().startswith(self.base_image_prefix):
+            logger.info('Remove unused volume {0}'.format(item['path']))
+            volume.delete(0)
+            return
+        with self._base_image_lock(volume.name()):
+            if self.get_base_images().get(item['path'], 1) > 0:
+                raise DevopsError('Base volume {0} is used'.format(
+                    item['path']))
+            logger.info('Remove unused base volume {0}'.format(item['path']))
+            volume.delete(0)
+
+    @retry()
+    def _erase_domain(self, domain):
+        if domain.isActive():
+            domain.destroy()
+        for snapshot in domain.listAllSnapshots(0):
+            Snapshot(snapshot).delete_snapshot_files()
+        domain.undefineFlags(libvirt.VIR_DOMAIN_UNDEFINE_SNAPSHOTS_METADATA)
+
+    @retry()
+    def _erase_volume(self, volume):
+        volume.delete(0)
+
+    def erase_group(self, group, threads=None):
+        """Remove domains, volumes, networks, filters and DHCP entries
+
+        DHCP entries of the nodes are removed from the networks of other
+        groups, which serve replicas of the group.
+
+        Domains, volumes, networks and filters of the host are listed
+        once for the group instead of a lookup of every object, domains
+        and volumes are removed in parallel. Records of the group are
+        not deleted, this is done in bulk by the caller.
+
+        :type group: Group
+        :param threads: number of parallel removals, a thread for every
+            domain or volume if None
+        """
+        nodes = list(group.get_nodes())
+        volumes = [volume for volume in
+                   Volume.objects.filter(node__group=group) if volume.uuid]
+        interfaces = Interface.objects.filter(
+            node__group=group, l2_network_device__isnull=False)
+        l2_devices = list(group.get_l2_network_devices())
+
+        uuids = set(node.uuid for node in nodes if node.uuid)
+        domains = [domain for domain in self.conn.listAllDomains()
+                   if domain.UUIDString() in uuids]
+        logger.info('Remove {0} domains of group {1}'.format(
+            len(domains), group.name))
+        run_parallel(self._erase_domain, domains, threads)
+
+        # Entries of interfaces on replicas are kept by the original
+        # network of another group, see Node.update_dhcp_hosts()
+        by_device = {}
+        for interface in interfaces:
+            l2_device = interface.l2_network_device
+            if (l2_device.replica_of is None or
+                    l2_device.address_pool is None):
+                continue
+            by_device.setdefault(l2_device.pk, (l2_device, []))[1].append(
+                interface)
+        for l2_device, device_interfaces in by_device.values():
+            l2_device.update_dhcp_hosts(remove=device_interfaces)
+
+        keys = set(volume.uuid for volume in volumes)
+        libvirt_volumes = [vol for pool in self.conn.listAllStoragePools()
+                           if pool.isActive()
+                           for vol in pool.listAllVolumes()
+                           if vol.key() in keys]
+        logger.info('Remove {0} volumes of group {1}'.format(
+            len(libvirt_volumes), group.name))
+        run_parallel(self._erase_volume, libvirt_volumes, threads)
+        if any(volume.storage_pool == self.ephemeral_pool_name
+               for volume in volumes):
+            self.release_ephemeral_storage_pool()
+
+        # Filters of interfaces refer to filters of networks
+        nwfilters = {nwfilter.name(): nwfilter
+                     for nwfilter in self.conn.listAllNWFilters(0)}
+        for interface in interfaces:
+            nwfilter = nwfilters.pop(interface.nwfilter_name, None)
+            if nwfilter is not None:
+                nwfilter.undefine()
+
+        networks = {network.UUIDString(): network
+                    for network in self.conn.listAllNetworks()}
+        for l2_device in l2_devices:
+            network = networks.get(l2_device.uuid)
+            if network is not None:
+                bridge_name = network.bridgeName()
+                if network.isActive():
+                    network.destroy()
+                for vlanid in l2_device.vlan_ifaces:
+                    l2_device.iface_undefine(
+                        iface_name='{0}.{1}'.format(bridge_name, vlanid))
+                network.undefine()
+            nwfilter = nwfilters.pop(l2_device.nwfilter_name, None)
+            if nwfilter is not None:
+                nwfilter.undefine()
+
+    @retry()
+    def get_drift(self, groups):
+        """Compare objects of the host with records of the groups
+
+        Domains, networks, volumes and filters are listed once for the
+        connection and compared with the records of all groups on it.
+        An object belongs to devops only if it has the exact name built
+        from a record: '<environment>_<node>' for domains and
+        '<environment>_<l2 network device>' for networks and their
+        filters, filters of interfaces add '_<MAC>' to the name of the
+        network filter. Other objects of the host are never touched,
+        even if their names start with the name of an environment.
+        Records without UUID are not defined yet, their objects are
+        neither missing nor orphans. Unused volumes are left to
+        'dos.py gc'.
+
+        :param groups: groups of all environments in the database
+            :rtype : list of dicts, see devops.helpers.reconcile
+        """
+        groups = [group for group in groups
+                  if group.environment is not None and
+                  group.driver.name == self.name and
+                  group.driver.connection_string == self.connection_string]
+
+        drift = []
+
+        def add(kind, obj, name, repair, env, stage=None, detail='',
+                **data):
+            data.update(kind=kind, object=obj, name=name, repair=repair,
+                        stage=stage, detail=detail,
+                        host=self.connection_string, env=env)
+            drift.append(data)
+
+        def compare(obj, records, objects, stage):
+            """Compare records [(uuid, name, env, record)] with {uuid: name}"""
+            owners = {name: (uuid_string, env)
+                      for uuid_string, name, env, _ in records}
+            records = {uuid_string: (name, env, record)
+                       for uuid_string, name, env, record in records
+                       if uuid_string}
+            uuids = dict((name, uuid_string)
+                         for uuid_string, name in objects.items())
+            for uuid_string in set(records) - set(objects):
+                name, env, record = records[uuid_string]
+                if name in uuids:
+                    add('mismatch', obj, name, 'update-uuid', env,
+                        record=record, uuid=uuids[name],
+                        detail='{0} in the database, {1} on the '
+                        'host'.format(uuid_string, uuids[name]))
+                elif obj == 'domain':
+                    add('missing', obj, name, 'delete-record', env,
+                        record=record, detail=uuid_string)
+                else:
+                    add('missing', obj, name, None, env, detail=uuid_string)
+            # An object with the name of a record is adopted by the record
+            # if its own object is missing, see 'mismatch' above
+            for uuid_string in set(objects) - set(records):
+                name = objects[uuid_string]
+                if name not in owners:
+                    continue
+                record_uuid, env = owners[name]
+                if record_uuid in objects:
+                    add('orphan', obj, name, 'remove', env, stage=stage,
+                        uuid=uuid_string, detail=uuid_string)
+
+        nodes = Node.objects.filter(group__in=groups).select_related(
+            'group__environment')
+        compare('domain', [
+            (node.uuid, underscored(node.group.environment.name, node.name),
+             node.group.environment.name, node)
+            for node in nodes], {
+            domain.UUIDString(): domain.name()
+            for domain in self.conn.listAllDomains()}, stage=0)
+
+        l2_devices = list(L2NetworkDevice.objects.filter(
+            group__in=groups).select_related('group__environment'))
+        compare('network', [
+            (l2_device.uuid, LibvirtXMLBuilder._crop_name(
+                l2_device.network_name), l2_device.group.environment.name,
+             l2_device)
+            for l2_device in l2_devices], {
+            network.UUIDString(): network.name()
+            for network in self.conn.listAllNetworks()}, stage=1)
+
+        keys = set(
+            vol.key() for pool in self.conn.listAllStoragePools(
+                libvirt.VIR_CONNECT_LIST_STORAGE_POOLS_ACTIVE)
+            for vol in pool.listAllVolumes())
+        volumes = Volume.objects.filter(
+            node__group__in=groups).select_related('node__group__environment')
+        for volume in volumes:
+            if volume.uuid and volume.uuid not in keys:
+                add('missing', 'volume', volume.uuid, None,
+                    volume.node.group.environment.name)
+
+        # Filters of interfaces refer to filters of networks, so they are
+        # defined after and removed before them
+        network_filters = {
+            l2_device.nwfilter_name: l2_device.group.environment.name
+            for l2_device in l2_devices}
+        filters = {l2_device.nwfilter_name: (
+            l2_device, 1, network_filters[l2_device.nwfilter_name])
+            for l2_device in l2_devices if l2_device.uuid}
+        names = set(network_filters)
+        interfaces = Interface.objects.filter(
+            node__group__in=groups,
+            l2_network_device__isnull=False).select_related(
+            'node__group__environment', 'l2_network_device')
+        for interface in interfaces:
+            names.add(interface.nwfilter_name)
+            # Filters are defined with the domain of the node
+            if interface.node.uuid:
+                filters[interface.nwfilter_name] = (
+                    interface, 2, interface.node.group.environment.name)
+        nwfilters = set(nwfilter.name()
+                        for nwfilter in self.conn.listAllNWFilters(0))
+        for name in set(filters) - nwfilters:
+            record, stage, env = filters[name]
+            add('missing', 'nwfilter', name, 'define', env, stage=stage,
+                record=record)
+        # Filters of removed interfaces are left on the networks
+        for name in nwfilters - names:
+            match = MAC_SUFFIX.search(name)
+            if match and name[:match.start()] in network_filters:
+                add('orphan', 'nwfilter', name, 'remove',
+                    network_filters[name[:match.start()]], stage=2)
+        return drift
+
+    @retry()
+    def repair_drift(self, item):
+        """Repair an object of the host found by get_drift()"""
+        logger.info('Repair {0} {1} {2}'.format(
+            item['kind'], item['object'], item['name']))
+        if item['object'] == 'domain':
+            self._erase_domain(self.conn.lookupByUUIDString(item['uuid']))
+        elif item['object'] == 'network':
+            network = self.conn.networkLookupByUUIDString(item['uuid'])
+            if network.isActive():
+                network.destroy()
+            network.undefine()
+        elif item['object'] == 'nwfilter' and item['repair'] == 'define':
+            self.conn.nwfilterDefineXML(item['record'].build_filter_xml())
+        elif item['object'] == 'nwfilter':
+            self.conn.nwfilterLookupByName(item['name']).undefine()
+        else:
+            raise DevopsError('Cannot repair {0} {1}'.format(
+                item['object'], item['name']))
+
+    @retry()
+    def get_filter_states(self, names=None):
+        """Get a view of blocking states of network filters
+
+        All filters are listed with a single call, the XML is fetched
+        only for the filters in 'names'.
+
+        :type names: list or None for all filters
+            :rtype : dict of (virNWFilter, blocked) by name of the filter
+        """
+        if names is not None:
+            names = set(names)
+        return {nwfilter.name(): (nwfilter, is_nwfilter_blocking(nwfilter))
+                for nwfilter in self.conn.listAllNWFilters(0)
+                if names is None or nwfilter.name() in names}
+
+    @retry()
+    def update_filters(self, block=(), unblock=(), states=None):
+        """Block and unblock traffic of many interfaces and networks
+
+        Filters are redefined only when their state is changed. A view
+        returned by get_filter_states() can be passed to apply several
+        changes in a row without querying the filters again, it is
+        updated with the new states.
+
+        :param block: LibvirtInterface and LibvirtL2NetworkDevice objects
+        :param unblock: LibvirtInterface and LibvirtL2NetworkDevice objects
+        :param states: view of filter states, queried if None
+            :rtype : list of interfaces and networks with changed state
+        """
+        changes = ([(item, True) for item in block] +
+                   [(item, False) for item in unblock])
+        if states is None:
+            states = self.get_filter_states(
+                names=[item.nwfilter_name for item, _ in changes])
+
+        redefined = []
+        for item, blocked in changes:
+            name = item.nwfilter_name
+            if name not in states:
+                logger.error("NWFilter not found by name: {}".format(name))
+                continue
+            nwfilter, is_blocked = states[name]
+            if is_blocked == blocked:
+                continue
+            self.conn.nwfilterDefineXML(item.build_filter_xml(
+                uuid=nwfilter.UUIDString(), blocked=blocked))
+            states[name] = (nwfilter, blocked)
+            logger.info("NWFilter {0} has been {1}".format(
+                name, 'blocked' if blocked else 'unblocked'))
+            redefined.append(item)
+        return redefined
+
+    @retry()
+    def get_domains_inventory(self, uuids=None, details=()):
+        """Get state and devices of domains in bulk
+
+        State of all domains is taken from a single stats query. Other
+        details need a call for every domain, so they are queried only
+        if requested: 'devices' (VNC port, interfaces and disks) and
+        'snapshots' (names of snapshots).
+
+        :type uuids: list
+        :type details: tuple
+            :rtype : dict
+        """
+        try:
+            stats = self.conn.getAllDomainStats(
+                libvirt.VIR_DOMAIN_STATS_STATE)
+            states = [(dom, stat['state.state']) for dom, stat in stats]
+        except libvirt.libvirtError as e:
+            if e.get_error_code() != libvirt.VIR_ERR_NO_SUPPORT:
+                raise
+            states = [(dom, dom.state()[0])
+                      for dom in self.conn.listAllDomains()]
+        if uuids is not None:
+            uuids = set(uuids)
+            states = [(dom, state) for dom, state in states
+                      if dom.UUIDString() in uuids]
+
+        inventory = {}
+        for dom, state in states:
+            item = {
+                'name': dom.name(),
+                'state': state,
+                'active': state in (
+                    libvirt.VIR_DOMAIN_RUNNING,
+                    libvirt.VIR_DOMAIN_BLOCKED,
+                    libvirt.VIR_DOMAIN_PAUSED,
+                    libvirt.VIR_DOMAIN_PMSUSPENDED),
+            }
+            if 'devices' in details:
+                item.update(self._get_domain_devices(dom))
+            if 'snapshots' in details:
+                item['snapshots'] = dom.snapshotListNames()
+                item['snapshots_count'] = len(item['snapshots'])
+            inventory[dom.UUIDString()] = item
+        return inventory
+
+    @staticmethod
+    def _get_domain_devices(dom):
+        xml_desc = ET.fromstring(dom.XMLDesc(0))
+        vnc_element = xml_desc.find('devices/graphics[@type="vnc"][@port]')
+        interfaces = {}
+        for iface in xml_desc.findall('devices/interface'):
+            mac = iface.find('mac')
+            target = iface.find('target')
+            if mac is not None:
+                interfaces[mac.get('address')] = (
+                    target.get('dev') if target is not None else None)
+        disks = {}
+        for disk in xml_desc.findall('devices/disk'):
+            target = disk.find('target')
+            source = disk.find('source')
+            if target is not None:
+                disks[target.get('dev')] = (
+                    source.get('file') if source is not None else None)
+        return {
+            'vnc_port': (vnc_element.get('port')
+                         if vnc_element is not None else None),
+            'interfaces': interfaces,
+            'disks': disks,
+        }
+
+    def _get_inventories(self):
+        # Every node loads its own instance of the driver, so the cache
+        # is kept per driver record and per thread
+        if not hasattr(self._inventories, 'drivers'):
+            self._inventories.drivers = {}
+        return self._inventories.drivers
+
+    def load_inventory(self, nodes, details=()):
+        """Cache the inventory of nodes for the node properties
+
+        :type nodes: list
+        :type details: tuple
+        """
+        self._get_inventories()[self.pk] = self.get_domains_inventory(
+            uuids=[node.uuid for node in nodes], details=details)
+
+    def clear_inventory(self):
+        self._get_inventories().pop(self.pk, None)
+
+    def get_stats_collector(self, nodes, interval=5, history=60):
+        """Get collector of resource usage of the nodes
+
+        The collector is a thread, call start() to sample periodically
+        or sample() to take a single sample.
+
+        :type nodes: list
+        :type interval: int
+        :type history: int
+            :rtype : DomainStatsCollector
+        """
+        domains = {
+            node.uuid: {
+                'env': deepgetattr(node, 'group.environment.name'),
+                'node': node.name,
+            } for node in nodes if node.uuid}
+        return DomainStatsCollector(self.conn, domains,
+                                    interval=interval, history=history)
+
+    def get_inventory(self, uuid_string):
+        """Get cached inventory of the domain, or None if not loaded
+
+        :type uuid_string: String
+            :rtype : dict
+        """
+        inventory = self._get_inventories().get(self.pk)
+        if inventory is not None:
+            return inventory.get(uuid_string)
+
 
 class LibvirtL2NetworkDevice(L2NetworkDevice):
     """L2 network device based on libvirt Network
@@ -392,6 +1718,18 @@ class LibvirtL2NetworkDevice(L2NetworkDevice):
              l2_net_dev: openstack_br
              tag: 103
 
+       A device with 'replica_of' is a part of the named device on another
+       host, connected with it by 'parent_iface'. Addresses of its
+       interfaces are taken from the same address pool, but the gateway
+       and DHCP server are served only by the named device.
+
+         admin_host2:
+           replica_of: admin
+           address_pool: fuelweb_admin-pool01
+           parent_iface:
+             l2_net_dev: uplink_host2
+             tag: 1000
+
     Note: This class is imported as L2NetworkDevice at .__init__.py
     """
     uuid = ParamField()
@@ -415,6 +1753,7 @@ class LibvirtL2NetworkDevice(L2NetworkDevice):
         l2_net_dev=ParamField(default=None),
         tag=ParamField(default=None),
     )
+    replica_of = ParamField(default=None)
 
     @property
     def _libvirt_network(self):
@@ -428,6 +1767,16 @@ class LibvirtL2NetworkDevice(L2NetworkDevice):
     def bridge_name(self):
         return self._libvirt_network.bridgeName()
 
+    @property
+    def replicas(self):
+        """Get replicas of the device on other hosts
+
+        :rtype : list
+        """
+        return [l2_dev for l2_dev in
+                self.group.environment.get_env_l2_network_devices()
+                if l2_dev.params.get('replica_of') == self.name]
+
     @property
     def network_name(self):
         """Get network name
@@ -466,7 +1815,9 @@ class LibvirtL2NetworkDevice(L2NetworkDevice):
         dhcp_range_start = None
         dhcp_range_end = None
         addresses = []
-        if self.address_pool is not None:
+        # Replica is a plain bridge, IP of the network is on the host
+        # of the original device
+        if self.address_pool is not None and self.replica_of is None:
             # Reserved names 'l2_network_device' and 'dhcp'
             ip_network_address = self.address_pool.get_ip('l2_network_device')
 
@@ -479,15 +1830,10 @@ class LibvirtL2NetworkDevice(L2NetworkDevice):
             dhcp_range_start = self.address_pool.ip_range_start('dhcp')
             dhcp_range_end = self.address_pool.ip_range_end('dhcp')
 
-            for interface in self.interfaces:
-                for address in interface.addresses:
-                    ip_addr = netaddr.IPAddress(address.ip_address)
-                    if ip_addr in self.address_pool.ip_network:
-                        addresses.append(dict(
-                            mac=str(interface.mac_address),
-                            ip=str(address.ip_address),
-                            name=interface.node.name
-                        ))
+            interfaces = list(self.interfaces)
+            for replica in self.replicas:
+                interfaces.extend(replica.interfaces)
+            addresses = self._get_dhcp_hosts(interfaces)
 
         xml = LibvirtXMLBuilder.build_network_xml(
             network_name=self.network_name,
@@ -509,14 +1855,115 @@ class LibvirtL2NetworkDevice(L2NetworkDevice):
 
         super(LibvirtL2NetworkDevice, self).define()
 
+    def _get_dhcp_hosts(self, interfaces, names=None):
+        """Get DHCP host entries of the interfaces in the address pool
+
+        libvirt rejects host entries with the same name, so the node name
+        is given only to the first entry of a node, the other entries of
+        the node have no name.
+
+        :type interfaces: list
+        :param names: names used by other entries of the network, updated
+            with the names of the returned entries
+            :rtype : list of dicts with 'mac', 'ip' and optional 'name'
+        """
+        if names is None:
+            names = set()
+        hosts = []
+        for interface in interfaces:
+            for address in interface.addresses:
+                ip_addr = netaddr.IPAddress(address.ip_address)
+                if ip_addr in self.address_pool.ip_network:
+                    host = dict(
+                        mac=str(interface.mac_address),
+                        ip=str(address.ip_address),
+                    )
+                    if interface.node.name not in names:
+                        host['name'] = interface.node.name
+                        names.add(interface.node.name)
+                    hosts.append(host)
+        return hosts
+
+    @retry()
+    def update_dhcp_hosts(self, add=None, remove=None):
+        """Add and remove DHCP host entries of interfaces on the network
+
+        Entries are changed by network.update() in the persistent config
+        and, when the network is active, in the running network, so the
+        network and its guests are not restarted. Entries which already
+        exist are not added again, so the update can be repeated.
+        A node name is given to one entry of the node only, see
+        _get_dhcp_hosts(). Interfaces of a replica are served by the
+        original device.
+
+        :param add: interfaces to add entries for
+        :param remove: interfaces to remove entries of
+            :rtype : None
+        """
+        if self.replica_of is not None:
+            original = self.group.environment.get_env_l2_network_device(
+                name=self.replica_of)
+            original.update_dhcp_hosts(add=add, remove=remove)
+            return
+        if (not self.uuid or not self.has_dhcp_server or
+                self.address_pool is None):
+            return
+        network = self._libvirt_network
+        if network is None:
+            return
+
+        network_xml = ET.fromstring(network.XMLDesc(0))
+        entries = {host.get('mac').lower(): host
+                   for host in network_xml.findall('./ip/dhcp/host')
+                   if host.get('mac')}
+        names = {host.get('name')
+                 for host in network_xml.findall('./ip/dhcp/host')
+                 if host.get('name')}
+        flags = libvirt.VIR_NETWORK_UPDATE_AFFECT_CONFIG
+        if network.isActive():
+            flags |= libvirt.VIR_NETWORK_UPDATE_AFFECT_LIVE
+
+        for interface in remove or []:
+            entry = entries.pop(interface.mac_address.lower(), None)
+            if entry is None:
+                continue
+            logger.debug("Remove DHCP host {0} from network {1}".format(
+                interface.mac_address, self.network_name))
+            network.update(libvirt.VIR_NETWORK_UPDATE_COMMAND_DELETE,
+                           libvirt.VIR_NETWORK_SECTION_IP_DHCP_HOST,
+                           -1, ET.tostring(entry), flags)
+            names.discard(entry.get('name'))
+
+        add = [interface for interface in add or []
+               if interface.mac_address.lower() not in entries]
+        for host in self._get_dhcp_hosts(add, names=names):
+            if host['mac'].lower() in entries:
+                continue
+            logger.debug("Add DHCP host {0} ({1}) to network {2}".format(
+                host['mac'], host['ip'], self.network_name))
+            network.update(libvirt.VIR_NETWORK_UPDATE_COMMAND_ADD_LAST,
+                           libvirt.VIR_NETWORK_SECTION_IP_DHCP_HOST,
+                           -1, LibvirtXMLBuilder.build_dhcp_host_xml(**host),
+                           flags)
+            entries[host['mac'].lower()] = host
+
     def start(self):
         self.create()
 
     @retry()
     def create(self, *args, **kwargs):
+        """Start the network and connect it to its parent interface
+
+        Tagged interfaces of the bridge are started with the network. The
+        parent interface is added to the bridge by a command on the host
+        of the network, see LibvirtDriver.host_call().
+        """
         if not self.is_active():
             self._libvirt_network.create()
 
+        for vlanid in self.vlan_ifaces:
+            self.iface_create('{0}.{1}'.format(self.bridge_name(), vlanid))
+
         # Insert a specified interface into the network's bridge
         parent_name = ''
         if self.parent_iface.phys_dev is not None:
@@ -527,28 +1974,23 @@ class LibvirtL2NetworkDevice(L2NetworkDevice):
         elif self.parent_iface.l2_net_dev is not None:
             l2_net_dev = self.group.environment.get_env_l2_network_device(
                 name=self.parent_iface.l2_net_dev)
+            # The tagged interface exists while the parent is active
+            l2_net_dev.create()
             parent_name = l2_net_dev.bridge_name()
 
         # Add specified interface to the current bridge
-        if parent_name is not '':
+        if parent_name:
             if self.parent_iface.tag:
                 parent_iface_name = "{0}.{1}".format(
                     parent_name, str(self.parent_iface.tag))
             else:
                 parent_iface_name = parent_name
 
-            # TODO(ddmitriev): check if the parent_name link is UP
-            # before adding it to the bridge
-            cmd = 'sudo brctl addif {br} {iface}'.format(
-                br=self.bridge_name(), iface=parent_iface_name)
-
-            # TODO(ddmitriev): check that the parent_name is not included
-            # to any bridge before adding it to the current bridge instead
-            # of this try/except workaround
-            try:
-                subprocess.check_output(cmd.split())
-            except Exception:
-                pass
+            # 'ip link set' does not fail if the interface is already
+            # in the bridge
+            self.driver.host_call(
+                ['sudo', 'ip', 'link', 'set', 'dev', parent_iface_name,
+                 'up', 'master', self.bridge_name()])
 
     @retry()
     def destroy(self):
@@ -603,6 +2045,17 @@ class LibvirtL2NetworkDevice(L2NetworkDevice):
         self.driver.conn.interfaceDefineXML(
             LibvirtXMLBuilder.build_iface_xml(name, ip, prefix, vlanid))
 
+    @retry()
+    def iface_create(self, iface_name):
+        """Start interface of the host if it is not active
+
+        :type iface_name: String
+            :rtype : None
+        """
+        iface = self.driver.conn.interfaceLookupByName(iface_name)
+        if not iface.isActive():
+            iface.create(0)
+
     @retry()
     def iface_undefine(self, iface_name):
         """Start interface
@@ -614,8 +2067,14 @@ class LibvirtL2NetworkDevice(L2NetworkDevice):
             iface = self.driver.conn.interfaceLookupByName(iface_name)
         except libvirt.libvirtError:
             return None
+        if iface.isActive():
+            iface.destroy(0)
         iface.undefine()
 
+    @property
+    def nwfilter_name(self):
+        return self.network_name
+
     @property
     def _nwfilter(self):
         """Returns NWFilter object"""
@@ -626,28 +2085,37 @@ class LibvirtL2NetworkDevice(L2NetworkDevice):
                 self.network_name))
             return None
 
+    def build_filter_xml(self, uuid=None, blocked=False):
+        """Generate XML of the filter of the network
+
+        :type uuid: String
+        :type blocked: Boolean
+            :rtype : String
+        """
+        rule = None
+        if blocked:
+            rule = dict(action='drop',
+                        direction='inout',
+                        priority='-1000')
+        return LibvirtXMLBuilder.build_network_filter(
+            name=self.network_name,
+            uuid=uuid,
+            rule=rule)
+
     @property
     def is_blocked(self):
         """Returns state of network"""
-        filter_xml = ET.fromstring(self._nwfilter.XMLDesc())
-        return filter_xml.find('./rule') is not None
+        return is_nwfilter_blocking(self._nwfilter)
 
     def block(self):
         """Block all traffic in network"""
-        filter_xml = LibvirtXMLBuilder.build_network_filter(
-            name=self.network_name,
-            uuid=self._nwfilter.UUIDString(),
-            rule=dict(action='drop',
-                      direction='inout',
-                      priority='-1000'))
-        self.driver.conn.nwfilterDefineXML(filter_xml)
+        self.driver.conn.nwfilterDefineXML(self.build_filter_xml(
+            uuid=self._nwfilter.UUIDString(), blocked=True))
 
     def unblock(self):
         """Unblock all traffic in network"""
-        filter_xml = LibvirtXMLBuilder.build_network_filter(
-            name=self.network_name,
-            uuid=self._nwfilter.UUIDString())
-        self.driver.conn.nwfilterDefineXML(filter_xml)
+        self.driver.conn.nwfilterDefineXML(self.build_filter_xml(
+            uuid=self._nwfilter.UUIDString()))
 
 
 class LibvirtVolume(Volume):
@@ -657,6 +2125,16 @@ class LibvirtVolume(Volume):
     capacity = ParamField(default=None)
     format = ParamField(default='qcow2', choices=('qcow2', 'raw'))
     source_image = ParamField(default=None)
+    base_image = ParamField(default=None)
+    cache = ParamField(default='unsafe',
+                       choices=('default', 'none', 'writethrough',
+                                'writeback', 'directsync', 'unsafe'))
+    io = ParamField(default=None, choices=(None, 'native', 'threads'))
+    discard = ParamField(default=None, choices=(None, 'unmap', 'ignore'))
+    preallocation = ParamField(default=None, choices=(None, 'metadata'))
+    cluster_size = ParamField(default=None)
+    storage_pool = ParamField(default=None)
+    ephemeral = ParamField(default=False)
 
     @property
     def _libvirt_volume(self):
@@ -680,27 +2158,74 @@ class LibvirtVolume(Volume):
             backing_store_path = self.backing_store.get_path()
             backing_store_format = self.backing_store.format
 
-        if self.source_image is not None:
+        vol_format = self.format
+        with self._get_base_volume() as base_volume:
+            libvirt_volume = self._create_volume(
+                name, vol_format, base_volume,
+                backing_store_path, backing_store_format)
+        self.uuid = libvirt_volume.key()
+        if base_volume is not None:
+            self.base_image = base_volume.path()
+            self.format = 'qcow2'
+        super(LibvirtVolume, self).define()
+
+        # Upload predefined image to the volume
+        if self.source_image is not None and base_volume is None:
+            self.upload(self.source_image)
+
+    @contextmanager
+    def _get_base_volume(self):
+        if self.source_image is not None and self.driver.base_image_cache:
+            # Thin overlay over the shared copy of the source image, the
+            # copy stays locked until the overlay is created
+            with self.driver.base_image(
+                    self.source_image, self.format) as base_volume:
+                yield base_volume
+        elif self.base_image is not None:
+            # Thin overlay over existing volume, e.g. a disk of
+            # another environment
+            yield self.driver.conn.storageVolLookupByPath(self.base_image)
+        else:
+            yield None
+
+    def _create_volume(self, name, vol_format, base_volume,
+                       backing_store_path, backing_store_format):
+        if base_volume is not None:
+            backing_store_path = base_volume.path()
+            backing_store_format = self._get_libvirt_volume_format(
+                base_volume)
+            vol_format = 'qcow2'
+            capacity = base_volume.info()[1]
+            if self.capacity is not None:
+                capacity = max(capacity, int(self.capacity * 1024 ** 3))
+        elif self.source_image is not None:
             capacity = get_file_size(self.source_image)
         else:
             capacity = int(self.capacity * 1024 ** 3)
 
-        pool_name = self.driver.storage_pool_name
+        pool_name = self.driver.select_storage_pool(self, capacity)
         pool = self.driver.conn.storagePoolLookupByName(pool_name)
+        if pool_name == self.driver.ephemeral_pool_name:
+            # tmpfs doesn't support O_DIRECT
+            if self.cache in ('none', 'directsync'):
+                self.cache = 'writeback'
+            if self.io == 'native':
+                self.io = None
         xml = LibvirtXMLBuilder.build_volume_xml(
             name=name,
             capacity=capacity,
-            vol_format=self.format,
+            vol_format=vol_format,
             backing_store_path=backing_store_path,
             backing_store_format=backing_store_format,
+            cluster_size=self.cluster_size,
         )
-        libvirt_volume = pool.createXML(xml, 0)
-        self.uuid = libvirt_volume.key()
-        super(LibvirtVolume, self).define()
-
-        # Upload predefined image to the volume
-        if self.source_image is not None:
-            self.upload(self.source_image)
+        flags = 0
+        # Metadata can't be preallocated for overlays
+        if (self.preallocation == 'metadata' and vol_format == 'qcow2' and
+                backing_store_path is None):
+            flags |= libvirt.VIR_STORAGE_VOL_CREATE_PREALLOC_METADATA
+        self.storage_pool = pool_name
+        return pool.createXML(xml, flags)
 
     @retry()
     def remove(self, *args, **kwargs):
@@ -708,37 +2233,88 @@ class LibvirtVolume(Volume):
             if self.exists():
                 self._libvirt_volume.delete(0)
         super(LibvirtVolume, self).remove()
+        if self.storage_pool == self.driver.ephemeral_pool_name:
+            self.driver.release_ephemeral_storage_pool()
 
     @retry()
     def get_capacity(self):
         """Get volume capacity"""
         return self._libvirt_volume.info()[1]
 
+    def get_required_space(self):
+        """Get space in the storage pool required by the volume
+
+        Copies of source images are written at define, other volumes are
+        sparse or thin overlays which grow up to their capacity.
+
+        :rtype : tuple of bytes written at define and maximum size
+        """
+        capacity = int((self.capacity or 0) * 1024 ** 3)
+        if self.source_image is None:
+            return 0, capacity
+        size = get_file_size(self.source_image)
+        if self.driver.base_image_cache:
+            return 0, max(size, capacity)
+        return size, size
+
+    @staticmethod
+    def _get_libvirt_volume_format(libvirt_volume):
+        xml_desc = ET.fromstring(libvirt_volume.XMLDesc(0))
+        return xml_desc.find('target/format[@type]').get('type')
+
     @retry()
     def get_format(self):
-        xml_desc = ET.fromstring(self._libvirt_volume.XMLDesc(0))
-        return xml_desc.find('target/format[@type]').get('type')
+        return self._get_libvirt_volume_format(self._libvirt_volume)
 
     @retry()
     def get_path(self):
         return self._libvirt_volume.path()
 
+    def get_backing_chain(self):
+        """Get the volume and all its backing volumes, the volume first
+
+        :rtype : list
+        """
+        chain = [self]
+        while chain[-1].backing_store is not None:
+            chain.append(chain[-1].backing_store)
+        return chain
+
     def fill_from_exist(self):
         self.capacity = self.get_capacity()
         self.format = self.get_format()
 
-    @retry(count=2)
     def upload(self, path):
-        def chunk_render(_, _size, _fd):
-            return _fd.read(_size)
-        size = get_file_size(path)
-        with open(path, 'rb') as fd:
-            stream = self.driver.conn.newStream(0)
-            self._libvirt_volume.upload(
-                stream=stream, offset=0,
-                length=size, flags=0)
-            stream.sendAll(chunk_render, fd)
-            stream.finish()
+        self.driver.volume_upload(self._libvirt_volume, path)
+
+    def recreate_as_overlay(self, base_path):
+        """Replace volume content with a qcow2 overlay over base_path
+
+        Name and path of the volume are kept, so the domain which uses
+        the volume doesn't need to be redefined.
+
+        :type base_path: str
+        """
+        base = self.driver.conn.storageVolLookupByPath(base_path)
+        base_format = self._get_libvirt_volume_format(base)
+        volume = self._libvirt_volume
+        pool = volume.storagePoolLookupByVolume()
+        name = volume.name()
+        capacity = max(volume.info()[1], base.info()[1])
+        volume.delete(0)
+
+        xml = LibvirtXMLBuilder.build_volume_xml(
+            name=name,
+            capacity=capacity,
+            vol_format='qcow2',
+            backing_store_path=base_path,
+            backing_store_format=base_format,
+            cluster_size=self.cluster_size,
+        )
+        self.uuid = pool.createXML(xml, 0).key()
+        self.format = 'qcow2'
+        self.base_image = base_path
+        self.save()
 
     @retry()
     def get_allocation(self):
@@ -775,6 +2351,13 @@ class LibvirtVolume(Volume):
             node=self.node,
             format=self.format,
             backing_store=self,
+            cache=self.cache,
+            io=self.io,
+            discard=self.discard,
+            preallocation=self.preallocation,
+            cluster_size=self.cluster_size,
+            storage_pool=self.storage_pool,
+            ephemeral=self.ephemeral,
         )
 
     # TO REWRITE, LEGACY, for fuel-qa compatibility
@@ -807,6 +2390,18 @@ class LibvirtNode(Node):
     has_vnc = ParamField(default=True)
     bootmenu_timeout = ParamField(default=0)
     numa = ParamField(default=[])
+    iothreads = ParamField(default=0)
+    placement = ParamField(default=[])
+    snapshot_stats = ParamField(default={})
+    kernel_boot = ParamMultiField(
+        enabled=ParamField(default=False),
+        kernel=ParamField(default='/isolinux/vmlinuz'),
+        initrd=ParamField(default='/isolinux/initrd.img'),
+    )
+
+    _flatten_suffix = '.flatten-'
+    # State of the defined domain, not copied by Environment.clone()
+    instance_params = ('uuid', 'placement', 'snapshot_stats')
 
     @property
     def _libvirt_node(self):
@@ -822,6 +2417,9 @@ class LibvirtNode(Node):
 
             :rtype : String
         """
+        inventory = self.driver.get_inventory(self.uuid)
+        if inventory is not None and 'vnc_port' in inventory:
+            return inventory['vnc_port']
         xml_desc = ET.fromstring(
             self._libvirt_node.XMLDesc(0))
         vnc_element = xml_desc.find('devices/graphics[@type="vnc"][@port]')
@@ -853,6 +2451,9 @@ class LibvirtNode(Node):
 
             :rtype : Boolean
         """
+        inventory = self.driver.get_inventory(self.uuid)
+        if inventory is not None:
+            return inventory['active']
         return self._libvirt_node.isActive()
 
     @retry()
@@ -862,13 +2463,18 @@ class LibvirtNode(Node):
         :type keys: String
             :rtype : None
         """
-        key_codes = scancodes.from_string(str(keys))
+        domain = self._libvirt_node
+        key_codes = scancodes.to_batches(
+            scancodes.from_string(str(keys)),
+            max_keys=self.driver.keys_batch_size)
         for key_code in key_codes:
             if isinstance(key_code[0], str):
                 if key_code[0] == 'wait':
-                    sleep(1)
+                    sleep(key_code[1] if len(key_code) > 1
+                          else self.driver.keys_wait_time)
                 continue
-            self._libvirt_node.sendKey(0, 0, list(key_code), len(key_code), 0)
+            domain.sendKey(0, self.driver.keys_hold_time, list(key_code),
+                           len(key_code), 0)
 
     @retry()
     def define(self):
@@ -882,7 +2488,13 @@ class LibvirtNode(Node):
         )
 
         local_disk_devices = []
+        iothread = 0
         for disk in self.disk_devices:
+            disk_iothread = None
+            # Only virtio disks can be served by dedicated I/O threads
+            if self.iothreads and disk.bus == 'virtio':
+                disk_iothread = iothread % self.iothreads + 1
+                iothread += 1
             local_disk_devices.append(dict(
                 disk_type=disk.type,
                 disk_device=disk.device,
@@ -891,6 +2503,10 @@ class LibvirtNode(Node):
                 disk_bus=disk.bus,
                 disk_target_dev=disk.target_dev,
                 disk_serial=uuid.uuid4().hex,
+                disk_cache=disk.volume.cache,
+                disk_io=disk.volume.io,
+                disk_discard=disk.volume.discard,
+                disk_iothread=disk_iothread,
             ))
 
         local_interfaces = []
@@ -914,37 +2530,52 @@ class LibvirtNode(Node):
                 interface_target_dev=target_dev,
                 interface_model=interface.model,
                 interface_filter=filter_name,
+                interface_driver=interface.get_driver_attrs(),
             ))
 
         emulator = self.driver.get_capabilities().find(
             'guest/arch[@name="{0:>s}"]/'
             'domain[@type="{1:>s}"]/emulator'.format(
                 self.architecture, self.hypervisor)).text
-        node_xml = LibvirtXMLBuilder.build_node_xml(
-            name=name,
-            hypervisor=self.hypervisor,
-            use_host_cpu=self.driver.use_host_cpu,
-            vcpu=self.vcpu,
-            memory=self.memory,
-            use_hugepages=self.driver.use_hugepages,
-            hpet=self.driver.hpet,
-            os_type=self.os_type,
-            architecture=self.architecture,
-            boot=self.boot,
-            reboot_timeout=self.driver.reboot_timeout,
-            bootmenu_timeout=self.bootmenu_timeout,
-            emulator=emulator,
-            has_vnc=self.has_vnc,
-            vnc_password=self.driver.vnc_password,
-            local_disk_devices=local_disk_devices,
-            interfaces=local_interfaces,
-            acpi=self.driver.enable_acpi,
-            numa=self.numa,
-        )
-        logger.debug(node_xml)
-        self.uuid = self.driver.conn.defineXML(node_xml).UUIDString()
+
+        # CPUs are pinned by the domain definition, so another node can
+        # not be placed on the same CPUs until this one is defined
+        with self.driver.placement_lock():
+            placement = []
+            if self.driver.cpu_pinning:
+                placement = self.driver.plan_node_placement(self)
+            node_xml = LibvirtXMLBuilder.build_node_xml(
+                name=name,
+                hypervisor=self.hypervisor,
+                use_host_cpu=self.driver.use_host_cpu,
+                vcpu=self.vcpu,
+                memory=self.memory,
+                use_hugepages=self.driver.use_hugepages,
+                hpet=self.driver.hpet,
+                os_type=self.os_type,
+                architecture=self.architecture,
+                boot=self.boot,
+                reboot_timeout=self.driver.reboot_timeout,
+                bootmenu_timeout=self.bootmenu_timeout,
+                emulator=emulator,
+                has_vnc=self.has_vnc,
+                vnc_password=self.driver.vnc_password,
+                local_disk_devices=local_disk_devices,
+                interfaces=local_interfaces,
+                acpi=self.driver.enable_acpi,
+                numa=self.numa,
+                iothreads=self.iothreads,
+                placement=placement,
+                hugepage_size=self.driver.hugepage_size,
+                # The domain keeps its UUID when it is redefined
+                uuid=self.uuid,
+            )
+            logger.debug(node_xml)
+            self.uuid = self.driver.conn.defineXML(node_xml).UUIDString()
+        self.placement = placement
 
         super(LibvirtNode, self).define()
+        self.update_dhcp_hosts()
 
     def start(self):
         self.create()
@@ -959,9 +2590,31 @@ class LibvirtNode(Node):
         if self.is_active():
             self._libvirt_node.destroy()
 
+    def update_dhcp_hosts(self, remove=False):
+        """Add or remove DHCP host entries of the node interfaces
+
+        Interfaces are grouped by network, so every network is queried
+        once for the node.
+
+        :param remove: remove entries instead of adding them
+        """
+        by_device = {}
+        for interface in self.interfaces:
+            l2_dev = interface.l2_network_device
+            if l2_dev is None or l2_dev.address_pool is None:
+                continue
+            by_device.setdefault(l2_dev.pk, (l2_dev, []))[1].append(
+                interface)
+        for l2_dev, interfaces in by_device.values():
+            if remove:
+                l2_dev.update_dhcp_hosts(remove=interfaces)
+            else:
+                l2_dev.update_dhcp_hosts(add=interfaces)
+
     @retry()
     def remove(self, *args, **kwargs):
         if self.uuid:
+            self.update_dhcp_hosts(remove=True)
             if self.exists():
                 self.destroy()
 
@@ -988,12 +2641,29 @@ class LibvirtNode(Node):
                 domain.resume()
 
     @retry()
-    def reboot(self):
+    def _reboot(self):
+        self._libvirt_node.reboot()
+
+    def reboot(self, timeout=None):
         """Reboot node
 
+        If timeout is set and domain events are available, wait for the
+        reboot event of the domain.
+
+        :type timeout: int
             :rtype : None
         """
-        self._libvirt_node.reboot()
+        watcher = self.driver.event_watcher
+        if not timeout or watcher is None:
+            self._reboot()
+            return
+        reboots = watcher.get_reboots(self.uuid)
+        self._reboot()
+        if not watcher.wait(self.uuid,
+                            lambda: watcher.get_reboots(self.uuid) > reboots,
+                            timeout):
+            raise TimeoutError(
+                'Node {0} has not rebooted'.format(self.name))
 
     @retry()
     def shutdown(self):
@@ -1007,10 +2677,294 @@ class LibvirtNode(Node):
     def reset(self):
         self._libvirt_node.reset()
 
+    _states = {
+        libvirt.VIR_DOMAIN_NOSTATE: 'running',
+        libvirt.VIR_DOMAIN_RUNNING: 'running',
+        libvirt.VIR_DOMAIN_BLOCKED: 'running',
+        libvirt.VIR_DOMAIN_SHUTDOWN: 'running',
+        libvirt.VIR_DOMAIN_PAUSED: 'paused',
+        libvirt.VIR_DOMAIN_PMSUSPENDED: 'paused',
+        libvirt.VIR_DOMAIN_SHUTOFF: 'shutoff',
+        libvirt.VIR_DOMAIN_CRASHED: 'shutoff',
+    }
+
+    @retry()
+    def get_state(self):
+        """Get power state of node: 'running', 'paused' or 'shutoff'
+
+            :rtype : str
+        """
+        return self._states.get(self._libvirt_node.state()[0], 'running')
+
+    def wait_for_state(self, state, timeout=60):
+        """Wait until node reaches the power state
+
+        The state is checked only when a lifecycle event of the domain is
+        received. Polling is used if domain events are not available.
+
+        :type state: str
+        :type timeout: int
+        """
+        watcher = self.driver.event_watcher
+        if watcher is None:
+            return super(LibvirtNode, self).wait_for_state(state, timeout)
+        if not watcher.wait(self.uuid, lambda: self.get_state() == state,
+                            timeout):
+            raise TimeoutError('Node {0} has not reached state {1!r}'.format(
+                self.name, state))
+
     @retry()
     def has_snapshot(self, name):
+        inventory = self.driver.get_inventory(self.uuid)
+        if inventory is not None and 'snapshots' in inventory:
+            return name in inventory['snapshots']
         return name in self._libvirt_node.snapshotListNames()
 
+    def _start_setup(self):
+        if self.driver.golden_image_cache and self.golden_image_restore():
+            return
+        if self.kernel_boot.enabled:
+            self._start_kernel_boot()
+            return
+        super(LibvirtNode, self)._start_setup()
+
+    def get_kernel_boot_cmdline(self):
+        """Get kernel command line from the keys of kernel_cmd
+
+        Key tokens like <Wait> and everything typed before the kernel
+        name at the bootloader prompt are dropped, initrd is passed
+        separately.
+
+        :rtype : str
+        """
+        keys = self.format_kernel_cmd(self.kernel_cmd)
+        words = re.sub(r'<[^>]*>', '', keys).replace('\n', '').split()
+        kernel_name = os.path.basename(self.kernel_boot.kernel)
+        if kernel_name in words:
+            words = words[words.index(kernel_name) + 1:]
+        return ' '.join(word for word in words
+                        if not word.startswith('initrd='))
+
+    def _get_boot_iso(self):
+        for disk in self.disk_devices:
+            if disk.device == 'cdrom' and disk.volume.source_image:
+                return disk.volume.source_image
+        raise DevopsError(
+            'Node {0} has no cdrom with source_image for kernel boot'
+            ''.format(self.name))
+
+    @retry()
+    def _set_kernel_boot(self, kernel=None, initrd=None, cmdline=None):
+        """Set or remove direct kernel boot in the persistent domain XML
+
+        The installer reboots the node when it is done, so the domain is
+        stopped on reboot while the kernel is set.
+        """
+        xml_domain = ET.fromstring(self._libvirt_node.XMLDesc(
+            libvirt.VIR_DOMAIN_XML_INACTIVE))
+        xml_os = xml_domain.find('os')
+        for tag in ('kernel', 'initrd', 'cmdline'):
+            for element in xml_os.findall(tag):
+                xml_os.remove(element)
+        for element in xml_domain.findall('on_reboot'):
+            xml_domain.remove(element)
+        if kernel:
+            for tag, value in (('kernel', kernel),
+                               ('initrd', initrd),
+                               ('cmdline', cmdline)):
+                ET.SubElement(xml_os, tag).text = value
+            ET.SubElement(xml_domain, 'on_reboot').text = 'destroy'
+        self.driver.conn.defineXML(ET.tostring(xml_domain))
+
+    def _start_kernel_boot(self):
+        if self.kernel_cmd is None:
+            raise DevopsError('kernel_cmd is None')
+
+        kernel, initrd = self.driver.get_kernel_boot_files(
+            self._get_boot_iso(),
+            [self.kernel_boot.kernel, self.kernel_boot.initrd])
+        self._set_kernel_boot(kernel, initrd, self.get_kernel_boot_cmdline())
+        try:
+            self.start()
+        finally:
+            # Running domain keeps the kernel until it is stopped
+            self._set_kernel_boot()
+
+        self.wait_for_state('shutoff', timeout=self.bootstrap_timeout)
+        self.start()
+
+    def deploy_wait(self):
+        super(LibvirtNode, self).deploy_wait()
+        if self.driver.golden_image_cache:
+            self.golden_image_save()
+
+    @property
+    def golden_image_key(self):
+        """Key of the golden image for the node
+
+        Includes everything that affects the installed system: checksums
+        of the source images, rendered kernel command line (so addresses
+        of the admin network) and hardware of the node.
+
+        :rtype : str
+        """
+        images = sorted(vol.source_image for vol in self.get_volumes()
+                        if vol.source_image is not None)
+        key_data = dict(
+            images=[get_file_checksum(path) for path in images],
+            kernel_cmd=self.format_kernel_cmd(self.kernel_cmd or ''),
+            role=self.role,
+            vcpu=self.vcpu,
+            memory=self.memory,
+            disks=[(disk.target_dev, disk.device, disk.bus,
+                    disk.volume.name, disk.volume.capacity)
+                   for disk in self.disk_devices.order_by('target_dev')],
+            interfaces=[(iface.label, iface.model,
+                         deepgetattr(iface, 'l2_network_device.name'))
+                        for iface in self.interfaces],
+        )
+        return hashlib.sha256(
+            json.dumps(key_data, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get_golden_image(self, key=None):
+        """Get metadata of the golden image for the node
+
+        :param key: key of the image, golden_image_key if None
+            :rtype : dict or None
+        """
+        meta_path = self.driver.golden_image_meta_path(
+            key or self.golden_image_key)
+        if not os.path.isfile(meta_path):
+            return None
+        with open(meta_path) as meta_file:
+            return json.load(meta_file)
+
+    def golden_image_save(self):
+        """Store disks of the node as a golden image
+
+        The node is shut down to copy the disks. Memory state is not
+        stored: it can be restored only into the domain with the same
+        UUID, not into a node of another environment.
+        """
+        key = self.golden_image_key
+        meta_path = self.driver.golden_image_meta_path(key)
+
+        with file_lock(meta_path + '.lock'):
+            if os.path.isfile(meta_path):
+                return
+            logger.info('Save golden image {0} of {1}'.format(key, self.name))
+
+            self._golden_image_stop()
+
+            pool = self.driver.conn.storagePoolLookupByName(
+                self.driver.storage_pool_name)
+            volumes = {}
+            for disk in self.disk_devices:
+                if disk.device != 'disk':
+                    continue
+                source = disk.volume._libvirt_volume
+                xml = LibvirtXMLBuilder.build_volume_xml(
+                    name='{0}{1}_{2}'.format(self.driver.golden_image_prefix,
+                                             key, disk.target_dev),
+                    capacity=source.info()[1],
+                    vol_format='qcow2',
+                    backing_store_path=None,
+                    backing_store_format=None,
+                )
+                # Full copy, the backing chain of the source is flattened
+                volumes[disk.target_dev] = pool.createXMLFrom(
+                    xml, source, 0).path()
+
+            meta = dict(
+                volumes=volumes,
+                macs=[iface.mac_address for iface in self.interfaces],
+                created=datetime.datetime.utcnow().isoformat(),
+            )
+            with open(meta_path + '.tmp', 'w') as meta_file:
+                json.dump(meta, meta_file)
+            os.rename(meta_path + '.tmp', meta_path)
+
+        self.start()
+        super(LibvirtNode, self).deploy_wait()
+
+    def _golden_image_stop(self):
+        """Stop the node with consistent disks
+
+        Without ACPI the guest ignores the shutdown request, so its
+        filesystems are synced over SSH and the domain is destroyed.
+        """
+        if self.driver.enable_acpi:
+            self.shutdown()
+            self.wait_for_state('shutoff', timeout=600)
+            return
+        with self.remote(settings.SSH_CREDENTIALS['admin_network'],
+                         login=settings.SSH_CREDENTIALS['login'],
+                         password=settings.SSH_CREDENTIALS['password']
+                         ) as remote:
+            remote.check_call('sync')
+        self.destroy()
+
+    def _golden_image_adopt_macs(self, macs):
+        """Use MAC addresses of the golden image node
+
+        Network configuration of the installed system can be bound
+        to MAC addresses, so the domain is redefined with them.
+        """
+        interfaces = list(self.interfaces)
+        if [iface.mac_address for iface in interfaces] == macs:
+            return True
+        if len(interfaces) != len(macs):
+            return False
+        iface_cls = self.driver.get_model_class('Interface')
+        if iface_cls.objects.filter(mac_address__in=macs).exists():
+            logger.warning('MAC addresses of the golden image are used by '
+                           'another node')
+            return False
+
+        # Entries of the new addresses are added by define()
+        self.update_dhcp_hosts(remove=True)
+        for iface, mac in zip(interfaces, macs):
+            nwfilter = iface._nwfilter
+            if nwfilter:
+                nwfilter.undefine()
+            iface.mac_address = mac
+            iface.save()
+        self._libvirt_node.undefineFlags(
+            libvirt.VIR_DOMAIN_UNDEFINE_SNAPSHOTS_METADATA)
+        self.define()
+        return True
+
+    def golden_image_restore(self):
+        """Start the node from the golden image, if it exists
+
+        :rtype : bool
+        """
+        if self.kernel_cmd is None:
+            return False
+        key = self.golden_image_key
+        if self.get_golden_image(key) is None:
+            return False
+
+        # The image can't be removed by cleanup_golden_images() until
+        # the overlays are created
+        with file_lock(self.driver.golden_image_meta_path(key) + '.lock'):
+            meta = self.get_golden_image(key)
+            if meta is None:
+                return False
+            if not self._golden_image_adopt_macs(meta['macs']):
+                logger.info('Golden image for {0} is not used'.format(
+                    self.name))
+                return False
+
+            logger.info('Start {0} from golden image'.format(self.name))
+            for disk in self.disk_devices:
+                if disk.target_dev in meta['volumes']:
+                    disk.volume.recreate_as_overlay(
+                        meta['volumes'][disk.target_dev])
+
+        self.start()
+        return True
+
     # EXTERNAL SNAPSHOT
     def snapshot_create_child_volumes(self, name):
         for disk in self.disk_devices:
@@ -1084,6 +3038,7 @@ class LibvirtNode(Node):
         # Check that existing snapshot has the same type
         self._assert_snapshot_type(external=external)
 
+        started = datetime.datetime.utcnow()
         local_disk_devices = []
         if external:
             # EXTERNAL SNAPSHOTS
@@ -1151,6 +3106,54 @@ class LibvirtNode(Node):
             self.set_snapshot_current(name)
 
         logger.debug(domain.state(0))
+        self._save_snapshot_stats(name, started, memory_file)
+
+    def _save_snapshot_stats(self, name, started, memory_file):
+        """Record duration of the snapshot and size of its memory file"""
+        stats = dict(
+            duration=round(
+                (datetime.datetime.utcnow() - started).total_seconds(), 3),
+            memory_size=None,
+            memory_format=None,
+        )
+        # Memory file is local only if libvirtd runs on this host
+        if memory_file and os.path.isfile(memory_file):
+            stats['memory_size'] = os.path.getsize(memory_file)
+            stats['memory_format'] = get_save_image_format(memory_file)
+            expected = self.driver.snapshot_memory_compression
+            if expected and stats['memory_format'] not in (None, expected):
+                logger.warning(
+                    "Memory of snapshot {0} of {1} is saved as '{2}' "
+                    "instead of '{3}', set snapshot_image_format in "
+                    "qemu.conf of the host".format(
+                        name, self.name, stats['memory_format'], expected))
+            if self.driver.snapshot_memory_bypass_cache:
+                self._drop_page_cache(memory_file)
+        logger.info('Snapshot {0} of {1} is created in {2} s'.format(
+            name, self.name, stats['duration']))
+
+        if name is None:
+            return
+        snapshot_stats = dict(self.snapshot_stats)
+        snapshot_stats[name] = stats
+        self.snapshot_stats = snapshot_stats
+        self.save()
+
+    @staticmethod
+    def _drop_page_cache(path):
+        """Remove pages of the file from the page cache of the host"""
+        # posix_fadvise is available since python 3.3
+        if not hasattr(os, 'posix_fadvise'):
+            return
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logger.debug('Cannot drop {0} from the page cache: {1}'.format(
+                path, e))
 
     # EXTERNAL SNAPSHOT
     @staticmethod
@@ -1165,7 +3168,7 @@ class LibvirtNode(Node):
         return snapshot.delete_snapshot_files()
 
     # EXTERNAL SNAPSHOT
-    def _redefine_external_snapshot(self, name=None):
+    def _redefine_external_snapshot(self, name=None, resume=None):
         snapshot = self._get_snapshot(name)
 
         logger.info("Revert {0} ({1}) from external snapshot {2}".format(
@@ -1195,10 +3198,16 @@ class LibvirtNode(Node):
             # Redefine domain for snapshot without memory save
             self.driver.conn.defineXML(ET.tostring(xml_domain))
         else:
+            if resume:
+                flags = libvirt.VIR_DOMAIN_SAVE_RUNNING
+            else:
+                flags = libvirt.VIR_DOMAIN_SAVE_PAUSED
+            if self.driver.snapshot_memory_bypass_cache:
+                flags |= libvirt.VIR_DOMAIN_SAVE_BYPASS_CACHE
             self.driver.conn.restoreFlags(
                 snapshot.memory_file,
                 dxml=ET.tostring(xml_domain),
-                flags=libvirt.VIR_DOMAIN_SAVE_PAUSED)
+                flags=flags)
 
         # set snapshot as current
         self.set_snapshot_current(name)
@@ -1240,7 +3249,7 @@ class LibvirtNode(Node):
                 volume.delete()
                 volume_pool.createXML(volume_xml)
 
-    def _revert_external_snapshot(self, name=None):
+    def _revert_external_snapshot(self, name=None, resume=None):
         snapshot = self._get_snapshot(name)
         self.destroy()
         if snapshot.children_num == 0:
@@ -1254,7 +3263,7 @@ class LibvirtNode(Node):
 
             # Revert snapshot
             # self.driver.node_revert_snapshot(node=self, name=name)
-            self._redefine_external_snapshot(name=name)
+            self._redefine_external_snapshot(name=name, resume=resume)
         else:
             # Looking for last reverted snapshot without children
             # or create new and start next snapshot chain
@@ -1278,7 +3287,8 @@ class LibvirtNode(Node):
                     # Revert snapshot
                     # self.driver.node_revert_snapshot(
                     #    node=self, name=revert_name)
-                    self._redefine_external_snapshot(name=revert_name)
+                    self._redefine_external_snapshot(name=revert_name,
+                                                     resume=resume)
                     create_new = False
                     break
                 else:
@@ -1297,9 +3307,11 @@ class LibvirtNode(Node):
 
                 # Create new snapshot
                 self.snapshot(name=revert_name, external=True)
+                if resume:
+                    self.resume()
 
     @retry()
-    def revert(self, name=None, destroy=True):
+    def revert(self, name=None, destroy=False, resume=None):
         """Method to revert node in state from snapshot
 
            For external snapshots in libvirt we use restore function.
@@ -1310,6 +3322,15 @@ class LibvirtNode(Node):
            In case of usage external snapshots we clean snapshot disk when
            revert to snapshot without childs and create new snapshot point
            when reverting to snapshots with childs.
+
+           Internal snapshots are reverted by a single call which stops
+           the running domain itself, so destroying it first is not
+           required.
+
+        :param destroy: destroy the node before reverting
+        :param resume: True to leave the node running, False to leave
+            it paused, None to keep the state of the snapshot. Snapshots
+            of a shutoff node are not affected.
         """
         if destroy:
             self.destroy()
@@ -1318,12 +3339,21 @@ class LibvirtNode(Node):
 
             if snapshot.get_type == 'external':
                 # EXTERNAL SNAPSHOT
-                self._revert_external_snapshot(name)
+                volumes = [disk.volume for disk in self.disk_devices
+                           if disk.device == 'disk']
+                self._revert_external_snapshot(name, resume=resume)
+                self._remove_unused_volumes(volumes)
             else:
                 # ORIGINAL SNAPSHOT
                 logger.info("Revert {0} ({1}) to internal snapshot {2}".format(
                     self.name, snapshot.state, name))
-                self._libvirt_node.revertToSnapshot(snapshot._snapshot, 0)
+                flags = 0
+                if snapshot.state != 'shutoff' and resume is not None:
+                    if resume:
+                        flags = libvirt.VIR_DOMAIN_SNAPSHOT_REVERT_RUNNING
+                    else:
+                        flags = libvirt.VIR_DOMAIN_SNAPSHOT_REVERT_PAUSED
+                self._libvirt_node.revertToSnapshot(snapshot._snapshot, flags)
 
         else:
             raise DevopsError(
@@ -1331,14 +3361,171 @@ class LibvirtNode(Node):
                 'snapshot with matching'
                 ' name {1}'.format(self.name, name))
 
-        # unblock all interfaces
-        for iface in self.interfaces:
-            if iface.is_blocked:
-                logger.info("Interface({}) in {} network has "
-                            "been unblocked".format(
-                                iface.mac_address,
-                                iface.l2_network_device.name))
-                iface.unblock()
+        self.unblock_interfaces()
+
+    def _remove_unused_volumes(self, volumes):
+        """Remove overlays of flatten() which are not used after revert
+
+        Disks usually use volumes of snapshots, which are kept. Overlays
+        created by flatten() don't belong to any snapshot, so the state
+        left in them is dropped by revert like the state of the domain.
+
+        :type volumes: list
+        """
+        used = set(disk.volume_id for disk in self.disk_devices)
+        volumes = [volume for volume in volumes
+                   if volume.pk not in used and
+                   self._flatten_suffix in volume.name]
+        if not volumes:
+            return
+        snapshot_paths = set()
+        for snapshot in self.get_snapshots():
+            snapshot_paths.update(snapshot.disks.values())
+        volume_cls = self.driver.get_model_class('Volume')
+        for volume in volumes:
+            if (volume.uuid in snapshot_paths or
+                    volume_cls.objects.filter(backing_store=volume).exists()):
+                continue
+            logger.info('Remove unused volume {0} of {1}'.format(
+                volume.name, self.name))
+            volume.remove()
+
+    def unblock_interfaces(self):
+        """Unblock all blocked interfaces of the node
+
+        Filters of the interfaces are taken by one query of all filters
+        instead of a lookup for every interface.
+        """
+        self.driver.update_filters(unblock=self.interfaces)
+
+    def get_snapshot_volumes(self, name=None):
+        """Get paths of the volumes with disks state of the snapshot
+
+        Disks of the node are switched to new volumes when an external
+        snapshot is created, so the state of the snapshot is kept
+        unchanged in their backing stores.
+
+        :type name: String
+            :rtype : dict
+        """
+        snapshot = self._get_snapshot(name)
+        if snapshot.get_type != 'external':
+            raise DevopsError(
+                'Snapshot {0} of {1} is internal, only external snapshots '
+                'can be used as a backing store'.format(
+                    snapshot.name, self.name))
+        volumes = {}
+        for target_dev, path in snapshot.disks.items():
+            volume = self.get_volume(uuid=path)
+            volumes[target_dev] = volume.backing_store.get_path()
+        return volumes
+
+    def get_chain_depth(self, name=None):
+        """Get number of backing volumes of the deepest disk
+
+        :param name: snapshot name, current disks are used if None
+            :rtype : int
+        """
+        if name is None:
+            volumes = [disk.volume for disk in self.disk_devices
+                       if disk.device == 'disk']
+        else:
+            volumes = [self.get_volume(uuid=path) for path in
+                       self._get_snapshot(name).disks.values()]
+        return max([len(volume.get_backing_chain()) - 1
+                    for volume in volumes] or [0])
+
+    def flatten(self, max_depth=None, timeout=3600):
+        """Collapse backing chains of disks deeper than max_depth
+
+        Data of the upper part of the chain is copied into the current
+        volume of the disk by block pull, then the volume is backed by
+        the volume at depth max_depth - 1, so reads walk at most
+        max_depth backing volumes. Volumes of snapshots are never
+        changed: a disk which still uses a volume of a snapshot is
+        switched to a new overlay first, like on snapshot creation but
+        without snapshot metadata, revert() removes the overlay unless
+        a later snapshot is based on it. Block pull needs a running
+        domain, so a stopped node is started paused until the pull is
+        done.
+
+        :param max_depth: settings.SNAPSHOTS_MAX_CHAIN_DEPTH if None
+        :type timeout: int
+            :rtype : list of target devices of flattened disks
+        """
+        if max_depth is None:
+            max_depth = settings.SNAPSHOTS_MAX_CHAIN_DEPTH
+        disks = [disk for disk in self.disk_devices
+                 if disk.device == 'disk' and
+                 len(disk.volume.get_backing_chain()) - 1 > max_depth]
+        if not disks:
+            return []
+
+        domain = self._libvirt_node
+        started = False
+        if not self.is_active():
+            domain.createWithFlags(libvirt.VIR_DOMAIN_START_PAUSED)
+            started = True
+        try:
+            self._flatten_disks(disks, max_depth, timeout)
+        finally:
+            if started:
+                domain.destroy()
+        return [disk.target_dev for disk in disks]
+
+    def _flatten_disks(self, disks, max_depth, timeout):
+        domain = self._libvirt_node
+        snapshot_paths = set()
+        for snapshot in self.get_snapshots():
+            snapshot_paths.update(snapshot.disks.values())
+
+        overlays = []
+        suffix = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
+        for disk in disks:
+            if disk.volume.get_path() in snapshot_paths:
+                chain = disk.volume.get_backing_chain()
+                overlay = disk.volume.create_child(name='{0}{1}{2}'.format(
+                    chain[-1].name, self._flatten_suffix, suffix))
+                overlay.define()
+                overlays.append((disk, overlay))
+        if overlays:
+            xml = LibvirtXMLBuilder.build_snapshot_xml(
+                external=True,
+                disk_only=True,
+                domain_isactive=True,
+                local_disk_devices=[dict(
+                    disk_volume_path=overlay.get_path(),
+                    disk_target_dev=disk.target_dev,
+                ) for disk, overlay in overlays])
+            domain.snapshotCreateXML(
+                xml,
+                libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY |
+                libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_REUSE_EXT |
+                libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA)
+            for disk, overlay in overlays:
+                disk.volume = overlay
+                disk.save()
+
+        bases = {}
+        for disk in disks:
+            chain = disk.volume.get_backing_chain()
+            base = chain[len(chain) - max_depth] if max_depth > 0 else None
+            bases[disk.target_dev] = base
+            logger.info('Pull {0} backing volumes into {1} of {2}'.format(
+                len(chain) - 1 - max_depth, disk.target_dev, self.name))
+            domain.blockRebase(
+                disk.target_dev, base.get_path() if base else None, 0, 0)
+
+        for disk in disks:
+            wait(lambda: not domain.blockJobInfo(disk.target_dev, 0),
+                 interval=1, timeout=timeout,
+                 timeout_msg='Block pull into {0} of {1} is not '
+                             'finished'.format(disk.target_dev, self.name))
+            volume = disk.volume
+            volume.backing_store = bases[disk.target_dev]
+            if volume.backing_store is None:
+                volume.base_image = None
+            volume.save()
 
     def _get_snapshot(self, name):
         """Get snapshot
@@ -1374,22 +3561,37 @@ class LibvirtNode(Node):
 
                 # Update domain to snapshot state
                 xml_domain = snapshot._xml_tree.find('domain')
+                snapshot_disks = snapshot.disks
                 self.driver.conn.defineXML(ET.tostring(xml_domain))
                 snapshot.delete_snapshot_files()
                 snapshot.delete(2)
 
                 for disk in self.disk_devices:
                     if disk.device == 'disk':
-                        snap_disk = disk.volume
+                        snap_disks = [disk.volume]
+                        # Disk can use a flattened overlay over the
+                        # volume of the snapshot
+                        if disk.target_dev in snapshot_disks:
+                            snap_disk = self.get_volume(
+                                uuid=snapshot_disks[disk.target_dev])
+                            if snap_disk.pk != disk.volume.pk:
+                                snap_disks.append(snap_disk)
                         # update disk on node
-                        disk.volume = disk.volume.backing_store
+                        disk.volume = snap_disks[-1].backing_store
                         disk.save()
-                        snap_disk.remove()
+                        for snap_disk in snap_disks:
+                            snap_disk.remove()
 
             else:
                 # ORIGINAL DELETE
                 snapshot.delete(0)
 
+            if name in self.snapshot_stats:
+                snapshot_stats = dict(self.snapshot_stats)
+                del snapshot_stats[name]
+                self.snapshot_stats = snapshot_stats
+                self.save()
+
     @retry()
     def set_vcpu(self, vcpu):
         """Set vcpu count on node
@@ -1425,6 +3627,9 @@ class LibvirtNode(Node):
         :type mac: String
             :rtype : String
         """
+        inventory = self.driver.get_inventory(self.uuid)
+        if inventory is not None and 'interfaces' in inventory:
+            return inventory['interfaces'].get(mac)
         xml_desc = ET.fromstring(self._libvirt_node.XMLDesc(0))
         target = xml_desc.find('.//mac[@address="%s"]/../target' % mac)
         if target is not None:
@@ -1432,6 +3637,40 @@ class LibvirtNode(Node):
 
 
 class LibvirtInterface(Interface):
+    """Note: This class is imported as Interface at .__init__.py
+
+    :param net_driver: Backend of virtio interface: 'name' ('vhost' or
+        'qemu'), number of 'queues' (number of VCPUs of the node by default
+        for 'vhost'), 'rx_queue_size' and 'tx_queue_size'.
+    """
+
+    net_driver = ParamMultiField(
+        name=ParamField(default=None, choices=(None, 'vhost', 'qemu')),
+        queues=ParamField(default=None),
+        rx_queue_size=ParamField(default=None),
+        tx_queue_size=ParamField(default=None),
+    )
+
+    def get_driver_attrs(self):
+        """Get attributes of the driver element of the interface
+
+        :rtype : dict
+        """
+        if self.model != 'virtio':
+            return {}
+        attrs = {}
+        queues = self.net_driver.queues
+        if self.net_driver.name is not None:
+            attrs['name'] = self.net_driver.name
+            if queues is None and self.net_driver.name == 'vhost':
+                queues = self.node.vcpu
+        if queues is not None and queues > 1:
+            attrs['queues'] = queues
+        if self.net_driver.rx_queue_size is not None:
+            attrs['rx_queue_size'] = self.net_driver.rx_queue_size
+        if self.net_driver.tx_queue_size is not None:
+            attrs['tx_queue_size'] = self.net_driver.tx_queue_size
+        return attrs
 
     def define(self):
         filter_xml = LibvirtXMLBuilder.build_interface_filter(
@@ -1461,28 +3700,36 @@ class LibvirtInterface(Interface):
             logger.error("NWFilter not found by name: {}".format(
                 self.nwfilter_name))
 
+    def build_filter_xml(self, uuid=None, blocked=False):
+        """Generate XML of the filter of the interface
+
+        :type uuid: String
+        :type blocked: Boolean
+            :rtype : String
+        """
+        rule = None
+        if blocked:
+            rule = dict(
+                action='drop',
+                direction='inout',
+                priority='-950')
+        return LibvirtXMLBuilder.build_interface_filter(
+            name=self.nwfilter_name,
+            filterref=self.l2_network_device.network_name,
+            uuid=uuid,
+            rule=rule)
+
     @property
     def is_blocked(self):
         """Show state of interface"""
-        filter_xml = ET.fromstring(self._nwfilter.XMLDesc())
-        return filter_xml.find('./rule') is not None
+        return is_nwfilter_blocking(self._nwfilter)
 
     def block(self):
         """Block traffic on interface"""
-        filter_xml = LibvirtXMLBuilder.build_interface_filter(
-            name=self.nwfilter_name,
-            filterref=self.l2_network_device.network_name,
-            uuid=self._nwfilter.UUIDString(),
-            rule=dict(
-                action='drop',
-                direction='inout',
-                priority='-950'))
-        self.driver.conn.nwfilterDefineXML(filter_xml)
+        self.driver.conn.nwfilterDefineXML(self.build_filter_xml(
+            uuid=self._nwfilter.UUIDString(), blocked=True))
 
     def unblock(self):
         """Unblock traffic on interface"""
-        filter_xml = LibvirtXMLBuilder.build_interface_filter(
-            name=self.nwfilter_name,
-            filterref=self.l2_network_device.network_name,
-            uuid=self._nwfilter.UUIDString())
-        self.driver.conn.nwfilterDefineXML(filter_xml)
+        self.driver.conn.nwfilterDefineXML(self.build_filter_xml(
+            uuid=self._nwfilter.UUIDString()))
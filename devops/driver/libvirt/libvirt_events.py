@@ -0,0 +1,137 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import threading
+import time
+
+import libvirt
+
+from devops import logger
+
+
+_event_loop_lock = threading.Lock()
+_event_loop_thread = None
+
+
+def _run_event_loop():
+    while True:
+        try:
+            libvirt.virEventRunDefaultImpl()
+        except Exception:
+            # Without the loop every wait runs until its timeout
+            logger.exception('libvirt event loop iteration failed')
+            time.sleep(1)
+
+
+def start_event_loop():
+    """Run libvirt default event loop in a background thread
+
+    The event loop implementation has to be registered before a
+    connection is opened, otherwise no events are delivered for it.
+
+    :rtype : Boolean
+    """
+    global _event_loop_thread
+    with _event_loop_lock:
+        if _event_loop_thread is None:
+            try:
+                libvirt.virEventRegisterDefaultImpl()
+            except libvirt.libvirtError as e:
+                logger.warning(
+                    'libvirt event loop is not available: {0}'.format(e))
+                _event_loop_thread = False
+                return False
+            _event_loop_thread = threading.Thread(
+                target=_run_event_loop, name='libvirt-event-loop')
+            _event_loop_thread.daemon = True
+            _event_loop_thread.start()
+        return bool(_event_loop_thread)
+
+
+class DomainEventWatcher(object):
+    """Track lifecycle and reboot events of domains of a connection
+
+    Waiters check the state of a domain only when an event for this
+    domain is received, and every 'recheck' seconds in case an event
+    is lost, for example on reconnect.
+
+    :param conn: libvirt connection opened after start_event_loop()
+    """
+
+    recheck = 10
+
+    def __init__(self, conn):
+        self._cond = threading.Condition()
+        self._events = collections.defaultdict(int)
+        self._reboots = collections.defaultdict(int)
+        self._callbacks = [
+            conn.domainEventRegisterAny(
+                None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                self._lifecycle_cb, None),
+            conn.domainEventRegisterAny(
+                None, libvirt.VIR_DOMAIN_EVENT_ID_REBOOT,
+                self._reboot_cb, None),
+        ]
+
+    def _notify(self, dom, reboot=False):
+        with self._cond:
+            uuid = dom.UUIDString()
+            self._events[uuid] += 1
+            if reboot:
+                self._reboots[uuid] += 1
+            self._cond.notify_all()
+
+    def _lifecycle_cb(self, conn, dom, event, detail, opaque):
+        logger.debug('Domain {0} lifecycle event {1}, detail {2}'.format(
+            dom.name(), event, detail))
+        self._notify(dom)
+
+    def _reboot_cb(self, conn, dom, opaque):
+        logger.debug('Domain {0} reboot event'.format(dom.name()))
+        self._notify(dom, reboot=True)
+
+    def get_reboots(self, uuid):
+        """Get number of reboot events received for the domain
+
+        :type uuid: str
+            :rtype : int
+        """
+        with self._cond:
+            return self._reboots[uuid]
+
+    def wait(self, uuid, predicate, timeout):
+        """Wait until predicate becomes True
+
+        Predicate is checked at start and after each event of the domain.
+
+        :type uuid: str
+        :type predicate: function
+        :type timeout: int
+            :rtype : Boolean
+        """
+        deadline = time.time() + timeout
+        while True:
+            with self._cond:
+                events = self._events[uuid]
+            # Domain is queried outside of the lock, so the event loop
+            # thread is never blocked by a waiter
+            if predicate():
+                return True
+            with self._cond:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                if self._events[uuid] == events:
+                    self._cond.wait(min(remaining, self.recheck))
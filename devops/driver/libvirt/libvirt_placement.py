@@ -0,0 +1,202 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from devops.error import DevopsError
+
+
+def parse_cpuset(cpuset):
+    """Parse libvirt cpuset string like '0-3,^2,6' to set of CPU IDs
+
+    :type cpuset: str
+        :rtype : set
+    """
+    cpus = set()
+    excluded = set()
+    for item in (cpuset or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        target = cpus
+        if item.startswith('^'):
+            target = excluded
+            item = item[1:]
+        if '-' in item:
+            start, end = item.split('-', 1)
+            target.update(range(int(start), int(end) + 1))
+        else:
+            target.add(int(item))
+    return cpus - excluded
+
+
+def format_cpuset(cpus):
+    """Format CPU IDs as libvirt cpuset string, ranges are collapsed
+
+    :type cpus: iterable
+        :rtype : str
+    """
+    ranges = []
+    for cpu in sorted(set(cpus)):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(start) if start == end else
+                    '{0}-{1}'.format(start, end) for start, end in ranges)
+
+
+def get_host_cells(capabilities):
+    """Get NUMA cells of the host from capabilities XML
+
+    :type capabilities: ET
+        :rtype : list of dicts with 'id', 'cpus', 'memory' (KiB)
+            and 'pages' (number of pages by page size in KiB)
+    """
+    cells = []
+    for cell in capabilities.findall('host/topology/cells/cell'):
+        memory = cell.find('memory')
+        cells.append({
+            'id': int(cell.get('id')),
+            'cpus': sorted(int(cpu.get('id'))
+                           for cpu in cell.findall('cpus/cpu')),
+            'memory': int(memory.text) if memory is not None else 0,
+            'pages': {int(page.get('size')): int(page.text)
+                      for page in cell.findall('pages')},
+        })
+    return cells
+
+
+def get_pinned_cpus(domain_xml):
+    """Get host CPUs to which vcpus of the domain are pinned
+
+    :type domain_xml: ET
+        :rtype : set
+    """
+    cpus = set()
+    for vcpupin in domain_xml.findall('cputune/vcpupin'):
+        cpus.update(parse_cpuset(vcpupin.get('cpuset')))
+    return cpus
+
+
+_MEMORY_UNITS = {
+    'b': 1, 'bytes': 1,
+    'k': 1024, 'KiB': 1024, 'KB': 1000,
+    'M': 1024 ** 2, 'MiB': 1024 ** 2, 'MB': 1000 ** 2,
+    'G': 1024 ** 3, 'GiB': 1024 ** 3, 'GB': 1000 ** 3,
+}
+
+
+def _to_mib(value, unit):
+    return int(value) * _MEMORY_UNITS[unit or 'KiB'] // 1024 ** 2
+
+
+def get_reserved_memory(domain_xml):
+    """Get memory which numatune of the domain binds to host NUMA cells
+
+    Memory bound to several host cells is split between them evenly.
+
+    :type domain_xml: ET
+        :rtype : dict of memory in MiB by host cell ID
+    """
+    numatune = domain_xml.find('numatune')
+    if numatune is None:
+        return {}
+    memory = numatune.find('memory')
+    nodeset = parse_cpuset(memory.get('nodeset') if memory is not None
+                           else None)
+    memnodes = {int(memnode.get('cellid')): parse_cpuset(
+        memnode.get('nodeset')) for memnode in numatune.findall('memnode')}
+
+    guest_cells = domain_xml.findall('cpu/numa/cell')
+    if guest_cells:
+        parts = [(memnodes.get(int(cell.get('id')), nodeset),
+                  _to_mib(cell.get('memory'), cell.get('unit')))
+                 for cell in guest_cells]
+    else:
+        total = domain_xml.find('memory')
+        parts = [(nodeset, _to_mib(total.text, total.get('unit')))]
+
+    reserved = {}
+    for host_cells, memory in parts:
+        for cell_id in host_cells:
+            reserved[cell_id] = (reserved.get(cell_id, 0) +
+                                 memory // len(host_cells))
+    return reserved
+
+
+def get_guest_cells(vcpu, memory, numa):
+    """Get guest NUMA cells of a node, a node without NUMA has one cell
+
+    :type vcpu: int
+    :type memory: int
+    :type numa: list
+        :rtype : list of dicts with 'vcpus' and 'memory' (MiB)
+    """
+    if not numa:
+        return [{'vcpus': list(range(vcpu)), 'memory': memory}]
+    return [{'vcpus': sorted(parse_cpuset(str(cell['cpus']))),
+             'memory': cell['memory']} for cell in numa]
+
+
+def plan_placement(host_cells, guest_cells, pinned=(), free_memory=None):
+    """Assign every guest cell to a single host cell
+
+    Each guest vcpu gets a dedicated host CPU which is not pinned by
+    any other domain. Guest cells are spread over different host cells
+    first, then the host cell with the most free CPUs is used.
+
+    :param host_cells: result of get_host_cells()
+    :param guest_cells: result of get_guest_cells()
+    :param pinned: host CPUs already used by other domains
+    :param free_memory: dict of free memory in MiB by host cell ID,
+        memory of the cells is used if not given
+        :rtype : list of dicts with 'cell', 'host_cell', 'vcpus',
+            'cpus' and 'memory', where cpus[i] is the host CPU of vcpus[i]
+    """
+    pinned = set(pinned)
+    free_cpus = {cell['id']: [cpu for cpu in cell['cpus']
+                              if cpu not in pinned]
+                 for cell in host_cells}
+    if free_memory is None:
+        free_memory = {cell['id']: cell['memory'] // 1024
+                       for cell in host_cells}
+    free_memory = dict(free_memory)
+
+    used_cells = set()
+    placement = []
+    for idx, guest in enumerate(guest_cells):
+        count = len(guest['vcpus'])
+        candidates = [cell_id for cell_id in sorted(free_cpus)
+                      if len(free_cpus[cell_id]) >= count and
+                      free_memory.get(cell_id, 0) >= guest['memory']]
+        if not candidates:
+            raise DevopsError(
+                'No host NUMA cell has {0} free CPUs and {1} MiB of free '
+                'memory for guest NUMA cell {2}'.format(
+                    count, guest['memory'], idx))
+        host_cell = max(candidates,
+                        key=lambda cell_id: (cell_id not in used_cells,
+                                             len(free_cpus[cell_id]),
+                                             -cell_id))
+        cpus = free_cpus[host_cell][:count]
+        free_cpus[host_cell] = free_cpus[host_cell][count:]
+        free_memory[host_cell] -= guest['memory']
+        used_cells.add(host_cell)
+        placement.append({
+            'cell': idx,
+            'host_cell': host_cell,
+            'vcpus': guest['vcpus'],
+            'cpus': cpus,
+            'memory': guest['memory'],
+        })
+    return placement
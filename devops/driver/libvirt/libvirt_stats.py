@@ -0,0 +1,273 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import threading
+import time
+
+import libvirt
+
+from devops import logger
+
+
+# (metric name, sample key, help text)
+DOMAIN_METRICS = (
+    ('devops_domain_cpu_usage_ratio', 'cpu_usage',
+     'CPU time used by the domain per second of wall time'),
+    ('devops_domain_vcpu_usage_ratio', 'vcpu_usage',
+     'Time spent on vCPUs per second of wall time'),
+    ('devops_domain_memory_current_bytes', 'memory_current',
+     'Current balloon size of the domain'),
+    ('devops_domain_memory_rss_bytes', 'memory_rss',
+     'Resident set size of the domain process'),
+)
+
+BLOCK_METRICS = (
+    ('devops_domain_block_read_bytes_rate', 'rd_bytes_rate',
+     'Bytes read from the block device per second'),
+    ('devops_domain_block_write_bytes_rate', 'wr_bytes_rate',
+     'Bytes written to the block device per second'),
+    ('devops_domain_block_read_iops', 'rd_iops',
+     'Read requests to the block device per second'),
+    ('devops_domain_block_write_iops', 'wr_iops',
+     'Write requests to the block device per second'),
+    ('devops_domain_block_read_latency_seconds', 'rd_latency',
+     'Average latency of read requests'),
+    ('devops_domain_block_write_latency_seconds', 'wr_latency',
+     'Average latency of write requests'),
+)
+
+NET_METRICS = (
+    ('devops_domain_net_rx_bytes_rate', 'rx_bytes_rate',
+     'Bytes received by the interface per second'),
+    ('devops_domain_net_tx_bytes_rate', 'tx_bytes_rate',
+     'Bytes transmitted by the interface per second'),
+    ('devops_domain_net_rx_packets_rate', 'rx_pkts_rate',
+     'Packets received by the interface per second'),
+    ('devops_domain_net_tx_packets_rate', 'tx_pkts_rate',
+     'Packets transmitted by the interface per second'),
+)
+
+
+def _devices(stats, prefix, fields):
+    devices = {}
+    for idx in range(stats.get('{0}.count'.format(prefix), 0)):
+        name = stats.get('{0}.{1}.name'.format(prefix, idx))
+        if name is None:
+            continue
+        devices[name] = {
+            field.replace('.', '_'): stats.get(
+                '{0}.{1}.{2}'.format(prefix, idx, field), 0)
+            for field in fields}
+    return devices
+
+
+def parse_domain_stats(stats):
+    """Convert flat record of virConnectGetAllDomainStats to counters
+
+    :type stats: dict
+        :rtype : dict
+    """
+    return {
+        'cpu_time': stats.get('cpu.time', 0),
+        'vcpu_time': sum(stats.get('vcpu.{0}.time'.format(idx), 0)
+                         for idx in range(stats.get('vcpu.current', 0))),
+        'memory_current': stats.get('balloon.current', 0) * 1024,
+        'memory_rss': stats.get('balloon.rss', 0) * 1024,
+        'block': _devices(stats, 'block',
+                          ('rd.bytes', 'wr.bytes', 'rd.reqs', 'wr.reqs',
+                           'rd.times', 'wr.times')),
+        'net': _devices(stats, 'net',
+                        ('rx.bytes', 'tx.bytes', 'rx.pkts', 'tx.pkts')),
+    }
+
+
+def _rate(cur, prev, interval):
+    delta = cur - prev
+    if delta < 0:
+        # counter is reset when the domain is restarted
+        return None
+    return float(delta) / interval
+
+
+def _latency(cur, prev, times_key, reqs_key):
+    reqs = cur[reqs_key] - prev[reqs_key]
+    if reqs <= 0:
+        return 0.0
+    return float(cur[times_key] - prev[times_key]) / reqs / 1e9
+
+
+def compute_rates(cur, prev, interval):
+    """Compute rates between two parsed samples
+
+    :type cur: dict
+    :type prev: dict
+    :type interval: float
+        :rtype : dict
+    """
+    cpu = _rate(cur['cpu_time'], prev['cpu_time'], interval)
+    vcpu = _rate(cur['vcpu_time'], prev['vcpu_time'], interval)
+    sample = {
+        'cpu_usage': cpu / 1e9 if cpu is not None else None,
+        'vcpu_usage': vcpu / 1e9 if vcpu is not None else None,
+        'memory_current': cur['memory_current'],
+        'memory_rss': cur['memory_rss'],
+        'block': {},
+        'net': {},
+    }
+    for name, dev in cur['block'].items():
+        old = prev['block'].get(name)
+        if old is None:
+            continue
+        sample['block'][name] = {
+            'rd_bytes_rate': _rate(dev['rd_bytes'], old['rd_bytes'],
+                                   interval),
+            'wr_bytes_rate': _rate(dev['wr_bytes'], old['wr_bytes'],
+                                   interval),
+            'rd_iops': _rate(dev['rd_reqs'], old['rd_reqs'], interval),
+            'wr_iops': _rate(dev['wr_reqs'], old['wr_reqs'], interval),
+            'rd_latency': _latency(dev, old, 'rd_times', 'rd_reqs'),
+            'wr_latency': _latency(dev, old, 'wr_times', 'wr_reqs'),
+        }
+    for name, dev in cur['net'].items():
+        old = prev['net'].get(name)
+        if old is None:
+            continue
+        sample['net'][name] = {
+            'rx_bytes_rate': _rate(dev['rx_bytes'], old['rx_bytes'],
+                                   interval),
+            'tx_bytes_rate': _rate(dev['tx_bytes'], old['tx_bytes'],
+                                   interval),
+            'rx_pkts_rate': _rate(dev['rx_pkts'], old['rx_pkts'], interval),
+            'tx_pkts_rate': _rate(dev['tx_pkts'], old['tx_pkts'], interval),
+        }
+    return sample
+
+
+class DomainStatsCollector(threading.Thread):
+    """Periodically sample resource usage of domains
+
+    Every sample is a single virConnectGetAllDomainStats call for all
+    watched domains. Rates computed from two consecutive samples are
+    kept in a ring buffer of 'history' entries per domain.
+
+    :param conn: libvirt connection
+    :param domains: dict of labels by UUID of domain, for example
+        {'5f1c...': {'env': 'myenv', 'node': 'admin'}}
+    :param interval: seconds between samples
+    :param history: number of samples kept for every domain
+    """
+
+    STATS = (libvirt.VIR_DOMAIN_STATS_CPU_TOTAL |
+             libvirt.VIR_DOMAIN_STATS_VCPU |
+             libvirt.VIR_DOMAIN_STATS_BALLOON |
+             libvirt.VIR_DOMAIN_STATS_BLOCK |
+             libvirt.VIR_DOMAIN_STATS_INTERFACE)
+
+    def __init__(self, conn, domains, interval=5, history=60):
+        super(DomainStatsCollector, self).__init__()
+        self.daemon = True
+        self.conn = conn
+        self.domains = domains
+        self.interval = interval
+        self.history = collections.defaultdict(
+            lambda: collections.deque(maxlen=history))
+        self._last = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def sample(self):
+        """Take one sample of all watched domains"""
+        now = time.time()
+        records = self.conn.getAllDomainStats(
+            self.STATS, libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+        with self._lock:
+            seen = set()
+            for dom, stats in records:
+                uuid = dom.UUIDString()
+                if uuid not in self.domains:
+                    continue
+                seen.add(uuid)
+                cur = parse_domain_stats(stats)
+                last = self._last.get(uuid)
+                self._last[uuid] = (now, cur)
+                if last is None or now <= last[0]:
+                    continue
+                rates = compute_rates(cur, last[1], now - last[0])
+                rates['timestamp'] = now
+                self.history[uuid].append(rates)
+            # Inactive domains start counting from zero again
+            for uuid in set(self._last) - seen:
+                del self._last[uuid]
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.sample()
+            except libvirt.libvirtError as e:
+                logger.warning('Failed to get domain stats: {0}'.format(e))
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+
+    def get_history(self, uuid):
+        """Get list of samples of the domain, oldest first
+
+        :type uuid: str
+            :rtype : list
+        """
+        with self._lock:
+            return list(self.history.get(uuid, ()))
+
+    def to_dict(self):
+        """Get all samples with labels of domains
+
+        :rtype : list
+        """
+        with self._lock:
+            return [dict(labels, uuid=uuid,
+                         samples=list(self.history.get(uuid, ())))
+                    for uuid, labels in sorted(self.domains.items())]
+
+    def latest(self):
+        """Get the last sample of every domain which has one
+
+        :rtype : list
+        """
+        with self._lock:
+            return [(dict(labels, uuid=uuid), self.history[uuid][-1])
+                    for uuid, labels in sorted(self.domains.items())
+                    if self.history.get(uuid)]
+
+    def metrics(self):
+        """Get the last samples as (name, help, labels, value) tuples
+
+        :rtype : list
+        """
+        latest = self.latest()
+        metrics = []
+        for name, key, help_text in DOMAIN_METRICS:
+            metrics.extend((name, help_text, labels, sample[key])
+                           for labels, sample in latest)
+        for group, label, group_metrics in (
+                ('block', 'device', BLOCK_METRICS),
+                ('net', 'interface', NET_METRICS)):
+            for name, key, help_text in group_metrics:
+                metrics.extend(
+                    (name, help_text, dict(labels, **{label: dev}),
+                     values[key])
+                    for labels, sample in latest
+                    for dev, values in sorted(sample[group].items()))
+        return metrics
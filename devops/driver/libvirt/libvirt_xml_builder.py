@@ -17,6 +17,7 @@ import hashlib
 
 import six
 
+from devops.driver.libvirt.libvirt_placement import format_cpuset
 from devops.helpers.xmlgenerator import XMLGenerator
 
 
@@ -74,22 +75,34 @@ class LibvirtXMLBuilder(object):
                         start=dhcp_range_start,
                         end=dhcp_range_end)
                     for address in addresses:
-                        network_xml.host(
-                            mac=address['mac'],
-                            ip=address['ip'],
-                            name=address['name'],
-                        )
+                        network_xml.host(**address)
                     if has_pxe_server:
                         network_xml.bootp(file='pxelinux.0')
 
         return str(network_xml)
 
+    @classmethod
+    def build_dhcp_host_xml(cls, mac, ip, name=None):
+        """Generate XML of a DHCP host entry for network.update()
+
+        :type mac: String
+        :type ip: String
+        :type name: String or None
+            :rtype : String
+        """
+        attrs = dict(mac=mac, ip=ip)
+        if name is not None:
+            attrs['name'] = name
+        host_xml = XMLGenerator('host', **attrs)
+        return str(host_xml)
+
     @classmethod
     def build_volume_xml(cls, name, capacity, vol_format, backing_store_path,
-                         backing_store_format):
+                         backing_store_format, cluster_size=None):
         """Generate volume XML
 
         :type volume: Volume
+        :type cluster_size: Integer
             :rtype : String
         """
         volume_xml = XMLGenerator('volume')
@@ -98,12 +111,29 @@ class LibvirtXMLBuilder(object):
         with volume_xml.target:
             volume_xml.format(type=vol_format)
             volume_xml.permissions.mode("0644")
+            if cluster_size:
+                volume_xml.clusterSize(str(cluster_size), unit='KiB')
         if backing_store_path:
             with volume_xml.backingStore:
                 volume_xml.path(backing_store_path)
                 volume_xml.format(type=backing_store_format)
         return str(volume_xml)
 
+    @classmethod
+    def build_storage_pool_xml(cls, name, path):
+        """Generate XML of a directory storage pool
+
+        :type name: String
+        :type path: String
+            :rtype : String
+        """
+        pool_xml = XMLGenerator('pool', type='dir')
+        pool_xml.name(cls._crop_name(name))
+        with pool_xml.target:
+            pool_xml.path(path)
+            pool_xml.permissions.mode('0755')
+        return str(pool_xml)
+
     @classmethod
     def build_snapshot_xml(cls, name=None, description=None,
                            external=False, disk_only=False, memory_file='',
@@ -140,7 +170,9 @@ class LibvirtXMLBuilder(object):
     @classmethod
     def _build_disk_device(cls, device_xml, disk_type, disk_device,
                            disk_volume_format, disk_volume_path, disk_bus,
-                           disk_target_dev, disk_serial):
+                           disk_target_dev, disk_serial, disk_cache='unsafe',
+                           disk_io=None, disk_discard=None,
+                           disk_iothread=None):
         """Build xml for disk
 
         :param device_xml: XMLBuilder
@@ -149,7 +181,14 @@ class LibvirtXMLBuilder(object):
 
         with device_xml.disk(type=disk_type, device=disk_device):
             # https://bugs.launchpad.net/ubuntu/+source/qemu-kvm/+bug/741887
-            device_xml.driver(type=disk_volume_format, cache="unsafe")
+            driver_args = {'type': disk_volume_format, 'cache': disk_cache}
+            if disk_io:
+                driver_args['io'] = disk_io
+            if disk_discard:
+                driver_args['discard'] = disk_discard
+            if disk_iothread:
+                driver_args['iothread'] = disk_iothread
+            device_xml.driver(**driver_args)
             device_xml.source(file=disk_volume_path)
             if disk_bus == 'usb':
                 device_xml.target(
@@ -167,10 +206,11 @@ class LibvirtXMLBuilder(object):
     def _build_interface_device(cls, device_xml, interface_type,
                                 interface_mac_address, interface_network_name,
                                 interface_target_dev, interface_model,
-                                interface_filter):
+                                interface_filter, interface_driver=None):
         """Build xml for interface
 
         :param device_xml: XMLBuilder
+        :param interface_driver: dict of attributes of the driver element
         """
 
         with device_xml.interface(type=interface_type):
@@ -180,6 +220,8 @@ class LibvirtXMLBuilder(object):
             device_xml.target(dev=interface_target_dev)
             if interface_model is not None:
                 device_xml.model(type=interface_model)
+            if interface_driver:
+                device_xml.driver(**interface_driver)
             device_xml.filterref(filter=interface_filter)
 
     @classmethod
@@ -223,15 +265,22 @@ class LibvirtXMLBuilder(object):
                        use_hugepages, hpet, os_type, architecture, boot,
                        reboot_timeout, bootmenu_timeout, emulator,
                        has_vnc, vnc_password, local_disk_devices, interfaces,
-                       acpi, numa):
+                       acpi, numa, iothreads=0, placement=None,
+                       hugepage_size=None, uuid=None):
         """Generate node XML
 
         :type node: Node
         :type emulator: String
+        :param placement: assignment of guest NUMA cells to host NUMA
+            cells, see libvirt_placement.plan_placement()
+        :param hugepage_size: size of huge pages in KiB
+        :param uuid: UUID of the domain, generated by libvirt if None
             :rtype : String
         """
         node_xml = XMLGenerator("domain", type=hypervisor)
         node_xml.name(cls._crop_name(name))
+        if uuid:
+            node_xml.uuid(uuid)
 
         if acpi:
             with node_xml.features:
@@ -252,11 +301,38 @@ class LibvirtXMLBuilder(object):
         elif cpu_args:
             node_xml.cpu(**cpu_args)
         node_xml.vcpu(str(vcpu))
+        if iothreads:
+            node_xml.iothreads(str(iothreads))
         node_xml.memory(str(memory * 1024), unit='KiB')
 
+        if placement:
+            with node_xml.cputune:
+                for cell in placement:
+                    for vcpu_id, cpu in zip(cell['vcpus'], cell['cpus']):
+                        node_xml.vcpupin(vcpu=str(vcpu_id), cpuset=str(cpu))
+                node_xml.emulatorpin(cpuset=format_cpuset(
+                    cpu for cell in placement for cpu in cell['cpus']))
+            with node_xml.numatune:
+                node_xml.memory(mode='strict', nodeset=format_cpuset(
+                    cell['host_cell'] for cell in placement))
+                # memnode can refer only to cells of guest NUMA topology
+                if numa:
+                    for cell in placement:
+                        node_xml.memnode(cellid=str(cell['cell']),
+                                         mode='strict',
+                                         nodeset=str(cell['host_cell']))
+
         if use_hugepages:
             with node_xml.memoryBacking:
-                node_xml.hugepages
+                if hugepage_size and numa:
+                    with node_xml.hugepages:
+                        node_xml.page(size=str(hugepage_size), unit='KiB',
+                                      nodeset=format_cpuset(range(len(numa))))
+                elif hugepage_size:
+                    with node_xml.hugepages:
+                        node_xml.page(size=str(hugepage_size), unit='KiB')
+                else:
+                    node_xml.hugepages
 
         node_xml.clock(offset='utc')
         with node_xml.clock.timer(name='rtc',
@@ -69,6 +69,19 @@ class TimeoutError(DevopsError):
     pass
 
 
+class DevopsResourcesError(DevopsError):
+    """Hosts have not enough free resources for the environment"""
+
+    def __init__(self, env_name, report):
+        self.report = report
+        lines = [
+            '  {host}: {resource} required {required} {unit}, '
+            'available {available} {unit}'.format(**row) for row in report]
+        super(DevopsResourcesError, self).__init__(
+            "Not enough resources for environment '{0}':\n{1}".format(
+                env_name, '\n'.join(lines)))
+
+
 class DevopsObjNotFound(DevopsError):
     """Object not found in Devops database"""
 
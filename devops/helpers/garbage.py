@@ -0,0 +1,91 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Search and removal of files left by erased snapshots and environments
+
+Volumes are checked by the drivers against the database and the domains
+of their hosts. Memory state files of external snapshots are checked
+against the snapshots of all hosts of the drivers.
+"""
+
+import os
+import time
+
+from devops.helpers.helpers import run_parallel
+from devops import logger
+
+
+MEMORY_FILE_PREFIX = 'snapshot-memory-'
+
+
+def find_garbage(drivers, known_volumes, env_nodes, memory_dir=None,
+                 min_age=3600):
+    """Find unused volumes and snapshot memory files
+
+    :param drivers: drivers of all groups in the database
+    :param known_volumes: set of keys of volumes in the database
+    :param env_nodes: dict of names of environments in the database
+        with lists of names of their nodes
+    :param memory_dir: directory with memory state files of snapshots
+    :param min_age: seconds, newer volumes and memory files can belong to
+        a node or a snapshot which is being created
+        :rtype : list of dicts with 'type', 'path', 'size' (bytes) and
+            'driver' which removes the item, None for local files
+    """
+    garbage = {}
+    memory_files = set()
+    for driver in drivers:
+        for item in driver.get_garbage(known_volumes, env_nodes,
+                                       min_age=min_age):
+            item['driver'] = driver
+            garbage.setdefault(item['path'], item)
+        memory_files.update(driver.get_snapshot_memory_files())
+
+    if memory_dir and os.path.isdir(memory_dir):
+        now = time.time()
+        for name in os.listdir(memory_dir):
+            path = os.path.join(memory_dir, name)
+            if (not name.startswith(MEMORY_FILE_PREFIX) or
+                    path in memory_files or not os.path.isfile(path) or
+                    now - os.path.getmtime(path) < min_age):
+                continue
+            garbage[path] = {'type': 'memory', 'path': path,
+                             'size': os.path.getsize(path), 'driver': None}
+
+    return [garbage[path] for path in sorted(garbage)]
+
+
+def remove_garbage(garbage, threads=None):
+    """Remove items found by find_garbage() in a pool of threads
+
+    A failure to remove an item is logged and doesn't stop the others.
+
+    :type garbage: list
+    :type threads: int
+        :rtype : list of removed items
+    """
+    def remove(item):
+        try:
+            if item['driver'] is None:
+                logger.info('Remove unused file {0}'.format(item['path']))
+                os.remove(item['path'])
+            else:
+                item['driver'].remove_garbage(item)
+            return True
+        except Exception as e:
+            logger.error('Cannot remove {0}: {1}'.format(item['path'], e))
+            return False
+
+    removed = run_parallel(remove, garbage, threads)
+    return [item for item, ok in zip(garbage, removed) if ok]
@@ -14,10 +14,14 @@
 
 from __future__ import absolute_import
 
+from contextlib import contextmanager
+import fcntl
 from functools import partial
 # pylint: disable=redefined-builtin
 from functools import reduce
 # pylint: enable=redefined-builtin
+import hashlib
+from multiprocessing.pool import ThreadPool
 import os
 import socket
 import time
@@ -267,6 +271,102 @@ def get_file_size(path):
     return os.stat(path).st_size
 
 
+_file_checksums = {}
+
+
+def get_file_checksum(path, chunk_size=4 * 1024 ** 2):
+    """Get sha256 checksum of file content
+
+    Result is memoized by path, size and modification time of the file,
+    so repeated calls for the same unchanged image do not read it again.
+
+    :type path: str
+    :type chunk_size: int
+    :rtype : str
+    """
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime)
+    if key not in _file_checksums:
+        checksum = hashlib.sha256()
+        with open(path, 'rb') as fd:
+            for chunk in iter(partial(fd.read, chunk_size), b''):
+                checksum.update(chunk)
+        _file_checksums[key] = checksum.hexdigest()
+    return _file_checksums[key]
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on the file while the context is active
+
+    The lock is shared between processes on the same host, parent
+    directory of the lock file is created if missing.
+
+    :type path: str
+    """
+    lock_dir = os.path.dirname(path)
+    if lock_dir and not os.path.exists(lock_dir):
+        os.makedirs(lock_dir)
+    with open(path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def run_parallel(func, items, threads=None):
+    """Call the function for every item in a pool of threads
+
+    Results are returned in the order of items. The first exception
+    raised by a call is re-raised after all calls are finished.
+
+    :type func: function
+    :type items: iterable
+    :param threads: size of the pool, a thread for every item by default
+        :rtype : list
+    """
+    items = list(items)
+    if len(items) <= 1 or threads == 1:
+        return [func(item) for item in items]
+    pool = ThreadPool(threads or len(items))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def format_prometheus(metrics):
+    """Format metrics in Prometheus text exposition format
+
+    :param metrics: iterable of (name, help, labels, value) tuples,
+        metrics with value None are skipped
+        :rtype : str
+    """
+    helps = {}
+    samples = {}
+    for name, help_text, labels, value in metrics:
+        if name not in helps:
+            helps[name] = help_text
+            samples[name] = []
+        if value is not None:
+            samples[name].append((labels, value))
+
+    lines = []
+    for name in sorted(helps):
+        lines.append('# HELP {0} {1}'.format(name, helps[name]))
+        lines.append('# TYPE {0} gauge'.format(name))
+        for labels, value in samples[name]:
+            label_str = ','.join(
+                '{0}="{1}"'.format(
+                    key,
+                    str(val).replace('\\', '\\\\').replace('"', '\\"'))
+                for key, val in sorted(labels.items()))
+            lines.append('{0}{{{1}}} {2}'.format(name, label_str, value))
+    return '\n'.join(lines) + '\n'
+
+
 def _get_file_size(*args, **kwargs):
     logger.warning(
         '_get_file_size has been deprecated in favor of get_file_size')
@@ -0,0 +1,114 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Reconciliation of the database with the objects on the hosts
+
+Every driver lists the objects of its host once and compares them with
+the records of all groups on the host. Differences are:
+
+* 'orphan' - an object of the host with a name built from records of
+  the database which is not used by them, like a filter of a removed
+  interface
+* 'missing' - a record of the database without the object on the host
+* 'mismatch' - a record with the UUID of another object of the host
+  with the expected name
+
+Repairs of records are done first, then repairs of the host objects in
+stages, objects of a stage are repaired in parallel.
+"""
+
+import json
+
+from devops.helpers.helpers import run_parallel
+from devops import logger
+
+
+# Repairs of records done in the calling thread, other repairs are done
+# by the drivers
+RECORD_REPAIRS = ('update-uuid', 'delete-record')
+
+
+def find_drift(groups):
+    """Compare objects of the hosts with records of the groups
+
+    :param groups: groups of all environments in the database
+        :rtype : list of dicts with 'kind', 'object', 'host', 'env',
+            'name', 'detail', 'repair' (action or None if the item can
+            not be repaired), 'driver' and data of the repair
+    """
+    groups = list(groups)
+    drivers = {}
+    for group in groups:
+        # groups with the same driver params share the host
+        driver = group.driver
+        key = (driver.name, json.dumps(driver.params, sort_keys=True))
+        drivers.setdefault(key, driver)
+
+    drift = {}
+    for driver in drivers.values():
+        for item in driver.get_drift(groups):
+            item['driver'] = driver
+            key = (item['host'], item['object'], item['name'], item['kind'])
+            drift.setdefault(key, item)
+    return [drift[key] for key in sorted(drift)]
+
+
+def _repair_record(item):
+    record = item['record']
+    if item['repair'] == 'update-uuid':
+        logger.info('Update UUID of {0} {1} to {2}'.format(
+            item['object'], item['name'], item['uuid']))
+        record.uuid = item['uuid']
+        record.save()
+    elif item['repair'] == 'delete-record':
+        logger.info('Delete record of {0} {1}'.format(
+            item['object'], item['name']))
+        record.delete()
+
+
+def repair_drift(drift, threads=None):
+    """Repair items found by find_drift()
+
+    Records are changed in the calling thread, objects of the hosts are
+    repaired by their drivers in a pool of threads. A failure to repair
+    an item is logged and doesn't stop the others.
+
+    :type drift: list
+    :type threads: int
+        :rtype : list of repaired items
+    """
+    def repair(item):
+        try:
+            if item['repair'] in RECORD_REPAIRS:
+                _repair_record(item)
+            else:
+                item['driver'].repair_drift(item)
+            return True
+        except Exception as e:
+            logger.error('Cannot repair {0} {1}: {2}'.format(
+                item['object'], item['name'], e))
+            return False
+
+    items = [item for item in drift if item['repair'] is not None]
+    repaired = [item for item in items
+                if item['repair'] in RECORD_REPAIRS and repair(item)]
+    host_items = [item for item in items
+                  if item['repair'] not in RECORD_REPAIRS]
+    for stage in sorted(set(item['stage'] for item in host_items)):
+        stage_items = [item for item in host_items
+                       if item['stage'] == stage]
+        results = run_parallel(repair, stage_items, threads)
+        repaired.extend(item for item, ok in zip(stage_items, results)
+                        if ok)
+    return repaired
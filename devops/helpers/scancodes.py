@@ -12,6 +12,8 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import re
+
 # Based on http://www.win.tue.nl/~aeb/linux/kbd/scancodes-1.html
 # Scancodes < 0x80 - key presses, > 0x80 - key releases
 SCANCODES = {
@@ -149,35 +151,99 @@ SPECIALS = {
     '<F12>': 0x58
 }
 
-__all__ = ['from_string']
+SHIFT = 0x2a
 
+# Keys which change the screen, so following keys are never pressed
+# together with them
+BATCH_BREAKERS = (
+    SPECIALS['<Enter>'],
+    SPECIALS['<Esc>'],
+)
 
-def iterable(a):
-    if a is None:
-        return tuple()
-    return a if isinstance(a, (tuple, list)) else (a,)
+# Maximum number of keys pressed at once, VIR_DOMAIN_SEND_KEY_MAX_KEYS
+MAX_KEYS = 16
 
+_TOKEN_RE = re.compile(r'<[^>]*>|.', re.DOTALL)
+_WAIT_RE = re.compile(r'^<Wait(\d+(?:\.\d+)?)>$')
 
-def from_string(s):
-    """from_string(s) - Convert string of chars into string of scancodes."""
+_CACHE_SIZE = 64
+_cache = {}
 
-    scancodes = []
+__all__ = ['from_string', 'to_batches']
 
-    while len(s) > 0:
-        if s[0] == '<' and s.find('>') > 0:
-            special_end = s.find('>') + 1
-            special = s[0:special_end]
-            s = s[special_end:]
 
-            codes = SPECIALS.get(special)
-        else:
-            key = s[0]
-            s = s[1:]
+def iterable(a):
+    if a is None:
+        return tuple()
+    return a if isinstance(a, (tuple, list)) else (a,)
+
 
-            codes = SCANCODES.get(key)
+def _token_codes(token):
+    if len(token) == 1:
+        return SCANCODES.get(token)
+    codes = SPECIALS.get(token)
+    if codes is None:
+        wait = _WAIT_RE.match(token)
+        if wait:
+            codes = ('wait', float(wait.group(1)))
+    return codes
 
-        codes = iterable(codes)
-        if len(codes) > 0:
-            scancodes.append(codes)
 
-    return scancodes
+def from_string(s):
+    """from_string(s) - Convert string of chars into string of scancodes.
+
+    '<WaitN>' is converted to ('wait', N), where N is number of seconds.
+    Results are cached, so repeated strings are converted only once.
+    """
+    scancodes = _cache.get(s)
+    if scancodes is None:
+        scancodes = []
+        for token in _TOKEN_RE.findall(s):
+            codes = iterable(_token_codes(token))
+            if len(codes) > 0:
+                scancodes.append(codes)
+        if len(_cache) >= _CACHE_SIZE:
+            _cache.clear()
+        _cache[s] = scancodes
+    return list(scancodes)
+
+
+def to_batches(scancodes, max_keys=MAX_KEYS):
+    """Join consecutive keys which may be pressed at once
+
+    Keys are joined while they need the same modifier (none or Shift),
+    no key repeats in a batch and the batch has at most max_keys codes.
+    Key combinations like <KillX> and waits are never joined.
+
+    :type scancodes: list
+    :type max_keys: int
+        :rtype : list
+    """
+    batches = []
+    modifiers = None
+    keys = []
+
+    def flush():
+        if keys:
+            batches.append(modifiers + tuple(keys))
+            del keys[:]
+
+    for codes in scancodes:
+        if isinstance(codes[0], str) or max_keys < 2:
+            flush()
+            batches.append(codes)
+            continue
+        mods, key = tuple(codes[:-1]), codes[-1]
+        if mods not in ((), (SHIFT,)):
+            flush()
+            batches.append(codes)
+            continue
+        if (mods != modifiers or key in keys or
+                len(mods) + len(keys) >= max_keys):
+            flush()
+            modifiers = mods
+        keys.append(key)
+        if key in BATCH_BREAKERS:
+            flush()
+    flush()
+    return batches
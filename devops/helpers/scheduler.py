@@ -0,0 +1,237 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Distribution of nodes of an environment template across several hosts
+
+Hosts are described by a list of dicts:
+
+.. code-block:: yaml
+
+    - name: host1                               # optional, default 'hostN'
+      connection_string: qemu+ssh://host1/system
+      uplink: eth1      # physical interface connected to the other hosts
+      memory: 65536     # MiB, optional, detected by the driver if missing
+      vcpu: 32          # optional, detected by the driver if missing
+      disk: 1000        # GiB, optional, detected by the driver if missing
+
+Nodes of every group are packed on the hosts with first fit decreasing.
+The group stays on the first used host, a copy of the group is created
+for every other used host. Each l2 network device used by nodes on other
+hosts gets a replica there, replicas are connected with the device by a
+dedicated VLAN on an 'uplink' bridge of every host. Bridges of remote
+hosts are wired over ssh, so qemu+ssh:// connections are required and
+the user should be allowed to run 'sudo ip link' there.
+"""
+
+from copy import deepcopy
+
+from devops.error import DevopsError
+from devops.helpers import loader
+from devops import logger
+
+
+RESOURCES = ('memory', 'vcpu', 'disk')
+
+
+def get_node_requirements(node):
+    """Get resources required by a node of the template
+
+    :type node: dict
+        :rtype : dict
+    """
+    params = node.get('params', {})
+    return {
+        'memory': params.get('memory', 1024),
+        'vcpu': params.get('vcpu', 1),
+        'disk': sum(volume.get('capacity') or 0
+                    for volume in params.get('volumes', [])),
+    }
+
+
+def get_host_name(hosts, idx):
+    return hosts[idx].get('name') or 'host{0}'.format(idx + 1)
+
+
+def detect_capacity(hosts, driver_name, driver_params=None):
+    """Fill missing capacities of hosts by the driver
+
+    :type hosts: list
+    :type driver_name: str
+    :type driver_params: dict
+        :rtype : list
+    """
+    result = []
+    for host in hosts:
+        host = dict(host)
+        if any(host.get(resource) is None for resource in RESOURCES):
+            driver_cls = loader.load_class('{0}:Driver'.format(driver_name))
+            params = dict(driver_params or {})
+            params['connection_string'] = host['connection_string']
+            driver = driver_cls(name=driver_name, **params)
+            capacity = driver.get_host_capacity() or {}
+            for resource in RESOURCES:
+                if host.get(resource) is None:
+                    host[resource] = capacity.get(resource)
+        result.append(host)
+    return result
+
+
+def schedule_nodes(nodes, hosts, free=None):
+    """Assign nodes to hosts with first fit decreasing bin packing
+
+    Nodes are sorted by required memory, vcpus and disk, then each node
+    is placed on the first host which has enough of the remaining
+    resources. Resources with capacity None are not limited.
+
+    :type nodes: list
+    :type hosts: list
+    :param free: remaining resources of hosts, updated by scheduled
+        nodes, capacities of hosts are used if not given
+        :rtype : list of lists of nodes for every host
+    """
+    if free is None:
+        free = [{resource: host.get(resource) for resource in RESOURCES}
+                for host in hosts]
+    placement = [[] for _ in hosts]
+
+    def fits(requirements, capacity):
+        return all(capacity[resource] is None or
+                   capacity[resource] >= requirements[resource]
+                   for resource in RESOURCES)
+
+    requirements = [(get_node_requirements(node), node) for node in nodes]
+    requirements.sort(
+        key=lambda item: tuple(item[0][resource] for resource in RESOURCES),
+        reverse=True)
+    for required, node in requirements:
+        for idx, capacity in enumerate(free):
+            if fits(required, capacity):
+                break
+        else:
+            raise DevopsError(
+                "No host has enough resources for node '{0}': {1}".format(
+                    node['name'], required))
+        for resource in RESOURCES:
+            if capacity[resource] is not None:
+                capacity[resource] -= required[resource]
+        placement[idx].append(node)
+        logger.debug("Node '{0}' is scheduled to host '{1}'".format(
+            node['name'], get_host_name(hosts, idx)))
+
+    # keep the order of nodes from the template
+    order = {id(node): pos for pos, node in enumerate(nodes)}
+    for host_nodes in placement:
+        host_nodes.sort(key=lambda node: order[id(node)])
+    return placement
+
+
+def _get_uplink(uplinks, hosts, idx, host_group):
+    """Get name of the uplink bridge of the host, create it if missing"""
+    if idx not in uplinks:
+        if not hosts[idx].get('uplink'):
+            raise DevopsError(
+                "Host '{0}' has no 'uplink' interface to connect networks "
+                "with other hosts".format(get_host_name(hosts, idx)))
+        name = 'uplink_{0}'.format(get_host_name(hosts, idx))
+        host_group['l2_network_devices'][name] = {
+            'vlan_ifaces': [],
+            'parent_iface': {'phys_dev': hosts[idx]['uplink']},
+        }
+        uplinks[idx] = (host_group, name)
+    return uplinks[idx]
+
+
+def distribute_config(full_config, hosts, vlan_start=1000):
+    """Distribute nodes of the template across hosts
+
+    :param full_config: template as returned by get_devops_config()
+    :param hosts: list of hosts, see the module description
+    :param vlan_start: first VLAN tag used to connect networks of hosts
+        :rtype : dict
+    """
+    full_config = deepcopy(full_config)
+    config = full_config['template']['devops_settings']
+    uplinks = {}
+    vlan = vlan_start
+    groups = []
+    free = None
+
+    for group in config['groups']:
+        driver = group['driver']
+        driver_params = driver.get('params', {})
+        if free is None:
+            # all groups share the resources of the hosts
+            free = [{resource: host.get(resource) for resource in RESOURCES}
+                    for host in detect_capacity(hosts, driver['name'],
+                                                driver_params)]
+        placement = schedule_nodes(group.get('nodes', []), hosts, free)
+        used = [idx for idx, nodes in enumerate(placement) if nodes]
+        primary = used[0] if used else 0
+
+        host_groups = {}
+        for idx in used or [primary]:
+            host_group = deepcopy(group)
+            host_group['nodes'] = placement[idx]
+            host_group['driver']['params'] = dict(
+                driver_params,
+                connection_string=hosts[idx]['connection_string'])
+            host_group.setdefault('l2_network_devices', {})
+            if idx != primary:
+                host_group['name'] = '{0}_{1}'.format(
+                    group['name'], get_host_name(hosts, idx))
+                host_group['l2_network_devices'] = {}
+            host_groups[idx] = host_group
+            groups.append(host_group)
+
+        l2_devices = group.get('l2_network_devices', {})
+        for name in sorted(l2_devices):
+            remote = [idx for idx in used if idx != primary and any(
+                iface.get('l2_network_device') == name
+                for node in placement[idx]
+                for iface in node.get('params', {}).get('interfaces', []))]
+            if not remote:
+                continue
+            device = host_groups[primary]['l2_network_devices'][name]
+            if device.get('parent_iface') or device.get('vlan_ifaces'):
+                raise DevopsError(
+                    "l2 network device '{0}' is already connected to an "
+                    "interface of the host and can not be shared between "
+                    "hosts".format(name))
+
+            for idx in [primary] + remote:
+                host_group = host_groups[idx]
+                uplink_group, uplink = _get_uplink(
+                    uplinks, hosts, idx, host_group)
+                uplink_group['l2_network_devices'][uplink][
+                    'vlan_ifaces'].append(vlan)
+                parent_iface = {'l2_net_dev': uplink, 'tag': vlan}
+                if idx == primary:
+                    device['parent_iface'] = parent_iface
+                    continue
+
+                replica_name = '{0}_{1}'.format(
+                    name, get_host_name(hosts, idx))
+                replica = {'replica_of': name, 'parent_iface': parent_iface}
+                if 'address_pool' in device:
+                    replica['address_pool'] = device['address_pool']
+                host_group['l2_network_devices'][replica_name] = replica
+                for node in host_group['nodes']:
+                    for iface in node.get('params', {}).get('interfaces',
+                                                            []):
+                        if iface.get('l2_network_device') == name:
+                            iface['l2_network_device'] = replica_name
+            vlan += 1
+
+    config['groups'] = groups
+    return full_config
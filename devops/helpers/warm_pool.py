@@ -0,0 +1,309 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Pools of environments kept ready in the state of a snapshot
+
+A pool keeps 'size' clones of the source environment which are reverted
+to the snapshot, resumed and have synchronized time, so a CI job gets a
+ready environment at once. Every clone gets its own snapshot with the
+name of the source snapshot when it is created, new and returned clones
+are reverted to it by the maintainer in the background.
+
+State of a pool is a JSON file in settings.WARM_POOLS_DIR which is
+changed under a file lock, so leases are atomic between processes:
+
+.. code-block:: yaml
+
+    source: myenv           # environment to clone
+    snapshot: deployed      # snapshot to clone and to revert to
+    size: 3
+    timesync: true          # synchronize time after resume
+    max_lease: 14400        # seconds, leases are recycled after it
+    generation: 1           # increased when source or snapshot is changed
+    members:
+      pool-1: {state: ready, since: 1480000000.0, owner: null, ...}
+
+Members are 'preparing' (created or recycled by the process 'pid'),
+'ready', 'leased' (by 'owner'), 'dirty' (released) or 'broken' (will be
+erased and created again).
+"""
+
+from contextlib import contextmanager
+import errno
+import json
+import os
+import time
+
+from django.db import connection
+
+from devops.error import DevopsError
+from devops.error import DevopsObjNotFound
+from devops.helpers.helpers import file_lock
+from devops.helpers.helpers import run_parallel
+from devops.helpers.ntp import sync_time
+from devops import logger
+from devops.models import Environment
+from devops import settings
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class WarmPool(object):
+    """Pool of environments in the state of a snapshot
+
+    :param name: name of the pool, also the prefix of its environments
+    :param pools_dir: directory of state files, settings.WARM_POOLS_DIR
+        if None
+    """
+
+    def __init__(self, name, pools_dir=None):
+        self.name = name
+        self.path = os.path.join(pools_dir or settings.WARM_POOLS_DIR,
+                                 '{0}.json'.format(name))
+
+    @contextmanager
+    def _state(self, required=True):
+        with file_lock(self.path + '.lock'):
+            state = None
+            if os.path.isfile(self.path):
+                with open(self.path) as state_file:
+                    state = json.load(state_file)
+            elif required:
+                raise DevopsError(
+                    "Pool {0} is not configured, use 'dos.py pool-fill' "
+                    "with --source and --snapshot".format(self.name))
+            state = state or {}
+            yield state
+            with open(self.path + '.tmp', 'w') as state_file:
+                json.dump(state, state_file, indent=2, sort_keys=True)
+            os.rename(self.path + '.tmp', self.path)
+
+    def configure(self, source=None, snapshot=None, size=None,
+                  timesync=None, max_lease=None):
+        """Create the pool or change its parameters, None keeps them
+
+        Members of the previous source or snapshot are replaced, leased
+        ones when they are released.
+
+        :type source: str
+        :type snapshot: str
+        :type size: int
+        :type timesync: bool
+        :param max_lease: seconds, 0 means no limit
+        """
+        with self._state(required=False) as state:
+            if not state:
+                if source is None or snapshot is None:
+                    raise DevopsError(
+                        'Source environment and snapshot are required for '
+                        'the new pool {0}'.format(self.name))
+                state.update(size=1, timesync=True, max_lease=0,
+                             generation=0, members={})
+            if ((source or state.get('source')) != state.get('source') or
+                    (snapshot or state.get('snapshot')) !=
+                    state.get('snapshot')):
+                state['generation'] += 1
+            for key, value in (('source', source), ('snapshot', snapshot),
+                               ('size', size), ('timesync', timesync),
+                               ('max_lease', max_lease)):
+                if value is not None:
+                    state[key] = value
+
+    def get_members(self):
+        """Get members of the pool
+
+        :rtype : dict of member states by environment name
+        """
+        with self._state() as state:
+            return state['members']
+
+    def lease(self, owner=None, timeout=0, interval=5):
+        """Take a ready environment of the pool
+
+        The environment which is ready for the longest time is taken.
+
+        :param owner: free-form description of the job
+        :param timeout: seconds to wait for a ready environment
+        :type interval: int
+            :rtype : str
+        """
+        deadline = time.time() + timeout
+        while True:
+            with self._state() as state:
+                ready = sorted(
+                    (member['since'], name)
+                    for name, member in state['members'].items()
+                    if member['state'] == 'ready')
+                if ready:
+                    name = ready[0][1]
+                    state['members'][name].update(
+                        state='leased', since=time.time(), owner=owner)
+                    logger.info('Environment {0} of pool {1} is leased'
+                                .format(name, self.name))
+                    return name
+            if time.time() >= deadline:
+                raise DevopsError('Pool {0} has no ready environments'.format(
+                    self.name))
+            time.sleep(interval)
+
+    def release(self, name):
+        """Return the leased environment, it is recycled by maintain()
+
+        :type name: str
+        """
+        with self._state() as state:
+            member = state['members'].get(name)
+            if member is None or member['state'] != 'leased':
+                raise DevopsError(
+                    'Environment {0} is not leased from pool {1}'.format(
+                        name, self.name))
+            member.update(state='dirty', since=time.time(), owner=None)
+
+    def _update_members(self, state):
+        """Find members to create, recycle and erase
+
+        Selected members are marked as 'preparing' by this process.
+
+        :rtype : list of (name, action) where action is 'create',
+            'recycle' or 'erase'
+        """
+        now = time.time()
+        members = state['members']
+        for name, member in sorted(members.items()):
+            if (member['state'] == 'preparing' and
+                    not _is_alive(member['pid'])):
+                logger.warning('Preparation of {0} was interrupted'.format(
+                    name))
+                member['state'] = 'broken'
+            elif (member['state'] == 'leased' and state['max_lease'] and
+                    now - member['since'] > state['max_lease']):
+                logger.warning('Lease of {0} by {1} is expired'.format(
+                    name, member['owner']))
+                member['state'] = 'dirty'
+            if (member['generation'] != state['generation'] and
+                    member['state'] in ('ready', 'dirty')):
+                member['state'] = 'broken'
+
+        jobs = []
+        # Leased members of the previous generation are replaced already
+        kept = [name for name, member in sorted(members.items())
+                if member['state'] != 'broken' and
+                member['generation'] == state['generation']]
+        # Excess members which are not used are removed, ready ones last
+        excess = len(kept) - state['size']
+        for name in sorted(kept, key=lambda name: members[name]['state'] ==
+                           'ready'):
+            if excess <= 0:
+                break
+            if members[name]['state'] in ('ready', 'dirty'):
+                members[name]['state'] = 'broken'
+                kept.remove(name)
+                excess -= 1
+
+        for name, member in sorted(members.items()):
+            if member['state'] == 'broken':
+                jobs.append((name, 'erase'))
+            elif member['state'] == 'dirty':
+                jobs.append((name, 'recycle'))
+
+        index = 1
+        for _ in range(state['size'] - len(kept)):
+            while '{0}-{1}'.format(self.name, index) in members:
+                index += 1
+            name = '{0}-{1}'.format(self.name, index)
+            members[name] = dict(generation=state['generation'], owner=None)
+            jobs.append((name, 'create'))
+
+        for name, action in jobs:
+            members[name].update(state='preparing', since=now,
+                                 pid=os.getpid(), action=action)
+        return jobs
+
+    def _sync_time(self, env, state):
+        if state['timesync']:
+            sync_time(env, [node.name for node in env.get_nodes()])
+
+    def _prepare(self, name, action, state):
+        """Create, recycle or erase the member, outside of the lock"""
+        if action == 'erase':
+            try:
+                Environment.get(name=name).erase()
+            except DevopsObjNotFound:
+                pass
+            return
+
+        if action == 'create':
+            # The environment can be left by an interrupted preparation
+            try:
+                Environment.get(name=name).erase()
+            except DevopsObjNotFound:
+                pass
+            source = Environment.get(name=state['source'])
+            env = source.clone(name, snapshot=state['snapshot'], start=True)
+            self._sync_time(env, state)
+            env.snapshot(state['snapshot'])
+        else:
+            env = Environment.get(name=name)
+
+        # A new clone is booted from the disks of the snapshot, so it is
+        # reverted to its own snapshot like the recycled ones
+        env.revert(state['snapshot'], flag=False, resume=True)
+        self._sync_time(env, state)
+
+    def maintain(self, threads=None):
+        """Recycle released environments and create missing ones
+
+        Environments are prepared in parallel, the call returns when
+        all of them are ready or broken.
+
+        :type threads: int
+            :rtype : list of (name, action) which were done
+        """
+        with self._state() as state:
+            jobs = self._update_members(state)
+            state = dict(state, members=None)
+
+        def prepare(job):
+            name, action = job
+            logger.info('{0} environment {1} of pool {2}'.format(
+                action.capitalize(), name, self.name))
+            try:
+                self._prepare(name, action, state)
+                result = 'ready'
+            except Exception as e:
+                logger.error('Cannot {0} environment {1}: {2}'.format(
+                    action, name, e))
+                result = 'broken'
+            finally:
+                # every thread has its own database connection
+                connection.close()
+            with self._state() as current:
+                members = current['members']
+                if action == 'erase' and result == 'ready':
+                    del members[name]
+                else:
+                    members[name].update(
+                        state='broken' if action == 'erase' else result,
+                        since=time.time(), pid=None)
+            return result
+
+        results = run_parallel(prepare, jobs, threads)
+        return [job for job, result in zip(jobs, results)
+                if result == 'ready']
@@ -14,6 +14,7 @@
 
 from django.db import models
 
+from devops.error import DevopsNotImplementedError
 from devops.helpers import loader
 from devops.models.base import BaseModel
 from devops.models.base import ParamedModel
@@ -41,3 +42,92 @@ class Driver(ParamedModel, BaseModel):
 
     def get_allocated_networks(self):
         return []
+
+    def load_inventory(self, nodes, details=()):
+        """Cache the state of nodes for a series of read-only queries"""
+        pass
+
+    def clear_inventory(self):
+        pass
+
+    def get_inventory(self, uuid_string):
+        return None
+
+    def erase_group(self, group):
+        """Remove nodes, volumes and networks of the group from the host
+
+        Records of the group can be left, they are deleted by the caller.
+
+        :type group: Group
+        """
+        for node in group.get_nodes():
+            node.erase()
+        for l2_network_device in group.get_l2_network_devices():
+            l2_network_device.erase()
+
+    def get_drift(self, groups):
+        """Compare objects of the host with records of the groups
+
+        :param groups: groups of all environments in the database
+            :rtype : list of dicts, see devops.helpers.reconcile
+        """
+        return []
+
+    def repair_drift(self, item):
+        """Repair an object of the host found by get_drift()"""
+        raise DevopsNotImplementedError(
+            'Reconciliation is not supported by {0}'.format(self.name))
+
+    def update_filters(self, block=(), unblock=(), states=None):
+        """Block and unblock traffic of many interfaces and networks
+
+        :param block: Interface and L2NetworkDevice objects
+        :param unblock: Interface and L2NetworkDevice objects
+        :param states: view of states of the traffic, if supported
+            :rtype : list of interfaces and networks with changed state
+        """
+        for item in block:
+            item.block()
+        for item in unblock:
+            item.unblock()
+        return list(block) + list(unblock)
+
+    def get_stats_collector(self, nodes, interval=5, history=60):
+        """Get collector of resource usage of nodes, if supported"""
+        return None
+
+    def get_resources_report(self, nodes):
+        """Compare resources required by nodes with free resources
+
+        :rtype : list of dicts with 'host', 'resource', 'unit',
+            'required', 'available', 'hard' (False if the resource can
+            be overcommitted) and 'status' which is one of 'ok',
+            'warning' or 'insufficient'
+        """
+        return []
+
+    def get_host_capacity(self):
+        """Get resources of the host for scheduling of nodes, if supported
+
+        :rtype : dict with 'memory' (MiB), 'vcpu' and 'disk' (GiB)
+        """
+        return None
+
+    def get_garbage(self, known_volumes, env_nodes, min_age=3600):
+        """Find volumes which are left by erased snapshots and nodes
+
+        :rtype : list of dicts with 'type', 'path' and 'size' (bytes)
+        """
+        return []
+
+    def get_snapshot_memory_files(self):
+        """Get memory state files used by snapshots on the host
+
+        :rtype : set
+        """
+        return set()
+
+    def remove_garbage(self, item):
+        """Remove an item found by get_garbage()"""
+        raise DevopsNotImplementedError(
+            'Garbage collection is not supported by {0}'.format(self.name))
@@ -12,12 +12,15 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from contextlib import contextmanager
 import time
 from warnings import warn
 
 from django.conf import settings
+from django.db import connection
 from django.db import IntegrityError
 from django.db import models
+from netaddr import IPAddress
 from netaddr import IPNetwork
 from paramiko import Agent
 from paramiko import RSAKey
@@ -25,7 +28,11 @@ from paramiko import RSAKey
 from devops.error import DevopsEnvironmentError
 from devops.error import DevopsError
 from devops.error import DevopsObjNotFound
+from devops.error import DevopsResourcesError
+from devops.helpers.helpers import run_parallel
 from devops.helpers.network import IpNetworksPool
+from devops.helpers.reconcile import find_drift
+from devops.helpers.reconcile import repair_drift
 from devops.helpers.ssh_client import SSHClient
 from devops.helpers.templates import create_devops_config
 from devops.helpers.templates import get_devops_config
@@ -36,6 +43,7 @@ from devops.models.group import Group
 from devops.models.network import AddressPool
 from devops.models.network import L2NetworkDevice
 from devops.models.node import Node
+from devops.models.volume import DiskDevice
 
 
 class Environment(BaseModel):
@@ -160,32 +168,154 @@ class Environment(BaseModel):
     def list_all(cls):
         return cls.objects.all()
 
+    @contextmanager
+    def inventory(self, details=()):
+        """Query state of all nodes in bulk for the duration of the block
+
+        Node properties like get_vnc_port(), is_active() and
+        has_snapshot() read the cached state instead of querying the
+        driver for every node, so the block should not change the nodes.
+        Only the state is queried by default, details which need a query
+        per node are listed in details: 'devices' for get_vnc_port() and
+        'snapshots' for has_snapshot().
+
+        :type details: tuple
+        """
+        groups = self.get_groups()
+        for group in groups:
+            group.driver.load_inventory(group.get_nodes(), details=details)
+        try:
+            yield
+        finally:
+            for group in groups:
+                group.driver.clear_inventory()
+
     # LEGACY
     def has_snapshot(self, name):
-        if self.get_nodes():
-            return all(n.has_snapshot(name) for n in self.get_nodes())
+        nodes = self.get_nodes()
+        if nodes:
+            with self.inventory(details=('snapshots',)):
+                return all(n.has_snapshot(name) for n in nodes)
         else:
             return False
 
-    def define(self):
-        for group in self.get_groups():
-            group.define_networks()
-        for group in self.get_groups():
-            group.define_nodes()
+    def _for_groups(self, func, parallel=False):
+        """Call the function for every group
 
-    def start(self, nodes=None):
-        for group in self.get_groups():
-            group.start_networks()
+        Groups are usually placed on different hosts, so with 'parallel'
+        every group is processed in its own thread.
+        """
+        groups = list(self.get_groups())
+        if not parallel:
+            for group in groups:
+                func(group)
+            return
+
+        def call(group):
+            try:
+                func(group)
+            finally:
+                # every thread has its own database connection
+                connection.close()
+
+        run_parallel(call, groups)
+
+    def get_resources_report(self):
+        """Compare resources required by the environment with the hosts
+
+        Groups on the same host compete for its free resources, so their
+        requirements are summed.
+
+        :rtype : list
+        """
+        rows = {}
         for group in self.get_groups():
-            group.start_nodes(nodes)
+            for row in group.driver.get_resources_report(group.get_nodes()):
+                key = (row['host'], row['resource'], row['unit'])
+                if key not in rows:
+                    rows[key] = row
+                    continue
+                total = rows[key]
+                total['required'] += row['required']
+                total['available'] = min(total['available'],
+                                         row['available'])
+                total['hard'] = total['hard'] or row['hard']
+                if total['required'] <= total['available']:
+                    total['status'] = 'ok'
+                else:
+                    total['status'] = ('insufficient' if total['hard']
+                                       else 'warning')
+        return [rows[key] for key in sorted(rows)]
+
+    def check_resources(self, timeout=0, interval=30):
+        """Check that the hosts have enough free resources
+
+        If the resources are insufficient, they are waited for up to
+        'timeout' seconds, for example until other environments are
+        erased or destroyed.
+
+        :type timeout: int
+        :type interval: int
+            :rtype : list
+        """
+        deadline = time.time() + timeout
+        while True:
+            report = self.get_resources_report()
+            insufficient = [row for row in report
+                            if row['status'] == 'insufficient']
+            if not insufficient:
+                break
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise DevopsResourcesError(self.name, insufficient)
+            logger.info(
+                "Not enough resources for environment '{0}', waiting "
+                "{1:.0f}s more".format(self.name, remaining))
+            time.sleep(min(interval, remaining))
+
+        for row in report:
+            if row['status'] == 'warning':
+                logger.warning(
+                    "{host}: {resource} of environment are overcommitted, "
+                    "required {required} {unit}, available {available} "
+                    "{unit}".format(**row))
+        return report
+
+    def define(self, parallel=False):
+        if settings.ADMISSION_CONTROL:
+            self.check_resources(timeout=settings.ADMISSION_TIMEOUT)
+        self._for_groups(lambda group: group.define_networks(), parallel)
+        self._for_groups(lambda group: group.define_nodes(), parallel)
+
+    def start(self, nodes=None, parallel=False):
+        def start_nodes(group):
+            group_nodes = None
+            if nodes:
+                group_nodes = [node for node in nodes
+                               if node.group_id == group.pk]
+                if not group_nodes:
+                    return
+            group.start_nodes(group_nodes)
+
+        self._for_groups(lambda group: group.start_networks(), parallel)
+        self._for_groups(start_nodes, parallel)
 
     def destroy(self):
         for group in self.get_groups():
             group.destroy()
 
     def erase(self):
-        for group in self.get_groups():
-            group.erase()
+        """Remove objects of all groups from the hosts and delete records
+
+        Records of the environment are deleted by a cascading delete.
+        The environment is not erased while its clones exist, see
+        clone().
+        """
+        groups = list(self.get_groups())
+        for group in groups:
+            group.check_clones()
+        for group in groups:
+            group.driver.erase_group(group)
         self.delete()
 
     def suspend(self, **kwargs):
@@ -203,46 +333,166 @@ class Environment(BaseModel):
             node.snapshot(name=name, description=description, force=force,
                           external=settings.SNAPSHOTS_EXTERNAL)
 
-    def revert(self, name=None, flag=True):
+    def revert(self, name=None, flag=True, resume=None):
+        """Revert all nodes to the snapshot
+
+        :param flag: check that all nodes have the snapshot
+        :param resume: True to leave nodes running, False to leave them
+            paused, None to keep the state of the snapshot
+        """
         if flag and not self.has_snapshot(name):
             raise Exception("some nodes miss snapshot,"
                             " test should be interrupted")
         for node in self.get_nodes():
-            node.revert(name)
+            node.revert(name, resume=resume)
 
         for group in self.get_groups():
-            for l2netdev in group.get_l2_network_devices():
-                l2netdev.unblock()
+            group.driver.update_filters(
+                unblock=group.get_l2_network_devices())
+
+    def clone(self, new_name, snapshot=None, start=True):
+        """Create a copy of the environment from the snapshot
+
+        The copy gets its own address pools (of the same size, with the
+        same relative reserved IPs and ranges), MAC addresses, networks
+        and domains. Volumes of the copy are thin overlays over the disks
+        of the source environment in the state of the snapshot, so the
+        source environment can't be erased while the copy exists.
+
+        :param new_name: name of the new environment
+        :param snapshot: name of the snapshot, current snapshot of each
+                         node is used if None
+        :param start: start the new environment
+        :rtype: Environment
+        """
+        clone = self.create(new_name)
+        try:
+            self._clone_objects(clone, snapshot)
+            clone.define()
+        except Exception:
+            logger.error('Cloning of {0} to {1} failed'.format(
+                self.name, new_name))
+            clone.erase()
+            raise
+
+        if start:
+            clone.start()
+        return clone
+
+    def _clone_objects(self, clone, snapshot):
+        def relative(ip_network, ip):
+            # Keep addresses inside of the pool relative to the pool start
+            if IPAddress(ip) in ip_network:
+                return int(IPAddress(ip)) - ip_network.first
+            return ip
+
+        for pool in self.get_address_pools():
+            ip_network = pool.ip_network
+            supernet = ip_network.supernet(
+                max(ip_network.prefixlen - 8, 8)) or [ip_network.cidr]
+            params = {key: value for key, value in pool.params.items()
+                      if key not in ('ip_reserved', 'ip_ranges')}
+            clone.add_address_pool(
+                name=pool.name,
+                net='{0}:{1}'.format(supernet[0], ip_network.prefixlen),
+                ip_reserved={
+                    name: relative(ip_network, ip)
+                    for name, ip in pool.ip_reserved.items()},
+                ip_ranges={
+                    name: [relative(ip_network, ip) for ip in ip_range]
+                    for name, ip_range in pool.ip_ranges.items()},
+                **params)
+
+        for group in self.get_groups():
+            clone_group = clone.add_group(
+                group_name=group.name,
+                driver_name=group.driver.name,
+                **group.driver.params)
+
+            for l2_network_device in group.get_l2_network_devices():
+                params = {key: value for key, value
+                          in l2_network_device.params.items()
+                          if key != 'uuid'}
+                if l2_network_device.address_pool is not None:
+                    params['address_pool'] = (
+                        l2_network_device.address_pool.name)
+                clone_group.add_l2_network_device(
+                    name=l2_network_device.name, **params)
+
+            clone_group.add_network_pools({
+                network_pool.name: network_pool.address_pool.name
+                for network_pool in group.get_network_pools()})
+
+        for group in self.get_groups():
+            clone_group = clone.get_group(name=group.name)
+            for node in group.get_nodes():
+                self._clone_node(node, clone_group, snapshot)
+
+    @staticmethod
+    def _clone_node(node, clone_group, snapshot):
+        snapshot_volumes = node.get_snapshot_volumes(snapshot)
+        params = {key: value for key, value in node.params.items()
+                  if key not in node.instance_params}
+        clone_node = clone_group.add_node(
+            name=node.name, role=node.role, **params)
+
+        for interface in node.interfaces:
+            l2_network_device_name = None
+            if interface.l2_network_device is not None:
+                l2_network_device_name = interface.l2_network_device.name
+            clone_node.add_interface(
+                label=interface.label,
+                l2_network_device_name=l2_network_device_name,
+                interface_model=interface.model,
+                **interface.params)
+
+        for network_config in node.network_configs:
+            clone_node.add_network_config(
+                label=network_config.label,
+                networks=network_config.networks,
+                aggregation=network_config.aggregation,
+                parents=network_config.parents)
+
+        volume_cls = clone_node.driver.get_model_class('Volume')
+        for disk in node.disk_devices:
+            # Volumes of snapshots are named after the first volume
+            # in the chain
+            volume = disk.volume
+            while volume.backing_store is not None:
+                volume = volume.backing_store
+
+            # Read-only devices like CD-ROMs are not a part of snapshots
+            base_image = snapshot_volumes.get(
+                disk.target_dev, disk.volume.get_path())
+            clone_volume = volume_cls.objects.create(
+                node=clone_node,
+                name=volume.name,
+                capacity=disk.volume.capacity,
+                format='qcow2',
+                base_image=base_image)
+            DiskDevice.node_attach_volume(
+                node=clone_node,
+                volume=clone_volume,
+                device=disk.device,
+                vol_type=disk.type,
+                bus=disk.bus,
+                target_dev=disk.target_dev)
 
     # TO REWRITE FOR LIBVIRT DRIVER ONLY
     @classmethod
     def synchronize_all(cls):
-        driver = cls.get_driver()
-        nodes = {driver._get_name(e.name, n.name): n
-                 for e in cls.list_all()
-                 for n in e.get_nodes()}
-        domains = set(driver.node_list())
-
-        # FIXME (AWoodward) This willy nilly wacks domains when you run this
-        #  on domains that are outside the scope of devops, if anything this
-        #  should cause domains to be imported into db instead of undefined.
-        #  It also leaves network and volumes around too
-        #  Disabled until a safer implementation arrives
-
-        # Undefine domains without devops nodes
-        #
-        # domains_to_undefine = domains - set(nodes.keys())
-        # for d in domains_to_undefine:
-        #    driver.node_undefine_by_name(d)
-
-        # Remove devops nodes without domains
-        nodes_to_remove = set(nodes.keys()) - domains
-        for n in nodes_to_remove:
-            nodes[n].delete()
+        """Delete nodes whose domains are removed from the hosts
+
+        Environments left without nodes are erased. Objects of the hosts
+        are not removed, 'dos.py reconcile --repair' does that.
+        """
+        drift = [item for item in find_drift(Group.list_all())
+                 if item['kind'] == 'missing' and item['object'] == 'domain']
+        removed = repair_drift(drift)
         cls.erase_empty()
 
-        logger.info('Undefined domains: {0}, removed nodes: {1}'.format(
-            0, len(nodes_to_remove)
+        logger.info('Missing domains: {0}, removed nodes: {1}'.format(
+            len(drift), len(removed)
         ))
 
     # LEGACY
@@ -478,7 +728,9 @@ class Environment(BaseModel):
     def get_networks(self, **kwargs):
         l2_network_devices = self.get_env_l2_network_devices(
             address_pool__isnull=False, **kwargs)
-        return [self._create_network_object(x) for x in l2_network_devices]
+        # Replicas on other hosts share the address pool of the device
+        return [self._create_network_object(x) for x in l2_network_devices
+                if not x.params.get('replica_of')]
 
     # LEGACY, for fuel-qa compatibility
     def get_node(self, *args, **kwargs):
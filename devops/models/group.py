@@ -16,12 +16,16 @@ from copy import deepcopy
 
 from django.db import models
 
+from devops.error import DevopsError
 from devops.error import DevopsObjNotFound
+from devops.helpers.reconcile import find_drift
+from devops.helpers.reconcile import repair_drift
 from devops import logger
 from devops.models.base import BaseModel
 from devops.models.network import L2NetworkDevice
 from devops.models.network import NetworkPool
 from devops.models.node import Node
+from devops.models.volume import Volume
 
 
 class Group(BaseModel):
@@ -109,12 +113,36 @@ class Group(BaseModel):
         for node in self.get_nodes():
             node.destroy()
 
-    def erase(self):
-        for node in self.get_nodes():
-            node.erase()
+    def get_clones(self):
+        """Get environments with volumes over the volumes of the group
 
-        for l2_network_device in self.get_l2_network_devices():
-            l2_network_device.erase()
+        Volumes of a copy made by Environment.clone() are overlays over
+        the volumes of the source environment.
+
+        :rtype : set of names of environments
+        """
+        keys = set(getattr(volume, 'uuid', None) for volume in
+                   Volume.objects.filter(node__group=self))
+        keys.discard(None)
+        return set(
+            volume.node.group.environment.name
+            for volume in Volume.objects.filter(
+                node__isnull=False).exclude(node__group=self).select_related(
+                'node__group__environment')
+            if getattr(volume, 'base_image', None) in keys)
+
+    def check_clones(self):
+        """Refuse to erase the group while it has clones"""
+        clones = self.get_clones()
+        if clones:
+            raise DevopsError(
+                'Volumes of group {0} are backing stores of environments '
+                '{1}, erase them first'.format(
+                    self.name, ', '.join(sorted(clones))))
+
+    def erase(self):
+        self.check_clones()
+        self.driver.erase_group(self)
         self.delete()
 
     @classmethod
@@ -123,35 +151,19 @@ class Group(BaseModel):
             if env.get_nodes().count() == 0:
                 env.erase()
 
-    # TO REWRITE FOR LIBVIRT DRIVER
     @classmethod
     def synchronize_all(cls):
-        driver = cls.get_driver()
-        nodes = {driver._get_name(e.name, n.name): n
-                 for e in cls.list_all()
-                 for n in e.get_nodes()}
-        domains = set(driver.node_list())
-
-        # FIXME (AWoodward) This willy nilly wacks domains when you run this
-        #  on domains that are outside the scope of devops, if anything this
-        #  should cause domains to be imported into db instead of undefined.
-        #  It also leaves network and volumes around too
-        #  Disabled untill a safer implmentation arrives
-
-        # Undefine domains without devops nodes
-        #
-        # domains_to_undefine = domains - set(nodes.keys())
-        # for d in domains_to_undefine:
-        #    driver.node_undefine_by_name(d)
-
-        # Remove devops nodes without domains
-        nodes_to_remove = set(nodes.keys()) - domains
-        for n in nodes_to_remove:
-            nodes[n].delete()
+        """Delete nodes whose domains are removed from the hosts
+
+        Groups left without nodes are erased.
+        """
+        drift = [item for item in find_drift(cls.list_all())
+                 if item['kind'] == 'missing' and item['object'] == 'domain']
+        removed = repair_drift(drift)
         cls.erase_empty()
 
-        logger.info('Undefined domains: {0}, removed nodes: {1}'.format(
-            0, len(nodes_to_remove)
+        logger.info('Missing domains: {0}, removed nodes: {1}'.format(
+            len(drift), len(removed)
         ))
 
     def add_l2_network_devices(self, l2_network_devices):
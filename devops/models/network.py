@@ -533,7 +533,8 @@ class Interface(ParamedModel):
 
     @classmethod
     def interface_create(cls, l2_network_device, node, label,
-                         if_type='network', mac_address=None, model='virtio'):
+                         if_type='network', mac_address=None, model='virtio',
+                         **params):
         """Create interface
 
         :rtype : Interface
@@ -544,7 +545,8 @@ class Interface(ParamedModel):
             label=label,
             type=if_type,
             mac_address=mac_address or generate_mac(),
-            model=model)
+            model=model,
+            **params)
         if (interface.l2_network_device and
                 interface.l2_network_device.address_pool is not None):
             interface.add_address()
@@ -17,8 +17,10 @@ from django.db import models
 from django.utils.functional import cached_property
 
 from devops.error import DevopsError
+from devops.error import DevopsNotImplementedError
 from devops.error import DevopsObjNotFound
 from devops.helpers.helpers import tcp_ping_
+from devops.helpers.helpers import wait
 from devops.helpers.helpers import wait_pass
 from devops.helpers.helpers import wait_ssh_cmd
 from devops.helpers.helpers import wait_tcp
@@ -49,6 +51,10 @@ class Node(ParamedModel, BaseModel):
     deploy_timeout = ParamField(default=3600)
     deploy_check_cmd = ParamField()
 
+    # Params with the state of the node on the host, which are not copied
+    # by Environment.clone()
+    instance_params = ()
+
     @property
     def driver(self):
         drv = self.group.driver
@@ -99,6 +105,23 @@ class Node(ParamedModel, BaseModel):
     def revert(self, *args, **kwargs):
         pass
 
+    def get_state(self):
+        """Get power state of node: 'running', 'paused' or 'shutoff'
+
+        :rtype : str
+        """
+        return 'running' if self.is_active() else 'shutoff'
+
+    def wait_for_state(self, state, timeout=60):
+        """Wait until node reaches the power state
+
+        :type state: str
+        :type timeout: int
+        """
+        wait(lambda: self.get_state() == state, interval=1, timeout=timeout,
+             timeout_msg='Node {0} has not reached state {1!r}'.format(
+                 self.name, state))
+
     # for fuel-qa compatibility
     def has_snapshot(self, *args, **kwargs):
         return True
@@ -108,6 +131,22 @@ class Node(ParamedModel, BaseModel):
         """Return full snapshots objects"""
         return []
 
+    def get_snapshot_volumes(self, name=None):
+        """Return paths of the volumes with disks state of the snapshot"""
+        raise DevopsNotImplementedError(
+            'Volumes of snapshots are not supported by {0}'.format(
+                self.driver.name))
+
+    def get_chain_depth(self, name=None):
+        """Return number of backing volumes of the deepest disk"""
+        return 0
+
+    def flatten(self, max_depth=None):
+        """Collapse backing chains of disks deeper than max_depth"""
+        raise DevopsNotImplementedError(
+            'Flattening of disks is not supported by {0}'.format(
+                self.driver.name))
+
     @property
     def disk_devices(self):
         return self.diskdevice_set.all()
@@ -189,15 +228,19 @@ class Node(ParamedModel, BaseModel):
             l2_network_device_name = interface.get('l2_network_device')
             interface_model = interface.get('interface_model', 'virtio')
             mac_address = interface.get('mac_address')
+            params = {}
+            if 'net_driver' in interface:
+                params['net_driver'] = interface['net_driver']
             self.add_interface(
                 label=label,
                 l2_network_device_name=l2_network_device_name,
                 mac_address=mac_address,
-                interface_model=interface_model)
+                interface_model=interface_model,
+                **params)
 
     # NEW
     def add_interface(self, label, l2_network_device_name,
-                      interface_model, mac_address=None):
+                      interface_model, mac_address=None, **params):
         if l2_network_device_name:
             env = self.group.environment
             l2_network_device = env.get_env_l2_network_device(
@@ -212,6 +255,7 @@ class Node(ParamedModel, BaseModel):
             l2_network_device=l2_network_device,
             mac_address=mac_address,
             model=interface_model,
+            **params
         )
 
     # NEW
@@ -285,23 +329,28 @@ class Node(ParamedModel, BaseModel):
         self.start()
         self.send_kernel_keys(self.kernel_cmd)
 
-    def send_kernel_keys(self, kernel_cmd):
-        """Provide variables data to kernel cmd format template"""
+    def format_kernel_cmd(self, kernel_cmd):
+        """Provide variables data to kernel cmd format template
 
+        :type kernel_cmd: str
+        :rtype : str
+        """
         ip = self.get_ip_address_by_network_name(
             settings.SSH_CREDENTIALS['admin_network'])
         master_iface = self.get_interface_by_network_name(
             settings.SSH_CREDENTIALS['admin_network'])
         admin_ap = master_iface.l2_network_device.address_pool
 
-        result_kernel_cmd = kernel_cmd.format(
+        return kernel_cmd.format(
             ip=ip,
             mask=admin_ap.ip_network.netmask,
             gw=admin_ap.gateway,
             hostname=settings.DEFAULT_MASTER_FQDN,
             nameserver=settings.DEFAULT_DNS,
         )
-        self.send_keys(result_kernel_cmd)
+
+    def send_kernel_keys(self, kernel_cmd):
+        self.send_keys(self.format_kernel_cmd(kernel_cmd))
 
     def bootstrap_and_wait(self):
         if self.kernel_cmd is None:
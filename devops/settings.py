@@ -284,3 +284,38 @@ DEVOPS_SETTINGS_TEMPLATE = os.environ.get('DEVOPS_SETTINGS_TEMPLATE', None)
 SNAPSHOTS_EXTERNAL = get_var_as_bool('SNAPSHOTS_EXTERNAL', False)
 SNAPSHOTS_EXTERNAL_DIR = os.environ.get("SNAPSHOTS_EXTERNAL_DIR",
                                         os.path.expanduser("~/.devops/snap"))
+
+# Maximum number of backing volumes of a disk left by 'dos.py flatten'
+SNAPSHOTS_MAX_CHAIN_DEPTH = int(os.environ.get("SNAPSHOTS_MAX_CHAIN_DEPTH",
+                                               10))
+
+# Directory for lock files which serialize the upload of shared base images
+# into a storage pool (libvirt driver parameter 'base_image_cache') and the
+# placement of nodes on host CPUs (libvirt driver parameter 'cpu_pinning')
+BASE_IMAGES_LOCK_DIR = os.environ.get("BASE_IMAGES_LOCK_DIR",
+                                      os.path.expanduser("~/.devops/lock"))
+
+# Directory for metadata of golden images of admin nodes
+# (libvirt driver parameter 'golden_image_cache')
+GOLDEN_IMAGES_DIR = os.environ.get("GOLDEN_IMAGES_DIR",
+                                   os.path.expanduser("~/.devops/golden"))
+
+# Directory for state files of warm pools of environments ('dos.py lease')
+WARM_POOLS_DIR = os.environ.get("WARM_POOLS_DIR",
+                                os.path.expanduser("~/.devops/pools"))
+
+# Wait for state changes of libvirt domains by lifecycle events instead of
+# polling. Polling is used anyway if the event loop is not available.
+LIBVIRT_EVENTS = get_var_as_bool('LIBVIRT_EVENTS', True)
+
+# Check free memory, huge pages, CPUs and storage pool space of the hosts
+# before an environment is defined
+ADMISSION_CONTROL = get_var_as_bool('ADMISSION_CONTROL', True)
+# Seconds to wait for free resources of the hosts, for example until other
+# environments are erased, before the environment is rejected
+ADMISSION_TIMEOUT = int(os.environ.get('ADMISSION_TIMEOUT', 0))
+
+# Directory for kernel and initrd files extracted from ISO images for
+# direct kernel boot of nodes (libvirt node parameter 'kernel_boot')
+KERNEL_BOOT_DIR = os.environ.get("KERNEL_BOOT_DIR",
+                                 os.path.expanduser("~/.devops/kernel"))
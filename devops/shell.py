@@ -16,8 +16,10 @@ from __future__ import print_function
 
 import argparse
 import collections
+import json
 import os
 import sys
+import time
 
 # pylint: disable=redefined-builtin
 from six.moves import xrange
@@ -27,11 +29,22 @@ import tabulate
 import devops
 
 from devops.error import DevopsObjNotFound
+from devops.error import DevopsResourcesError
+from devops.helpers.garbage import find_garbage
+from devops.helpers.garbage import remove_garbage
+from devops.helpers.helpers import format_prometheus
 from devops.helpers.ntp import sync_time
+from devops.helpers.reconcile import find_drift
+from devops.helpers.reconcile import repair_drift
+from devops.helpers.scheduler import distribute_config
 from devops.helpers.templates import create_devops_config
 from devops.helpers.templates import create_slave_config
 from devops.helpers.templates import get_devops_config
+from devops.helpers.templates import yaml_template_load
+from devops.helpers.warm_pool import WarmPool
 from devops.models import Environment
+from devops.models import Group
+from devops.models import Volume
 from devops import settings
 
 
@@ -82,8 +95,9 @@ class Shell(object):
 
     def do_show(self):
         headers = ("VNC", "NODE-NAME")
-        columns = [(node.get_vnc_port(), node.name)
-                   for node in self.env.get_nodes()]
+        with self.env.inventory(details=('devices',)):
+            columns = [(node.get_vnc_port(), node.name)
+                       for node in self.env.get_nodes()]
         self.print_table(headers=headers, columns=columns)
 
     def do_erase(self):
@@ -116,6 +130,7 @@ class Shell(object):
 
     def do_snapshot_list(self):
         snapshots = collections.OrderedDict()
+        depths = collections.defaultdict(int)
 
         Snap = collections.namedtuple('Snap', ['info', 'nodes'])
 
@@ -125,16 +140,19 @@ class Shell(object):
                     snapshots[snap.name].nodes.append(node.name)
                 else:
                     snapshots[snap.name] = Snap(snap, [node.name, ])
+                depths[snap.name] = max(depths[snap.name],
+                                        node.get_chain_depth(snap.name))
 
         snapshots = sorted(snapshots.values(), key=lambda x: x.info.created)
 
-        headers = ('SNAPSHOT', 'CREATED', 'NODES-NAMES')
+        headers = ('SNAPSHOT', 'CREATED', 'DEPTH', 'NODES-NAMES')
         columns = []
         for info, nodes in snapshots:
             nodes.sort()
             columns.append((
                 info.name,
                 info.created.strftime('%Y-%m-%d %H:%M:%S'),
+                depths[info.name],
                 ', '.join(nodes),
             ))
 
@@ -146,6 +164,152 @@ class Shell(object):
             if self.snapshot_name in snaps:
                 node.erase_snapshot(name=self.snapshot_name)
 
+    @staticmethod
+    def _log_to_stderr():
+        # stdout is used for the data
+        for handler in devops.logger.handlers:
+            if getattr(handler, 'stream', None) is sys.stdout:
+                handler.stream = sys.stderr
+
+    def do_snapshot_export(self):
+        # the archive format is specific to the libvirt driver, which is
+        # not required by other commands
+        from devops.driver.libvirt.libvirt_archive import export_snapshot
+
+        output = self.params.output or '{0}_{1}.snapshot.gz'.format(
+            self.env.name, self.snapshot_name)
+        if output == '-':
+            self._log_to_stderr()
+            export_snapshot(self.env, self.snapshot_name,
+                            getattr(sys.stdout, 'buffer', sys.stdout),
+                            compresslevel=self.params.compress_level)
+            return
+        with open(output, 'wb') as fileobj:
+            export_snapshot(self.env, self.snapshot_name, fileobj,
+                            compresslevel=self.params.compress_level)
+        print("Snapshot '{0}' is exported to {1}".format(
+            self.snapshot_name, output))
+
+    def do_snapshot_import(self):
+        from devops.driver.libvirt.libvirt_archive import import_snapshot
+
+        if self.params.archive == '-':
+            env = import_snapshot(
+                getattr(sys.stdin, 'buffer', sys.stdin),
+                name=self.params.env_name,
+                connection_string=self.params.connection_string)
+        else:
+            with open(self.params.archive, 'rb') as fileobj:
+                env = import_snapshot(
+                    fileobj,
+                    name=self.params.env_name,
+                    connection_string=self.params.connection_string)
+        print("Environment '{0}' is imported, resume it with "
+              "'dos.py resume {0}'".format(env.name))
+
+    def do_lease(self):
+        # stdout is used for the name of the environment
+        self._log_to_stderr()
+        print(WarmPool(self.params.pool).lease(owner=self.params.owner,
+                                               timeout=self.params.wait))
+
+    def do_release(self):
+        WarmPool(self.params.pool).release(self.params.env_name)
+
+    def _print_pool(self, pool):
+        headers = ('ENVIRONMENT', 'STATE', 'SINCE', 'OWNER')
+        columns = []
+        for name, member in sorted(pool.get_members().items()):
+            columns.append((
+                name,
+                member['state'],
+                time.strftime('%Y-%m-%d %H:%M:%S',
+                              time.localtime(member['since'])),
+                member['owner'] or '',
+            ))
+        self.print_table(columns=columns, headers=headers)
+
+    def do_pool_fill(self):
+        pool = WarmPool(self.params.pool)
+        pool.configure(
+            source=self.params.source,
+            snapshot=self.params.snapshot,
+            size=self.params.size,
+            timesync=False if self.params.no_timesync else None,
+            max_lease=self.params.max_lease)
+        pool.maintain(threads=self.params.threads)
+        self._print_pool(pool)
+
+    def do_pool_maintain(self):
+        pool = WarmPool(self.params.pool)
+        while True:
+            if pool.maintain(threads=self.params.threads):
+                self._print_pool(pool)
+            time.sleep(self.params.interval)
+
+    def do_flatten(self):
+        if self.params.node_name:
+            nodes = [self.env.get_node(name=self.params.node_name)]
+        else:
+            nodes = self.env.get_nodes()
+        for node in nodes:
+            disks = node.flatten(max_depth=self.params.max_depth)
+            if disks:
+                print("Disks of '{0}' are flattened: {1}".format(
+                    node.name, ', '.join(disks)))
+
+    def do_gc(self):
+        drivers = {}
+        env_nodes = {}
+        for env in Environment.list_all():
+            env_nodes[env.name] = [node.name for node in env.get_nodes()]
+            for group in env.get_groups():
+                # groups with the same driver params share the storage
+                driver = group.driver
+                key = (driver.name, json.dumps(driver.params, sort_keys=True))
+                drivers.setdefault(key, driver)
+        known_volumes = set(getattr(volume, 'uuid', None)
+                            for volume in Volume.objects.all())
+
+        garbage = find_garbage(drivers.values(), known_volumes, env_nodes,
+                               memory_dir=settings.SNAPSHOTS_EXTERNAL_DIR)
+        headers = ('TYPE', 'PATH', 'SIZE-MIB')
+        columns = [(item['type'], item['path'], item['size'] // 1024 ** 2)
+                   for item in garbage]
+        self.print_table(columns=columns, headers=headers)
+
+        size = sum(item['size'] for item in garbage) // 1024 ** 2
+        if self.params.dry_run:
+            print('{0} MiB can be reclaimed'.format(size))
+            return
+        removed = remove_garbage(garbage, threads=self.params.threads)
+        print('{0} MiB reclaimed'.format(
+            sum(item['size'] for item in removed) // 1024 ** 2))
+        if len(removed) < len(garbage):
+            sys.exit('{0} items were not removed'.format(
+                len(garbage) - len(removed)))
+
+    def do_reconcile(self):
+        drift = find_drift(Group.list_all())
+        headers = ('KIND', 'OBJECT', 'HOST', 'ENV', 'NAME', 'DETAIL',
+                   'REPAIR')
+        columns = [(item['kind'], item['object'], item['host'],
+                    item['env'] or '-', item['name'], item['detail'],
+                    item['repair'] or '-')
+                   for item in drift]
+        self.print_table(columns=columns, headers=headers)
+
+        if not self.params.repair:
+            if drift:
+                sys.exit('{0} differences found, use --repair to repair '
+                         'them'.format(len(drift)))
+            return
+        repaired = repair_drift(drift, threads=self.params.threads)
+        print('{0} differences repaired'.format(len(repaired)))
+        if len(repaired) < len(drift):
+            sys.exit('{0} differences were not repaired'.format(
+                len(drift) - len(repaired)))
+
     def do_net_list(self):
         headers = ("NETWORK NAME", "IP NET")
         columns = [(net.name, net.ip_network)
@@ -154,8 +318,9 @@ class Shell(object):
 
     def do_timesync(self):
         if not self.params.node_name:
-            nodes = [node.name for node in self.env.get_nodes()
-                     if node.driver.node_active(node)]
+            with self.env.inventory():
+                nodes = [node.name for node in self.env.get_nodes()
+                         if node.driver.node_active(node)]
         else:
             nodes = [self.params.node_name]
         cur_time = sync_time(self.env, nodes, skip_sync=True)
@@ -168,9 +333,40 @@ class Shell(object):
         for name in sorted(new_time):
             print("New time on '{0}' = {1}".format(name, new_time[name]))
 
+    def do_stats(self):
+        if self.params.name:
+            environments = [self.env]
+        else:
+            environments = Environment.list_all()
+        collectors = []
+        for env in environments:
+            for group in env.get_groups():
+                collector = group.driver.get_stats_collector(
+                    group.get_nodes(), interval=self.params.interval,
+                    history=self.params.count)
+                if collector is not None:
+                    collectors.append(collector)
+
+        # Rates are computed between two consecutive samples
+        for num in xrange(self.params.count + 1):
+            if num:
+                time.sleep(self.params.interval)
+            for collector in collectors:
+                collector.sample()
+
+        if self.params.format == 'prometheus':
+            metrics = []
+            for collector in collectors:
+                metrics.extend(collector.metrics())
+            sys.stdout.write(format_prometheus(metrics))
+        else:
+            domains = []
+            for collector in collectors:
+                domains.extend(collector.to_dict())
+            print(json.dumps(domains, indent=2, sort_keys=True))
+
     def do_revert_resume(self):
-        self.env.revert(self.snapshot_name, flag=False)
-        self.env.resume()
+        self.env.revert(self.snapshot_name, flag=False, resume=True)
         if not self.params.no_timesync:
             print('Time synchronization is starting')
             self.do_timesync()
@@ -213,9 +409,14 @@ class Shell(object):
 
     def do_create_env(self):
         config = get_devops_config(self.params.env_config_name)
-        self._create_env_from_config(config)
-
-    def _create_env_from_config(self, config):
+        if self.params.hosts:
+            config = distribute_config(
+                config, yaml_template_load(self.params.hosts),
+                vlan_start=self.params.vlan_start)
+        self._create_env_from_config(
+            config, parallel=bool(self.params.hosts))
+
+    def _create_env_from_config(self, config, parallel=False):
         env_name = config['template']['devops_settings']['env_name']
         for env in Environment.list_all():
             if env.name == env_name:
@@ -223,7 +424,12 @@ class Shell(object):
                 raise SystemExit()
 
         self.env = Environment.create_environment(config)
-        self.env.define()
+        try:
+            self.env.define(parallel=parallel)
+        except DevopsResourcesError:
+            # Nothing is defined on the hosts yet
+            self.env.erase()
+            raise
 
         # Start all l2 network devices
         for group in self.env.get_groups():
@@ -324,8 +530,18 @@ class Shell(object):
         'sync': do_synchronize,
         'snapshot-list': do_snapshot_list,
         'snapshot-delete': do_snapshot_delete,
+        'snapshot-export': do_snapshot_export,
+        'snapshot-import': do_snapshot_import,
+        'lease': do_lease,
+        'release': do_release,
+        'pool-fill': do_pool_fill,
+        'pool-maintain': do_pool_maintain,
+        'flatten': do_flatten,
+        'gc': do_gc,
+        'reconcile': do_reconcile,
         'net-list': do_net_list,
         'time-sync': do_timesync,
+        'stats': do_stats,
         'revert-resume': do_revert_resume,
         'version': do_version,
         'create': do_create,
@@ -352,16 +568,135 @@ class Shell(object):
                                             default=os.environ.get(
                                                 'DEVOPS_SETTINGS_TEMPLATE'))
 
+        hosts_parser = argparse.ArgumentParser(add_help=False)
+        hosts_parser.add_argument('--hosts', dest='hosts',
+                                  help='YAML file with the list of libvirt '
+                                       'hosts to distribute nodes across',
+                                  default=None)
+        hosts_parser.add_argument('--vlan-start', dest='vlan_start',
+                                  help='first VLAN tag used to connect '
+                                       'networks of the hosts',
+                                  default=1000, type=int)
+
         snapshot_name_parser = argparse.ArgumentParser(add_help=False)
         snapshot_name_parser.add_argument('snapshot-name',
                                           help='snapshot name',
                                           default=os.environ.get(
                                               'SNAPSHOT_NAME'))
 
+        optional_name_parser = argparse.ArgumentParser(add_help=False)
+        optional_name_parser.add_argument('name', help='environment name',
+                                          nargs='?',
+                                          default=os.environ.get('ENV_NAME'),
+                                          metavar='ENV_NAME')
+        stats_parser = argparse.ArgumentParser(add_help=False)
+        stats_parser.add_argument('--interval', dest='interval',
+                                  help='seconds between samples',
+                                  default=5, type=int)
+        stats_parser.add_argument('--count', dest='count',
+                                  help='number of samples',
+                                  default=1, type=int)
+        stats_parser.add_argument('--format', dest='format',
+                                  choices=('json', 'prometheus'),
+                                  help='output format',
+                                  default='json')
         node_name_parser = argparse.ArgumentParser(add_help=False)
         node_name_parser.add_argument('--node-name', '-N',
                                       help='node name',
                                       default=None)
+        gc_parser = argparse.ArgumentParser(add_help=False)
+        gc_parser.add_argument('--dry-run', dest='dry_run',
+                               action='store_const', const=True,
+                               help='only show what would be removed',
+                               default=False)
+        gc_parser.add_argument('--threads', dest='threads',
+                               help='number of parallel removals',
+                               default=4, type=int)
+        reconcile_parser = argparse.ArgumentParser(add_help=False)
+        reconcile_parser.add_argument('--repair', dest='repair',
+                                      action='store_const', const=True,
+                                      help='remove orphans, fix records and '
+                                           'define missing filters',
+                                      default=False)
+        reconcile_parser.add_argument('--threads', dest='threads',
+                                      help='number of parallel repairs',
+                                      default=4, type=int)
+        export_parser = argparse.ArgumentParser(add_help=False)
+        export_parser.add_argument('--output', '-o', dest='output',
+                                   help="archive file, '-' for stdout, "
+                                        "ENV_NAME_SNAPSHOT_NAME.snapshot.gz "
+                                        "by default",
+                                   default=None)
+        export_parser.add_argument('--compress-level', dest='compress_level',
+                                   help='gzip compression level, from 0 '
+                                        '(no compression) to 9',
+                                   default=6, type=int,
+                                   choices=range(10))
+
+        import_parser = argparse.ArgumentParser(add_help=False)
+        import_parser.add_argument('archive',
+                                   help="archive file, '-' for stdin")
+        import_parser.add_argument('--env-name', dest='env_name',
+                                   help='name of the new environment, the '
+                                        'exported name by default',
+                                   default=None)
+        import_parser.add_argument('--connection-string',
+                                   dest='connection_string',
+                                   help='libvirt URI of the host, the '
+                                        'exported one by default',
+                                   default=None)
+
+        pool_parser = argparse.ArgumentParser(add_help=False)
+        pool_parser.add_argument('pool', help='warm pool name')
+
+        pool_threads_parser = argparse.ArgumentParser(add_help=False)
+        pool_threads_parser.add_argument('--threads', dest='threads',
+                                         help='number of environments '
+                                              'prepared in parallel',
+                                         default=4, type=int)
+
+        lease_parser = argparse.ArgumentParser(add_help=False)
+        lease_parser.add_argument('--owner', dest='owner',
+                                  help='description of the job, e.g. '
+                                       'its URL',
+                                  default=os.environ.get('BUILD_URL'))
+        lease_parser.add_argument('--wait', dest='wait',
+                                  help='seconds to wait for a ready '
+                                       'environment',
+                                  default=0, type=int)
+
+        release_parser = argparse.ArgumentParser(add_help=False)
+        release_parser.add_argument('env_name',
+                                    help='leased environment name')
+
+        pool_fill_parser = argparse.ArgumentParser(add_help=False)
+        pool_fill_parser.add_argument('--source', dest='source',
+                                      help='environment to clone',
+                                      default=None)
+        pool_fill_parser.add_argument('--snapshot', dest='snapshot',
+                                      help='snapshot to clone and to '
+                                           'revert environments to',
+                                      default=None)
+        pool_fill_parser.add_argument('--size', dest='size',
+                                      help='number of environments',
+                                      default=None, type=int)
+        pool_fill_parser.add_argument('--max-lease', dest='max_lease',
+                                      help='seconds after which leased '
+                                           'environments are recycled, '
+                                           '0 for no limit',
+                                      default=None, type=int)
+
+        pool_maintain_parser = argparse.ArgumentParser(add_help=False)
+        pool_maintain_parser.add_argument('--interval', dest='interval',
+                                          help='seconds between checks '
+                                               'of the pool',
+                                          default=10, type=int)
+
+        max_depth_parser = argparse.ArgumentParser(add_help=False)
+        max_depth_parser.add_argument('--max-depth', dest='max_depth',
+                                      help='maximum number of backing '
+                                           'volumes of a disk',
+                                      default=None, type=int)
         no_timesync_parser = argparse.ArgumentParser(add_help=False)
         no_timesync_parser.add_argument('--no-timesync', dest='no_timesync',
                                         action='store_const', const=True,
@@ -514,6 +849,67 @@ class Shell(object):
                               help="Delete snapshot from environment",
                               description="Delete snapshot from selected "
                               "environment")
+        subparsers.add_parser('snapshot-export',
+                              parents=[name_parser, snapshot_name_parser,
+                                       export_parser],
+                              help="Export snapshot to an archive",
+                              description="Write the environment in the "
+                                          "state of the external snapshot "
+                                          "to a compressed archive"),
+        subparsers.add_parser('snapshot-import',
+                              parents=[import_parser],
+                              help="Import snapshot from an archive",
+                              description="Create an environment in the "
+                                          "state of the snapshot from an "
+                                          "archive"),
+        subparsers.add_parser('lease',
+                              parents=[pool_parser, lease_parser],
+                              help="Take a ready environment from a pool",
+                              description="Print the name of a ready "
+                                          "environment from the warm "
+                                          "pool and mark it as leased"),
+        subparsers.add_parser('release',
+                              parents=[pool_parser, release_parser],
+                              help="Return an environment to a pool",
+                              description="Return the leased environment "
+                                          "to the warm pool, it is "
+                                          "reverted by 'pool-maintain'"),
+        subparsers.add_parser('pool-fill',
+                              parents=[pool_parser, pool_threads_parser,
+                                       pool_fill_parser, no_timesync_parser],
+                              help="Configure and fill a warm pool",
+                              description="Create or change the warm pool "
+                                          "and wait until its "
+                                          "environments are prepared"),
+        subparsers.add_parser('pool-maintain',
+                              parents=[pool_parser, pool_threads_parser,
+                                       pool_maintain_parser],
+                              help="Keep a warm pool ready",
+                              description="Revert returned environments "
+                                          "and create missing ones in the "
+                                          "background, until stopped"),
+        subparsers.add_parser('flatten',
+                              parents=[name_parser, node_name_parser,
+                                       max_depth_parser],
+                              help="Collapse backing chains of disks",
+                              description="Collapse backing chains of "
+                                          "disks of nodes created by "
+                                          "external snapshots, volumes "
+                                          "of snapshots are kept"),
+        subparsers.add_parser('gc',
+                              parents=[gc_parser],
+                              help="Remove unused volumes and files",
+                              description="Remove volumes and memory "
+                                          "files of snapshots which are "
+                                          "not used by any environment "
+                                          "or libvirt domain"),
+        subparsers.add_parser('reconcile',
+                              parents=[reconcile_parser],
+                              help="Compare database with hosts",
+                              description="Find domains, networks, volumes "
+                                          "and filters which differ "
+                                          "between the database and the "
+                                          "hosts of all environments"),
         subparsers.add_parser('net-list',
                               parents=[name_parser],
                               help="Show networks in environment",
@@ -525,6 +921,14 @@ class Shell(object):
                               description="Sync time on all active nodes "
                                           "of environment starting from "
                                           "admin")
+        subparsers.add_parser('stats',
+                              parents=[optional_name_parser, stats_parser],
+                              help="Show resource usage of VMs",
+                              description="Sample CPU, memory, disk and "
+                                          "network usage of VMs in the "
+                                          "environment, or of all "
+                                          "environments if no name is "
+                                          "given"),
         subparsers.add_parser('revert-resume',
                               parents=[name_parser, snapshot_name_parser,
                                        node_name_parser, no_timesync_parser],
@@ -547,7 +951,8 @@ class Shell(object):
                               description="Create an environment by using "
                                           "cli options"),
         subparsers.add_parser('create-env',
-                              parents=[env_config_name_parser],
+                              parents=[env_config_name_parser,
+                                       hosts_parser],
                               help="Create a new environment",
                               description="Create an environment from a "
                                           "template file"),
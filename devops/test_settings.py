@@ -16,3 +16,6 @@ from devops.settings import *  # noqa
 
 # make tests faster
 DATABASES['default'] = {'ENGINE': 'django.db.backends.sqlite3'}
+
+# resources of the test driver are not real
+ADMISSION_CONTROL = False
@@ -0,0 +1,266 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+import io
+import shutil
+import struct
+import tempfile
+import unittest
+
+import libvirt
+import mock
+
+from devops.driver.libvirt import libvirt_archive
+from devops.error import DevopsError
+
+
+def qcow2_header(backing_file, cluster_bits=16, offset=0x200):
+    header = struct.pack('>4sIQII', libvirt_archive.QCOW2_MAGIC, 3,
+                         offset, len(backing_file), cluster_bits)
+    header += b'\0' * (offset - len(header)) + backing_file
+    return header + b'\0' * (1024 - len(header))
+
+
+class TestArchive(unittest.TestCase):
+
+    def write(self, records):
+        fileobj = io.BytesIO()
+        archive = libvirt_archive.ArchiveWriter(fileobj)
+        for header, chunks in records:
+            archive.add(header, chunks)
+        archive.close()
+        return fileobj.getvalue()
+
+    def test_round_trip(self):
+        data = self.write([
+            ({'type': 'manifest', 'manifest': {'environment': 'env'}}, None),
+            ({'type': 'volume', 'id': 0}, [b'a' * 10, b'', b'\0' * 10 ** 7]),
+            ({'type': 'volume', 'id': 1}, [b'skipped']),
+            ({'type': 'memory', 'node': 'admin'}, iter([b'mem'])),
+        ])
+        assert len(data) < 10 ** 5
+
+        records = []
+        for header, chunks in libvirt_archive.ArchiveReader(
+                io.BytesIO(data)):
+            if header['type'] == 'volume' and header['id'] == 1:
+                records.append((header, None))
+                continue
+            records.append((header, chunks and b''.join(chunks)))
+
+        assert records == [
+            ({'type': 'manifest', 'manifest': {'environment': 'env'},
+              'data': False}, None),
+            ({'type': 'volume', 'id': 0, 'data': True},
+             b'a' * 10 + b'\0' * 10 ** 7),
+            ({'type': 'volume', 'id': 1, 'data': True}, None),
+            ({'type': 'memory', 'node': 'admin', 'data': True}, b'mem'),
+        ]
+
+    def test_truncated(self):
+        data = self.write([({'type': 'volume', 'id': 0}, [b'x' * 1000])])
+
+        with self.assertRaises(DevopsError):
+            list(libvirt_archive.ArchiveReader(io.BytesIO(data[:-20])))
+        with self.assertRaises(DevopsError):
+            libvirt_archive.ArchiveReader(io.BytesIO(b'not an archive'))
+
+    def test_set_qcow2_backing_file(self):
+        header = qcow2_header(b'/old/pool/env_admin_system')
+
+        new = libvirt_archive.set_qcow2_backing_file(
+            header, '/pool/new_admin_system')
+        assert len(new) == len(header)
+        assert struct.unpack('>QI', new[8:20]) == (0x200, 22)
+        assert new[0x200:0x200 + 26] == b'/pool/new_admin_system\0\0\0\0'
+
+        longer = libvirt_archive.set_qcow2_backing_file(
+            new, '/var/lib/libvirt/images/new_admin_system')
+        assert struct.unpack('>I', longer[16:20]) == (40,)
+        assert longer[0x200:0x200 + 40] == (
+            b'/var/lib/libvirt/images/new_admin_system')
+        assert longer[0x200 + 40:] == b'\0' * (1024 - 0x200 - 40)
+
+    def test_set_qcow2_backing_file_errors(self):
+        with self.assertRaises(DevopsError):
+            libvirt_archive.set_qcow2_backing_file(b'\0' * 1024, '/path')
+        with self.assertRaises(DevopsError):
+            libvirt_archive.set_qcow2_backing_file(
+                qcow2_header(b'/base', cluster_bits=9, offset=0x1f0),
+                '/a/longer/path/of/the/base')
+
+    def test_set_backing_file_stream(self):
+        header = qcow2_header(b'/old/base')
+        chunks = [header[:100], header[100:], b'data']
+
+        data = b''.join(libvirt_archive._set_backing_file(chunks, '/base'))
+        assert data[0x200:0x200 + 10] == b'/base\0\0\0\0\0'
+        assert data.endswith(b'data')
+
+
+VOLUME_XML = """<volume>
+  <target><format type='{0}'/></target>
+  {1}
+</volume>"""
+
+
+class TestSnapshotArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.memory_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.memory_dir)
+        self.memory_file = self.memory_dir + '/snapshot-memory-env_admin.s'
+        with open(self.memory_file, 'wb') as f:
+            f.write(b'memory')
+
+        self.conn = mock.Mock()
+        volumes = {
+            '/pool/env_admin_system.s': VOLUME_XML.format(
+                'qcow2', '<backingStore><path>/pool/env_admin_system'
+                         '</path></backingStore>'),
+            '/pool/env_admin_system': VOLUME_XML.format('raw', ''),
+        }
+
+        def lookup(path):
+            volume = mock.Mock()
+            volume.path.return_value = path
+            volume.XMLDesc.return_value = volumes[path]
+            volume.info.return_value = [0, 1024 ** 3, 0]
+            return volume
+        self.conn.storageVolLookupByPath.side_effect = lookup
+
+        self.snapshot = mock.Mock(memory_file=self.memory_file,
+                                  created=datetime.datetime(2016, 1, 2))
+        self.snapshot._xml_tree.findtext.return_value = 'description'
+
+        root = mock.Mock(params={'uuid': '/pool/env_admin_system',
+                                 'cache': 'none'})
+        root.name = 'system'
+        disk = mock.Mock(target_dev='vda', device='disk', type='file',
+                         bus='virtio')
+        disk.volume.get_backing_chain.return_value = [disk.volume, root]
+
+        self.node = mock.Mock(role='fuel_master', uuid='domain-uuid',
+                              params={'uuid': 'domain-uuid', 'vcpu': 2},
+                              disk_devices=[disk], interfaces=[],
+                              network_configs=[])
+        self.node.name = 'admin'
+        self.node.driver.conn = self.conn
+        self.node.driver.connection_string = 'qemu:///system'
+        self.node.get_snapshot_volumes.return_value = {
+            'vda': '/pool/env_admin_system.s'}
+        self.node._get_snapshot.return_value = self.snapshot
+
+        group = mock.Mock()
+        group.name = 'default'
+        group.driver.name = 'devops.driver.libvirt'
+        group.driver.params = {'connection_string': 'qemu:///system'}
+        group.get_nodes.return_value = [self.node]
+        group.get_l2_network_devices.return_value = []
+        group.get_network_pools.return_value = []
+        self.node.group = group
+
+        self.env = mock.Mock()
+        self.env.name = 'env'
+        self.env.get_groups.return_value = [group]
+        self.env.get_address_pools.return_value = []
+
+    def test_get_manifest(self):
+        manifest, volumes, memory_files = libvirt_archive.get_manifest(
+            self.env, 's')
+
+        self.env.has_snapshot.assert_called_once_with('s')
+        assert manifest['snapshot'] == dict(
+            name='s', description='description',
+            created='2016-01-02T00:00:00')
+        node = manifest['groups'][0]['nodes'][0]
+        # Memory state can be restored only into the same UUID
+        assert node['uuid'] == 'domain-uuid'
+        assert node['params'] == {'vcpu': 2}
+        assert node['disks'][0]['layers'] == [0, 1]
+        assert node['disks'][0]['params'] == {'cache': 'none'}
+        assert [(layer['name'], layer['format'], layer['parent'])
+                for layer in manifest['volumes']] == [
+            ('system', 'raw', None), ('system.import1', 'qcow2', 0)]
+        assert volumes[1][1].path() == '/pool/env_admin_system.s'
+        assert memory_files == {('default', 'admin'): self.memory_file}
+
+    def _export(self):
+        fileobj = io.BytesIO()
+        with mock.patch.object(libvirt_archive, '_download',
+                               side_effect=lambda conn, vol: [b'data']):
+            libvirt_archive.export_snapshot(self.env, 's', fileobj)
+        fileobj.seek(0)
+        return fileobj
+
+    def _patch(self, name, **kwargs):
+        patcher = mock.patch.object(libvirt_archive, name, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def _setup_import(self):
+        for name in ('Address', 'DiskDevice', '_upload'):
+            self._patch(name)
+        for name in ('AddressPool', 'Interface'):
+            used = self._patch(name).objects.filter.return_value
+            used.exists.return_value = False
+        self._patch('settings', SNAPSHOTS_EXTERNAL_DIR=self.memory_dir)
+        self._patch('_set_backing_file', side_effect=lambda chunks, path:
+                    chunks)
+        self.manager = self._patch('LibvirtManager')
+        self.manager.get_connection.return_value = self.conn
+        self.conn.lookupByUUIDString.side_effect = libvirt.libvirtError(
+            'no domain')
+        env_cls = self._patch('Environment')
+        self.new_env = env_cls.create.return_value
+        group = self.new_env.get_group.return_value
+        group.name = 'default'
+        self.new_node = group.add_node.return_value
+        self.new_node.name = 'admin'
+
+    def test_import_snapshot(self):
+        fileobj = self._export()
+        self._setup_import()
+
+        with mock.patch.object(libvirt.libvirtError, 'get_error_code',
+                               return_value=libvirt.VIR_ERR_NO_DOMAIN):
+            env = libvirt_archive.import_snapshot(fileobj, name='new')
+
+        assert env is self.new_env
+        self.conn.lookupByUUIDString.assert_called_once_with('domain-uuid')
+        group = self.new_env.get_group.return_value
+        group.add_node.assert_called_once_with(
+            name='admin', role='fuel_master', vcpu=2, uuid='domain-uuid')
+        self.new_node.define.assert_called_once_with()
+        restore = self.new_node.driver.conn.restoreFlags
+        restore.assert_called_once_with(
+            self.memory_dir + '/snapshot-memory-new_admin.import',
+            self.new_node._libvirt_node.XMLDesc.return_value,
+            libvirt.VIR_DOMAIN_SAVE_PAUSED)
+        self.new_node.snapshot.assert_called_once_with(
+            name='s', description='description', external=True)
+
+    def test_import_snapshot_uuid_used(self):
+        fileobj = self._export()
+        self._setup_import()
+        self.conn.lookupByUUIDString.side_effect = None
+        self.conn.lookupByUUIDString.return_value.name.return_value = (
+            'env_admin')
+
+        with self.assertRaises(DevopsError) as e:
+            libvirt_archive.import_snapshot(fileobj, name='new')
+        assert 'used by domain env_admin' in str(e.exception)
+        assert not self.new_env.erase.called
+        assert not self.new_node.define.called
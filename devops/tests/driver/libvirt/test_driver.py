@@ -12,6 +12,11 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import json
+import os
+import shutil
+import struct
+import tempfile
 import xml.etree.ElementTree as ET
 
 from django.test import TestCase
@@ -20,8 +25,16 @@ import mock
 from netaddr import IPNetwork
 
 from devops.driver.libvirt.libvirt_driver import _LibvirtManager
+from devops.driver.libvirt.libvirt_driver import get_save_image_format
 from devops.driver.libvirt.libvirt_driver import LibvirtDriver
+from devops.driver.libvirt.libvirt_xml_builder import LibvirtXMLBuilder
+from devops.error import DevopsError
+from devops.helpers.reconcile import repair_drift
+from devops.helpers import scheduler
 from devops.models import Environment
+from devops.models import Interface
+from devops.models import Node
+from devops.models import Volume
 from devops.tests.driver.libvirt.base import LibvirtTestCase
 
 
@@ -70,6 +83,24 @@ class TestLibvirtManager(TestCase):
                                             'test:///default': c3}
 
 
+class TestSaveImageFormat(TestCase):
+
+    def write(self, data):
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_get_save_image_format(self):
+        header = b'LibvirtQemudSave' + struct.pack('=5I', 2, 100, 1, 4, 0)
+        assert get_save_image_format(self.write(header)) == 'lzop'
+        header = b'LibvirtQemudSave' + struct.pack('=5I', 2, 100, 1, 0, 0)
+        assert get_save_image_format(self.write(header)) == 'raw'
+        assert get_save_image_format(self.write(b'QFI\xfb')) is None
+        assert get_save_image_format('/nonexistent/file') is None
+
+
 class TestLibvirtDriver(LibvirtTestCase):
 
     def setUp(self):
@@ -147,6 +178,284 @@ class TestLibvirtDriver(LibvirtTestCase):
     def test_get_version(self):
         assert isinstance(self.d.get_libvirt_version(), int)
 
+    def test_host_call(self):
+        check_output = self.patch(
+            'devops.driver.libvirt.libvirt_driver.subprocess.check_output')
+        cmd = ['sudo', 'ip', 'link', 'set', 'dev', 'eth1', 'up']
+
+        self.d.host_call(cmd)
+        check_output.assert_called_once_with(cmd)
+
+        check_output.reset_mock()
+        self.d.connection_string = 'qemu+ssh://root@host2:2222/system'
+        self.d.host_call(cmd)
+        check_output.assert_called_once_with(
+            ['ssh', '-o', 'BatchMode=yes', '-p', '2222', 'root@host2'] + cmd)
+
+        check_output.reset_mock()
+        self.d.connection_string = 'qemu+tcp://host2/system'
+        with self.assertRaises(DevopsError):
+            self.d.host_call(cmd)
+        assert not check_output.called
+
+    def test_get_host_capacity(self):
+        self.d.storage_pool_name = 'default-pool'
+        capacity = self.d.get_host_capacity()
+        assert sorted(capacity) == ['disk', 'memory', 'vcpu']
+        assert capacity['vcpu'] == self.d.conn.getInfo()[2]
+        assert capacity['memory'] > 0
+
+    def test_detect_capacity(self):
+        hosts = scheduler.detect_capacity(
+            [{'connection_string': 'test:///default', 'memory': 1024}],
+            'devops.driver.libvirt', {'storage_pool_name': 'default-pool'})
+        assert hosts[0]['memory'] == 1024
+        assert hosts[0]['vcpu'] == self.d.conn.getInfo()[2]
+        assert hosts[0]['disk'] is not None
+
+    def test_get_garbage(self):
+        self.patch('devops.driver.libvirt.libvirt_driver.file_lock')
+        self.d.storage_pool_name = 'default-pool'
+        pool = self.d.conn.storagePoolLookupByName('default-pool')
+
+        def add_volume(name, backing=None):
+            pool.createXML(LibvirtXMLBuilder.build_volume_xml(
+                name, 1024, 'qcow2',
+                backing and '/default-pool/{0}'.format(backing), 'qcow2'), 0)
+            return '/default-pool/{0}'.format(name)
+
+        known = add_volume('test_env_node_vol')
+        add_volume('test_env_node_vol.snap1', backing='test_env_node_vol')
+        add_volume('test_env_node_old')
+        add_volume('test_env_7_node_vol')
+        add_volume('other_image')
+        add_volume('devops_base_raw_0a1b')
+        add_volume('other_vm', backing='devops_base_raw_0a1b')
+        add_volume('other_vm.snap', backing='other_vm')
+        add_volume('devops_base_raw_ffff')
+        golden = add_volume('devops_golden_0a1b_sda')
+        add_volume('devops_golden_ffff_sda')
+        self.patch('devops.driver.libvirt.libvirt_driver.LibvirtDriver.'
+                   'get_golden_images',
+                   return_value={'0a1b': {'volumes': {'sda': golden}}})
+
+        garbage = self.d.get_garbage({known}, {'test_env': ['node']})
+        assert [item['path'] for item in garbage] == [
+            '/default-pool/devops_base_raw_ffff',
+            '/default-pool/devops_golden_ffff_sda',
+            '/default-pool/test_env_node_old',
+            '/default-pool/test_env_node_vol.snap1',
+        ]
+        assert all(item['type'] == 'volume' for item in garbage)
+
+        # other environments can have volumes with the same prefix
+        assert len(self.d.get_garbage({known}, {})) == 3
+        assert len(self.d.get_garbage({known}, {'test': ['env']})) == 3
+        assert len(self.d.get_garbage({known}, {'test_env': []})) == 3
+
+        # volumes can be created by another process right now
+        with mock.patch.object(self.d, '_get_volume_age', return_value=60):
+            assert self.d.get_garbage(
+                {known}, {'test_env': ['node']}) == []
+
+        self.d.remove_garbage(garbage[0])
+        assert sorted(vol.name() for vol in pool.listAllVolumes()) == [
+            'devops_base_raw_0a1b', 'devops_golden_0a1b_sda',
+            'devops_golden_ffff_sda', 'other_image', 'other_vm',
+            'other_vm.snap', 'test_env_7_node_vol', 'test_env_node_old',
+            'test_env_node_vol', 'test_env_node_vol.snap1']
+
+    def test_cleanup_golden_images(self):
+        self.d.storage_pool_name = 'default-pool'
+        pool = self.d.conn.storagePoolLookupByName('default-pool')
+        for name, backing in (('devops_golden_0a1b_sda', None),
+                              ('devops_golden_0a1b_sdb', None),
+                              ('test_env_admin_system',
+                               '/default-pool/devops_golden_0a1b_sda')):
+            pool.createXML(LibvirtXMLBuilder.build_volume_xml(
+                name, 1024, 'qcow2', backing, 'qcow2'), 0)
+        golden_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, golden_dir)
+        with open(os.path.join(golden_dir, '0a1b.json'), 'w') as meta_file:
+            json.dump({'volumes': {
+                'sda': '/default-pool/devops_golden_0a1b_sda',
+                'sdb': '/default-pool/devops_golden_0a1b_sdb'}}, meta_file)
+
+        with self.settings(GOLDEN_IMAGES_DIR=golden_dir):
+            assert list(self.d.get_golden_images()) == ['0a1b']
+            assert self.d.cleanup_golden_images(keys=['ffff']) == []
+
+            # The volume used by the admin node is left to gc
+            assert self.d.cleanup_golden_images() == [
+                '/default-pool/devops_golden_0a1b_sdb']
+            assert self.d.get_golden_images() == {}
+        assert sorted(vol.name() for vol in pool.listAllVolumes()) == [
+            'devops_golden_0a1b_sda', 'test_env_admin_system']
+
+    def test_erase_group(self):
+        self.d.storage_pool_name = 'default-pool'
+        self.d.save()
+        self.node = self.group.add_node(
+            name='test_node',
+            role='default',
+            architecture='i686',
+            hypervisor='test',
+        )
+        interface = self.node.add_interface(
+            label='eth0',
+            l2_network_device_name='test_l2_net_dev',
+            interface_model='virtio',
+        )
+        volume = self.node.add_volume(name='test_volume', capacity=1)
+        self.l2_net_dev.define()
+        volume.define()
+        self.node.define()
+        self.env.start()
+        pool = self.d.conn.storagePoolLookupByName('default-pool')
+        assert len(pool.listAllVolumes()) == 1
+
+        nwfilters = {}
+        for name in (interface.nwfilter_name, self.l2_net_dev.nwfilter_name,
+                     'clean-traffic'):
+            nwfilters[name] = mock.Mock()
+            nwfilters[name].name.return_value = name
+        self.libvirt_nwfilter_list_mock.return_value = list(
+            nwfilters.values())
+
+        self.env.erase()
+
+        assert self.d.conn.listAllDomains() == []
+        assert self.d.conn.listAllNetworks() == []
+        assert pool.listAllVolumes() == []
+        nwfilters[interface.nwfilter_name].undefine.assert_called_once_with()
+        nwfilters[self.l2_net_dev.nwfilter_name].undefine.\
+            assert_called_once_with()
+        assert not nwfilters['clean-traffic'].undefine.called
+        assert not Environment.objects.filter(name='test_env').exists()
+        assert not Node.objects.exists()
+        assert not Volume.objects.exists()
+        assert not Interface.objects.exists()
+
+    def test_erase_group_replica(self):
+        self.l2_net_dev.has_dhcp_server = True
+        self.l2_net_dev.save()
+        group2 = self.env.add_group(
+            group_name='test_group_host2',
+            driver_name='devops.driver.libvirt',
+            connection_string='test:///default')
+        group2.add_l2_network_device(
+            name='test_l2_net_dev_host2',
+            address_pool='test_ap',
+            replica_of='test_l2_net_dev',
+        )
+        self.node = group2.add_node(
+            name='test_node',
+            role='default',
+            architecture='i686',
+            hypervisor='test',
+        )
+        self.node.add_interface(
+            label='eth0',
+            l2_network_device_name='test_l2_net_dev_host2',
+            mac_address='64:52:dc:96:12:cc',
+            interface_model='virtio',
+        )
+        update_mock = self.patch('libvirt.virNetwork.update')
+        # the entry of the node is added by define() of the network
+        self.env.define()
+        assert not update_mock.called
+
+        group2.erase()
+
+        update_mock.assert_called_once_with(
+            libvirt.VIR_NETWORK_UPDATE_COMMAND_DELETE,
+            libvirt.VIR_NETWORK_SECTION_IP_DHCP_HOST, -1, mock.ANY,
+            libvirt.VIR_NETWORK_UPDATE_AFFECT_CONFIG)
+        host = ET.fromstring(update_mock.call_args[0][3])
+        assert host.get('mac') == '64:52:dc:96:12:cc'
+        # the original network stays with the first group
+        assert len(self.d.conn.listAllNetworks()) == 1
+        assert not Node.objects.exists()
+
+    def test_get_drift(self):
+        self.node = self.group.add_node(
+            name='test_node',
+            role='default',
+            architecture='i686',
+            hypervisor='test',
+        )
+        interface = self.node.add_interface(
+            label='eth0',
+            l2_network_device_name='test_l2_net_dev',
+            interface_model='virtio',
+        )
+        volume = self.node.add_volume(name='test_volume', capacity=1)
+        volume.uuid = '/default-pool/test_env_test_node_test_volume'
+        volume.save()
+        self.l2_net_dev.define()
+        self.node.define()
+        domain_uuid = self.node.uuid
+        self.node.uuid = 'f3a4b1c2-0000-4000-8000-000000000000'
+        self.node.save()
+        # records without UUID are not defined yet, objects with their
+        # names are not orphans
+        new_node = self.group.add_node(
+            name='test_node2',
+            role='default',
+            architecture='i686',
+            hypervisor='test',
+        )
+        new_interface = new_node.add_interface(
+            label='eth0',
+            l2_network_device_name='test_l2_net_dev',
+            interface_model='virtio',
+        )
+
+        # only objects with names of records belong to the environment,
+        # 'test_env_7' can be an environment of another database
+        for name in ('test_env_orphan', 'other_vm', 'test_env_test_node2',
+                     'test_env_7_test_node'):
+            self.d.conn.defineXML(
+                '<domain type="test"><name>{0}</name>'
+                '<memory>1024</memory><os><type>hvm</type></os>'
+                '</domain>'.format(name))
+        nwfilters = []
+        for name in (interface.nwfilter_name, new_interface.nwfilter_name,
+                     'test_env_test_l2_net_dev_64:52:dc:96:12:cc',
+                     'test_env_7_test_l2_net_dev_64:52:dc:96:12:cc',
+                     'test_env_old_64:52:dc:96:12:cc', 'clean-traffic'):
+            nwfilters.append(mock.Mock())
+            nwfilters[-1].name.return_value = name
+        self.libvirt_nwfilter_list_mock.return_value = nwfilters
+
+        drift = self.d.get_drift([self.group])
+        items = sorted((item['kind'], item['object'], item['name'],
+                        item['repair'], item['stage']) for item in drift)
+        assert items == [
+            ('missing', 'nwfilter', 'test_env_test_l2_net_dev', 'define', 1),
+            ('missing', 'volume',
+             '/default-pool/test_env_test_node_test_volume', None, None),
+            ('mismatch', 'domain', 'test_env_test_node', 'update-uuid',
+             None),
+            ('orphan', 'nwfilter',
+             'test_env_test_l2_net_dev_64:52:dc:96:12:cc', 'remove', 2),
+        ]
+        assert all(item['env'] == 'test_env' for item in drift)
+
+        self.libvirt_nwfilter_define_mock.reset_mock()
+        repaired = repair_drift(
+            [dict(item, driver=self.d) for item in drift])
+        assert len(repaired) == 3
+        assert Node.objects.get(name='test_node').uuid == domain_uuid
+        assert sorted(domain.name() for domain in
+                      self.d.conn.listAllDomains()) == [
+            'other_vm', 'test_env_7_test_node', 'test_env_orphan',
+            'test_env_test_node', 'test_env_test_node2']
+        self.libvirt_nwfilter_define_mock.assert_called_once_with(
+            self.l2_net_dev.build_filter_xml())
+        self.libvirt_nwfilter_lookup_mock.assert_called_once_with(
+            'test_env_test_l2_net_dev_64:52:dc:96:12:cc')
+
 
 class TestLibvirtDriverDeviceNames(LibvirtTestCase):
 
@@ -0,0 +1,81 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+import unittest
+
+import libvirt
+import mock
+
+from devops.driver.libvirt import libvirt_events
+from devops.driver.libvirt.libvirt_events import DomainEventWatcher
+
+
+class TestDomainEventWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = mock.Mock()
+        self.dom = mock.Mock()
+        self.dom.UUIDString.return_value = 'uuid1'
+        self.watcher = DomainEventWatcher(self.conn)
+        self.callbacks = {
+            call[0][1]: call[0][2]
+            for call in self.conn.domainEventRegisterAny.call_args_list}
+
+    def test_register(self):
+        assert set(self.callbacks) == {
+            libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+            libvirt.VIR_DOMAIN_EVENT_ID_REBOOT}
+
+    def test_wait_event(self):
+        state = {'active': False}
+
+        def lifecycle_event():
+            state['active'] = True
+            self.callbacks[libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE](
+                self.conn, self.dom, libvirt.VIR_DOMAIN_EVENT_STARTED, 0,
+                None)
+
+        timer = threading.Timer(0.1, lifecycle_event)
+        timer.start()
+        assert self.watcher.wait('uuid1', lambda: state['active'], 10)
+        timer.join()
+
+    def test_wait_timeout(self):
+        self.watcher.recheck = 0.01
+        predicate = mock.Mock(return_value=False)
+        assert not self.watcher.wait('uuid1', predicate, 0.05)
+        assert predicate.called
+
+    def test_reboots(self):
+        assert self.watcher.get_reboots('uuid1') == 0
+        self.callbacks[libvirt.VIR_DOMAIN_EVENT_ID_REBOOT](
+            self.conn, self.dom, None)
+        assert self.watcher.get_reboots('uuid1') == 1
+
+
+class TestEventLoop(unittest.TestCase):
+
+    @mock.patch('devops.driver.libvirt.libvirt_events.time.sleep')
+    @mock.patch('libvirt.virEventRunDefaultImpl')
+    def test_run_event_loop_error(self, run_mock, sleep_mock):
+        # KeyboardInterrupt stops the endless loop of the test
+        run_mock.side_effect = [libvirt.libvirtError('failed'), None,
+                                KeyboardInterrupt]
+
+        with self.assertRaises(KeyboardInterrupt):
+            libvirt_events._run_event_loop()
+
+        assert run_mock.call_count == 3
+        sleep_mock.assert_called_once_with(1)
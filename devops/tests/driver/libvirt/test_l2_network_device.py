@@ -12,7 +12,11 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import xml.etree.ElementTree as ET
+
+import libvirt
 import mock
+from netaddr import IPAddress
 from netaddr import IPNetwork
 
 from devops.error import DevopsObjNotFound
@@ -73,6 +77,94 @@ class TestLibvirtL2NetworkDevice(LibvirtTestCase):
             "  </ip>\n"
             "</network>\n".format(self.l2_net_dev.uuid))
 
+    def test_update_dhcp_hosts(self):
+        self.l2_net_dev.has_dhcp_server = True
+        self.l2_net_dev.save()
+        node = self.group.add_node(
+            name='test_node',
+            role='default',
+            architecture='i686',
+            hypervisor='test',
+        )
+        eth0 = node.add_interface(
+            label='eth0',
+            l2_network_device_name='test_l2_net_dev',
+            mac_address='64:52:dc:96:12:cc',
+            interface_model='virtio',
+        )
+        self.l2_net_dev.define()
+        eth1 = node.add_interface(
+            label='eth1',
+            l2_network_device_name='test_l2_net_dev',
+            mac_address='64:52:DC:96:12:CD',
+            interface_model='virtio',
+        )
+
+        update_mock = self.patch('libvirt.virNetwork.update')
+        # eth0 is added by define() already
+        self.l2_net_dev.update_dhcp_hosts(add=[eth0, eth1])
+        update_mock.assert_called_once_with(
+            libvirt.VIR_NETWORK_UPDATE_COMMAND_ADD_LAST,
+            libvirt.VIR_NETWORK_SECTION_IP_DHCP_HOST, -1, mock.ANY,
+            libvirt.VIR_NETWORK_UPDATE_AFFECT_CONFIG)
+        host = ET.fromstring(update_mock.call_args[0][3].encode('utf-8'))
+        # the name is used by the entry of eth0
+        assert host.attrib == {
+            'mac': '64:52:DC:96:12:CD',
+            'ip': eth1.addresses[0].ip_address}
+
+        update_mock.reset_mock()
+        self.l2_net_dev.start()
+        self.l2_net_dev.update_dhcp_hosts(remove=[eth0, eth1])
+        update_mock.assert_called_once_with(
+            libvirt.VIR_NETWORK_UPDATE_COMMAND_DELETE,
+            libvirt.VIR_NETWORK_SECTION_IP_DHCP_HOST, -1, mock.ANY,
+            libvirt.VIR_NETWORK_UPDATE_AFFECT_CONFIG |
+            libvirt.VIR_NETWORK_UPDATE_AFFECT_LIVE)
+        host = ET.fromstring(update_mock.call_args[0][3])
+        assert host.get('mac') == '64:52:dc:96:12:cc'
+
+    def test_dhcp_hosts_names(self):
+        self.l2_net_dev.has_dhcp_server = True
+        self.l2_net_dev.save()
+        nodes = [self.group.add_node(
+            name=name,
+            role='default',
+            architecture='i686',
+            hypervisor='test',
+        ) for name in ('test_node1', 'test_node2', 'test_node3')]
+        for node in nodes[:2]:
+            for label in ('eth0', 'eth1'):
+                node.add_interface(
+                    label=label,
+                    l2_network_device_name='test_l2_net_dev',
+                    interface_model='virtio',
+                )
+        self.l2_net_dev.define()
+
+        xml = ET.fromstring(self.l2_net_dev._libvirt_network.XMLDesc(0))
+        hosts = xml.findall('./ip/dhcp/host')
+        assert len(hosts) == 4
+        names = [host.get('name') for host in hosts if host.get('name')]
+        assert sorted(names) == ['test_node1', 'test_node2']
+
+        interfaces = [node.add_interface(
+            label=label,
+            l2_network_device_name='test_l2_net_dev',
+            interface_model='virtio',
+        ) for node, label in ((nodes[0], 'eth2'),
+                              (nodes[2], 'eth0'),
+                              (nodes[2], 'eth1'))]
+        update_mock = self.patch('libvirt.virNetwork.update')
+        self.l2_net_dev.update_dhcp_hosts(add=interfaces)
+
+        added = [ET.fromstring(call[0][3].encode('utf-8'))
+                 for call in update_mock.call_args_list]
+        assert [host.get('mac') for host in added] == [
+            interface.mac_address for interface in interfaces]
+        assert [host.get('name') for host in added] == [
+            None, 'test_node3', None]
+
     def test_start_destroy(self):
         self.l2_net_dev.define()
         assert self.l2_net_dev.is_active() == 0
@@ -117,3 +209,37 @@ class TestLibvirtL2NetworkDevice(LibvirtTestCase):
         assert len(self.env.get_networks()) == 1
         l2dev = self.env.get_network(name='test_l2_net_dev')
         assert l2dev.id == self.l2_net_dev.id
+
+    def test_replica(self):
+        group2 = self.env.add_group(
+            group_name='test_group_host2',
+            driver_name='devops.driver.libvirt',
+            connection_string='test:///default')
+        replica = group2.add_l2_network_device(
+            name='test_l2_net_dev_host2',
+            address_pool='test_ap',
+            replica_of='test_l2_net_dev',
+        )
+        node = group2.add_node(
+            name='test_node',
+            role='default',
+            architecture='i686',
+            hypervisor='test',
+        )
+        interface = node.add_interface(
+            label='eth0',
+            l2_network_device_name='test_l2_net_dev_host2',
+            interface_model='virtio',
+        )
+
+        assert [r.id for r in self.l2_net_dev.replicas] == [replica.id]
+        assert self.l2_net_dev.replicas[0].replica_of == 'test_l2_net_dev'
+        assert (IPAddress(interface.addresses[0].ip_address) in
+                IPNetwork('172.0.0.0/24'))
+        assert len(self.env.get_networks()) == 1
+
+        self.l2_net_dev.define()
+        replica.define()
+        xml = replica._libvirt_network.XMLDesc(0)
+        assert '<ip ' not in xml
+        assert '<forward' not in xml
@@ -14,10 +14,14 @@
 
 import re
 
+from django.test import override_settings
 import mock
 import pytest
 
+from devops.error import DevopsError
+from devops.error import DevopsResourcesError
 from devops.models import Environment
+from devops.models import Interface
 from devops.tests.driver.libvirt.base import LibvirtTestCase
 
 
@@ -142,6 +146,121 @@ class TestLibvirtNode(LibvirtTestCase):
 </domain>
 """, xml)
 
+    def test_interface_driver(self):
+        assert self.interface.get_driver_attrs() == {}
+
+        self.node.vcpu = 4
+        self.node.save()
+        interface = self.node.add_interface(
+            label='eth1',
+            l2_network_device_name='test_l2_net_dev',
+            interface_model='virtio',
+            net_driver=dict(name='vhost', rx_queue_size=1024),
+        )
+        assert interface.get_driver_attrs() == {
+            'name': 'vhost', 'queues': 4, 'rx_queue_size': 1024}
+
+        interface.net_driver.queues = 1
+        assert interface.get_driver_attrs() == {
+            'name': 'vhost', 'rx_queue_size': 1024}
+
+        interface.model = 'e1000'
+        assert interface.get_driver_attrs() == {}
+
+    def test_cpu_pinning(self):
+        self.patch('devops.driver.libvirt.libvirt_driver.file_lock')
+        self.patch('devops.driver.libvirt.libvirt_placement.get_host_cells',
+                   return_value=[
+                       dict(id=0, cpus=[0, 1, 2], memory=4194304, pages={}),
+                       dict(id=1, cpus=[3, 4, 5], memory=4194304, pages={}),
+                   ])
+        self.patch('devops.driver.libvirt.libvirt_driver.LibvirtDriver.'
+                   'get_cells_free_memory', return_value={0: 4096, 1: 4096})
+        self.d.cpu_pinning = True
+        self.d.save()
+        self.node.vcpu = 2
+        self.node.save()
+
+        self.node.define()
+        assert self.node.placement == [dict(
+            cell=0, host_cell=0, vcpus=[0, 1], cpus=[0, 1], memory=1024)]
+        assert self.d.get_pinned_cpus() == {0, 1}
+        assert self.d.get_pinned_cpus(exclude=self.node.uuid) == set()
+        # Memory of the stopped node is kept for it
+        assert self.d.get_reserved_memory() == {0: 1024}
+        assert self.d.get_reserved_memory(exclude=self.node.uuid) == {}
+
+        node2 = self.group.add_node(
+            name='test_node2',
+            role='default',
+            architecture='i686',
+            hypervisor='test',
+            vcpu=2,
+        )
+        node2.define()
+        assert node2.placement == [dict(
+            cell=0, host_cell=1, vcpus=[0, 1], cpus=[3, 4], memory=1024)]
+
+        node3 = self.group.add_node(
+            name='test_node3',
+            role='default',
+            architecture='i686',
+            hypervisor='test',
+            vcpu=2,
+        )
+        with pytest.raises(DevopsError):
+            node3.define()
+
+    def test_resources_report(self):
+        rows = {row['resource']: row
+                for row in self.env.get_resources_report()}
+        assert sorted(rows) == ['disk', 'disk capacity', 'memory', 'vcpus']
+        assert rows['memory']['required'] == 1024
+        assert rows['vcpus']['required'] == 1
+        assert rows['disk']['required'] == 0
+        assert rows['disk capacity']['required'] == 5 * 1024
+        assert rows['memory']['host'] == 'test:///default'
+
+        self.node.memory = 1024 ** 3
+        self.node.save()
+        with pytest.raises(DevopsResourcesError) as e:
+            self.env.check_resources()
+        assert [row['resource'] for row in e.value.report] == ['memory']
+
+        with override_settings(ADMISSION_CONTROL=True):
+            with pytest.raises(DevopsResourcesError):
+                self.env.define()
+        assert self.d.node_list() == []
+        assert self.volume.uuid is None
+
+    def test_resources_report_groups(self):
+        group2 = self.env.add_group(
+            group_name='test_group2',
+            driver_name='devops.driver.libvirt',
+            connection_string='test:///default',
+            storage_pool_name='default-pool',
+        )
+        group2.add_node(
+            name='test_node2',
+            role='default',
+            architecture='i686',
+            hypervisor='test',
+            memory=2048,
+        )
+
+        report = self.env.get_resources_report()
+        rows = {row['resource']: row for row in report}
+        # Both groups are on the same host, requirements are summed
+        assert len(report) == len(rows)
+        assert rows['memory']['required'] == 1024 + 2048
+        assert rows['vcpus']['required'] == 2
+
+        self.node.memory = rows['memory']['available'] - 1024
+        self.node.save()
+        with pytest.raises(DevopsResourcesError) as e:
+            self.env.check_resources()
+        assert [row['resource'] for row in e.value.report] == ['memory']
+
     def test_set_memory_set_cpu(self):
         pass
 
@@ -164,12 +283,58 @@ class TestLibvirtNode(LibvirtTestCase):
 
         assert not self.node.exists()
 
+    def test_wait_for_state(self):
+        self.node.define()
+        self.node.start()
+        self.node.wait_for_state('running', timeout=1)
+        self.node.suspend()
+        self.node.wait_for_state('paused', timeout=1)
+        self.node.destroy()
+        self.node.wait_for_state('shutoff', timeout=1)
+
+    def test_wait_for_state_polling(self):
+        self.patch('devops.driver.libvirt.libvirt_driver.'
+                   'LibvirtDriver.event_watcher',
+                   new_callable=mock.PropertyMock, return_value=None)
+        self.node.define()
+        self.node.wait_for_state('shutoff', timeout=1)
+        self.node.start()
+        self.node.wait_for_state('running', timeout=1)
+
     def test_attrs(self):
         self.node.define()
 
         assert self.node.get_vnc_port() == '-1'
         assert self.node.vnc_password == '123456'
 
+    def test_inventory(self):
+        self.node.define()
+        self.node.start()
+
+        inventory = self.d.get_domains_inventory(
+            uuids=[self.node.uuid], details=('devices', 'snapshots'))
+        assert list(inventory) == [self.node.uuid]
+        assert inventory[self.node.uuid]['name'] == 'test_env_test_node'
+        assert inventory[self.node.uuid]['active']
+        assert inventory[self.node.uuid]['snapshots_count'] == 0
+
+        with mock.patch('libvirt.virDomain.XMLDesc') as xml_desc:
+            with mock.patch('libvirt.virDomain.snapshotListNames') as names:
+                state = self.d.get_domains_inventory(uuids=[self.node.uuid])
+                assert not xml_desc.called
+                assert not names.called
+        assert state[self.node.uuid]['active']
+        assert 'snapshots' not in state[self.node.uuid]
+
+        with self.env.inventory(details=('devices', 'snapshots')):
+            with mock.patch('libvirt.virConnect.lookupByUUIDString') as lookup:
+                assert self.node.is_active()
+                assert self.node.get_vnc_port() == \
+                    inventory[self.node.uuid]['vnc_port']
+                assert not self.node.has_snapshot('test')
+                assert not lookup.called
+        assert self.d.get_inventory(self.node.uuid) is None
+
     def test_send_keys(self):
         self.node.define()
         self.node.start()
@@ -177,10 +342,190 @@ class TestLibvirtNode(LibvirtTestCase):
         with mock.patch('libvirt.virDomain.sendKey') as send_key:
             send_key.return_value = 0
             self.node.send_keys('123<Wait>\n<Enter>')
-            send_key.assert_has_calls([
+            # Every key is sent separately by default
+            assert send_key.call_args_list == [
                 mock.call(0, 0, [2], 1, 0),
                 mock.call(0, 0, [3], 1, 0),
                 mock.call(0, 0, [4], 1, 0),
                 mock.call(0, 0, [28], 1, 0),
-            ])
+            ]
             self.libvirt_sleep_mock.assert_called_once_with(1)
+
+    def test_send_keys_batched(self):
+        self.d.keys_batch_size = 16
+        self.d.keys_hold_time = 10
+        self.d.save()
+        self.node.define()
+        self.node.start()
+
+        with mock.patch('libvirt.virDomain.sendKey') as send_key:
+            send_key.return_value = 0
+            self.node.send_keys('123<Wait3>A\n<Enter>')
+            assert send_key.call_args_list == [
+                mock.call(0, 10, [2, 3, 4], 3, 0),
+                mock.call(0, 10, [0x2a, 0x1e], 2, 0),
+                mock.call(0, 10, [28], 1, 0),
+            ]
+            self.libvirt_sleep_mock.assert_called_once_with(3.0)
+
+    def test_kernel_boot_cmdline(self):
+        self.patch('devops.models.node.Node.format_kernel_cmd',
+                   side_effect=lambda kernel_cmd: kernel_cmd)
+        self.node.kernel_cmd = (
+            '<Wait>\n<Esc>\n<Wait>\n'
+            'vmlinuz initrd=initrd.img ks=cdrom:/ks.cfg\n'
+            ' ip=10.109.0.2\n'
+            ' showmenu=no\n'
+            ' <Enter>\n')
+        assert self.node.get_kernel_boot_cmdline() == \
+            'ks=cdrom:/ks.cfg ip=10.109.0.2 showmenu=no'
+
+    def test_kernel_boot(self):
+        self.patch('devops.models.node.Node.format_kernel_cmd',
+                   side_effect=lambda kernel_cmd: kernel_cmd)
+        self.patch('devops.driver.libvirt.libvirt_driver.'
+                   'LibvirtNode._get_boot_iso', return_value='/tmp/fuel.iso')
+        get_files_mock = self.patch(
+            'devops.driver.libvirt.libvirt_driver.'
+            'LibvirtDriver.get_kernel_boot_files',
+            return_value=['/pool/vmlinuz', '/pool/initrd.img'])
+        wait_mock = self.patch('devops.driver.libvirt.libvirt_driver.'
+                               'LibvirtNode.wait_for_state')
+        self.node.kernel_cmd = 'vmlinuz initrd=initrd.img ks=cdrom:/ks.cfg'
+        self.node.kernel_boot.enabled = True
+        self.node.define()
+
+        conn = self.d.conn
+        with mock.patch.object(conn, 'defineXML',
+                               wraps=conn.defineXML) as define_mock:
+            self.node._start_setup()
+
+        get_files_mock.assert_called_once_with(
+            '/tmp/fuel.iso', ['/isolinux/vmlinuz', '/isolinux/initrd.img'])
+        wait_mock.assert_called_once_with('shutoff', timeout=600)
+        assert define_mock.call_count == 2
+        xml = define_mock.call_args_list[0][0][0]
+        assert '<kernel>/pool/vmlinuz</kernel>' in xml
+        assert '<initrd>/pool/initrd.img</initrd>' in xml
+        assert '<cmdline>ks=cdrom:/ks.cfg</cmdline>' in xml
+        assert '<on_reboot>destroy</on_reboot>' in xml
+        xml = define_mock.call_args_list[1][0][0]
+        assert '<kernel>' not in xml
+        assert self.node.is_active()
+
+    def test_golden_image_key(self):
+        self.patch('devops.models.node.Node.format_kernel_cmd',
+                   side_effect=lambda kernel_cmd: kernel_cmd)
+        self.node.kernel_cmd = 'vmlinuz ip={ip}'
+
+        key = self.node.golden_image_key
+        assert key == self.node.golden_image_key
+
+        self.node.memory = 2048
+        assert key != self.node.golden_image_key
+
+    def test_golden_image_restore_missing(self):
+        self.patch('devops.models.node.Node.format_kernel_cmd',
+                   side_effect=lambda kernel_cmd: kernel_cmd)
+        self.node.define()
+        self.node.kernel_cmd = 'vmlinuz ip={ip}'
+
+        with self.settings(GOLDEN_IMAGES_DIR='/nonexistent'):
+            assert self.node.get_golden_image() is None
+            assert not self.node.golden_image_restore()
+        assert not self.node.is_active()
+
+    def test_golden_image_restore(self):
+        self.node.define()
+        self.node.kernel_cmd = 'vmlinuz'
+        lock_mock = self.patch(
+            'devops.driver.libvirt.libvirt_driver.file_lock')
+        self.patch('devops.driver.libvirt.libvirt_driver.LibvirtNode.'
+                   'golden_image_key', new_callable=mock.PropertyMock,
+                   return_value='0a1b')
+        self.patch('devops.driver.libvirt.libvirt_driver.LibvirtNode.'
+                   'get_golden_image',
+                   return_value=dict(
+                       volumes={'sda': '/default-pool/golden_sda'},
+                       macs=[self.interface.mac_address]))
+        overlay_mock = self.patch('devops.driver.libvirt.libvirt_driver.'
+                                  'LibvirtVolume.recreate_as_overlay')
+        restore_mock = self.patch('libvirt.virConnect.restoreFlags')
+
+        assert self.node.golden_image_restore()
+
+        overlay_mock.assert_called_once_with('/default-pool/golden_sda')
+        assert lock_mock.call_args[0][0].endswith('0a1b.json.lock')
+        # Booted from the disk overlays, memory state is not restored
+        assert not restore_mock.called
+        assert self.node.is_active()
+
+    def test_golden_image_stop(self):
+        self.node.define()
+        self.node.start()
+        remote_mock = self.patch('devops.models.node.Node.remote')
+        shutdown_mock = self.patch(
+            'devops.driver.libvirt.libvirt_driver.LibvirtNode.shutdown')
+
+        # Without ACPI the guest ignores the shutdown request
+        self.node._golden_image_stop()
+        assert not shutdown_mock.called
+        remote = remote_mock.return_value.__enter__.return_value
+        remote.check_call.assert_called_once_with('sync')
+        assert not self.node.is_active()
+
+    def test_golden_image_adopt_macs(self):
+        self.node.define()
+        dhcp_mock = self.patch('devops.driver.libvirt.libvirt_driver.'
+                               'LibvirtNode.update_dhcp_hosts')
+
+        assert self.node._golden_image_adopt_macs(['64:52:dc:96:12:cc'])
+
+        # Entries of the old addresses are removed, define() adds the new
+        assert dhcp_mock.call_args_list == [mock.call(remove=True),
+                                            mock.call()]
+        assert Interface.objects.get(
+            pk=self.interface.pk).mac_address == '64:52:dc:96:12:cc'
+
+    def test_update_filters(self):
+        def nwfilter(name, blocked):
+            nwfilter = mock.Mock()
+            nwfilter.name.return_value = name
+            nwfilter.UUIDString.return_value = name + '-uuid'
+            nwfilter.XMLDesc.return_value = (
+                '<filter name="{0}">{1}</filter>'.format(
+                    name, '<rule action="drop"><all/></rule>'
+                    if blocked else ''))
+            return nwfilter
+
+        iface_filter = nwfilter(self.interface.nwfilter_name, False)
+        net_filter = nwfilter(self.l2_net_dev.nwfilter_name, True)
+        other_filter = nwfilter('clean-traffic', False)
+        self.libvirt_nwfilter_list_mock.return_value = [
+            iface_filter, net_filter, other_filter]
+        self.libvirt_nwfilter_define_mock.reset_mock()
+
+        states = self.d.get_filter_states(
+            names=[self.interface.nwfilter_name,
+                   self.l2_net_dev.nwfilter_name])
+        assert not other_filter.XMLDesc.called
+
+        changed = self.d.update_filters(
+            block=[self.interface], unblock=[self.l2_net_dev],
+            states=states)
+        assert changed == [self.interface, self.l2_net_dev]
+        assert self.libvirt_nwfilter_define_mock.call_args_list == [
+            mock.call(self.interface.build_filter_xml(
+                uuid=iface_filter.name() + '-uuid', blocked=True)),
+            mock.call(self.l2_net_dev.build_filter_xml(
+                uuid=net_filter.name() + '-uuid')),
+        ]
+
+        # The view is updated, nothing is queried or redefined again
+        self.libvirt_nwfilter_define_mock.reset_mock()
+        assert self.d.update_filters(
+            block=[self.interface], unblock=[self.l2_net_dev],
+            states=states) == []
+        assert not self.libvirt_nwfilter_define_mock.called
+        assert self.libvirt_nwfilter_list_mock.call_count == 1
+        assert iface_filter.XMLDesc.call_count == 1
@@ -46,6 +46,9 @@ class TestLibvirtNodeSnapshotBase(LibvirtTestCase):
         )
         self.nwfilter.UUIDString.return_value = \
             'e3db79b5-717c-4b15-9198-ecad569c1ea2'
+        self.nwfilter.name.return_value = \
+            'tenv_test_l2_net_dev_64:5d:8b:a9:ac:ec'
+        self.libvirt_nwfilter_list_mock.return_value = [self.nwfilter]
 
         self.env = Environment.create('tenv')
         self.group = self.env.add_group(
@@ -274,9 +277,12 @@ class TestLibvirtNodeSnapshot(TestLibvirtNodeSnapshotBase):
         self.interface.block()
 
         self.libvirt_nwfilter_define_mock.reset_mock()
+        self.libvirt_nwfilter_lookup_mock.reset_mock()
         with mock.patch('libvirt.virDomain.revertToSnapshot') as rev_mock:
             self.node.revert(name='test1')
             assert rev_mock.called
+            self.libvirt_nwfilter_list_mock.assert_called_once_with(0)
+            assert not self.libvirt_nwfilter_lookup_mock.called
             self.libvirt_nwfilter_define_mock.assert_called_once_with(
                 '<?xml version="1.0" encoding="utf-8"?>\n'
                 '<filter name="tenv_test_l2_net_dev_64:5d:8b:a9:ac:ec">\n'
@@ -291,8 +297,29 @@ class TestLibvirtNodeSnapshot(TestLibvirtNodeSnapshotBase):
 
         with mock.patch('libvirt.virDomain.destroy') as dest_mock:
             self.node.revert(name='test1')
+            assert not dest_mock.called
+            self.node.revert(name='test1', destroy=True)
             dest_mock.assert_called_once_with()
 
+    def test_revert_resume(self):
+        self.node.start()
+        self.node.snapshot(name='test1')
+
+        with mock.patch('libvirt.virDomain.revertToSnapshot') as rev_mock:
+            self.node.revert(name='test1', resume=True)
+            rev_mock.assert_called_once_with(
+                mock.ANY, libvirt.VIR_DOMAIN_SNAPSHOT_REVERT_RUNNING)
+            rev_mock.reset_mock()
+            self.node.revert(name='test1', resume=False)
+            rev_mock.assert_called_once_with(
+                mock.ANY, libvirt.VIR_DOMAIN_SNAPSHOT_REVERT_PAUSED)
+
+        self.node.destroy()
+        self.node.snapshot(name='test2')
+        with mock.patch('libvirt.virDomain.revertToSnapshot') as rev_mock:
+            self.node.revert(name='test2', resume=True)
+            rev_mock.assert_called_once_with(mock.ANY, 0)
+
 
 @pytest.mark.xfail(reason="need libvirtd >= 1.2.12")
 class TestLibvirtNodeExternalSnapshot(TestLibvirtNodeSnapshotBase):
@@ -466,6 +493,71 @@ class TestLibvirtNodeExternalSnapshot(TestLibvirtNodeSnapshotBase):
         assert snap_vol
         assert snap_vol.backing_store.id == main_vol.id
 
+    def test_snapshot_stats(self):
+        self.snap_xmls_dict['test1'] = (
+            '<domainsnapshot>\n'
+            '    <name>test1</name>\n'
+            '    <memory file="/tmp/snap/'
+            'snapshot-memory-tenv_tnode.test1-1" '
+            'snapshot="external"/>\n'
+            '    <domain>\n'
+            '        <cpu mode="host-model" />\n'
+            '    </domain>\n'
+            '</domainsnapshot>')
+        memory_file = '/tmp/snap/snapshot-memory-tenv_tnode.test1-1'
+        self.is_file_dict[memory_file] = True
+        self.os_mock.path.getsize.return_value = 1024
+        format_mock = self.patch(
+            'devops.driver.libvirt.libvirt_driver.get_save_image_format',
+            return_value='raw')
+        warning_mock = self.patch(
+            'devops.driver.libvirt.libvirt_driver.logger.warning')
+        self.d.snapshot_memory_compression = 'lzop'
+        self.d.snapshot_memory_bypass_cache = True
+        self.d.save()
+
+        self.node.start()
+        self.node.snapshot(name='test1', external=True)
+
+        stats = self.node.snapshot_stats['test1']
+        assert stats['memory_size'] == 1024
+        assert stats['memory_format'] == 'raw'
+        assert stats['duration'] >= 0
+        format_mock.assert_called_once_with(memory_file)
+        assert warning_mock.call_count == 1
+        self.os_mock.posix_fadvise.assert_called_once_with(
+            self.os_mock.open.return_value, 0, 0,
+            self.os_mock.POSIX_FADV_DONTNEED)
+
+        self.node.erase_snapshot('test1')
+        assert 'test1' not in self.node.snapshot_stats
+
+    def test_revert_bypass_cache(self):
+        self.snap_xmls_dict['test1'] = (
+            '<domainsnapshot>\n'
+            '    <name>test1</name>\n'
+            '    <state>running</state>\n'
+            '    <memory file="/tmp/snap/'
+            'snapshot-memory-tenv_tnode.test1" '
+            'snapshot="external"/>\n'
+            '    <domain>\n'
+            '        <cpu mode="host-model" />\n'
+            '    </domain>\n'
+            '</domainsnapshot>')
+        restore_mock = self.patch('libvirt.virConnect.restoreFlags')
+        self.d.snapshot_memory_bypass_cache = True
+        self.d.save()
+
+        self.node.start()
+        self.node.snapshot(name='test1', external=True)
+        self.node._redefine_external_snapshot('test1')
+
+        restore_mock.assert_called_once_with(
+            '/tmp/snap/snapshot-memory-tenv_tnode.test1',
+            dxml=mock.ANY,
+            flags=(libvirt.VIR_DOMAIN_SAVE_PAUSED |
+                   libvirt.VIR_DOMAIN_SAVE_BYPASS_CACHE))
+
     def test_set_snapshot_current(self):
         self.snap_xmls_dict['test1'] = (
             '<domainsnapshot>\n'
@@ -1258,3 +1350,159 @@ class TestLibvirtNodeExternalSnapshot(TestLibvirtNodeSnapshotBase):
                       (libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_REDEFINE |
                        libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_CURRENT)),
         ])
+
+    def _add_chain(self, *names):
+        disk = self.node.disk_devices[0]
+        volume = disk.volume
+        for name in names:
+            volume = volume.create_child(name)
+            volume.define()
+        disk.volume = volume
+        disk.save()
+        return volume
+
+    def test_flatten(self):
+        rebase_mock = self.patch('libvirt.virDomain.blockRebase')
+        job_mock = self.patch('libvirt.virDomain.blockJobInfo')
+        job_mock.return_value = {}
+        self.patch('devops.driver.libvirt.libvirt_driver.'
+                   'LibvirtNode.get_snapshots', return_value=[])
+
+        volume = self._add_chain('tvol.s1', 'tvol.s2')
+        self.node.start()
+        assert self.node.get_chain_depth() == 2
+
+        assert self.node.flatten(max_depth=2) == []
+        assert self.node.flatten(max_depth=1) == ['sda']
+
+        rebase_mock.assert_called_once_with(
+            'sda', '/default-pool/tenv_tnode_tvol', 0, 0)
+        volume = self.node.get_volume(pk=volume.pk)
+        assert volume.backing_store == self.volume
+        assert self.node.disk_devices[0].volume == volume
+        assert self.node.get_chain_depth() == 1
+        assert self.snap_create_xml_mock.called is False
+
+    def test_flatten_snapshot_volume(self):
+        rebase_mock = self.patch('libvirt.virDomain.blockRebase')
+        job_mock = self.patch('libvirt.virDomain.blockJobInfo')
+        job_mock.return_value = {}
+        self.snap_create_xml_mock.side_effect = None
+
+        volume = self._add_chain('tvol.s1', 'tvol.s2')
+        snapshot = mock.Mock(disks={'sda': volume.get_path()})
+        self.patch('devops.driver.libvirt.libvirt_driver.'
+                   'LibvirtNode.get_snapshots', return_value=[snapshot])
+        self.node.start()
+
+        assert self.node.flatten(max_depth=0) == ['sda']
+
+        overlay = self.node.disk_devices[0].volume
+        assert overlay.name.startswith('tvol.flatten-')
+        assert overlay.backing_store is None
+        xml = self.snap_create_xml_mock.call_args[0][0]
+        assert 'file="{0}"'.format(overlay.get_path()) in xml
+        self.snap_create_xml_mock.assert_called_once_with(
+            xml,
+            (libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY |
+             libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_REUSE_EXT |
+             libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA))
+        rebase_mock.assert_called_once_with('sda', None, 0, 0)
+
+        # volumes of the snapshot are kept
+        volume = self.node.get_volume(pk=volume.pk)
+        assert volume.backing_store.name == 'tvol.s1'
+        assert volume.exists()
+
+    def test_revert_removes_flatten_overlay(self):
+        volume = self._add_chain('tvol.s1')
+        overlay = self._add_chain('tvol.flatten-1')
+        snapshot = mock.Mock(get_type='external',
+                             disks={'sda': volume.get_path()})
+        self.patch('devops.driver.libvirt.libvirt_driver.'
+                   'LibvirtNode.get_snapshots', return_value=[snapshot])
+        self.patch('devops.driver.libvirt.libvirt_driver.'
+                   'LibvirtNode.has_snapshot', return_value=True)
+        self.patch('devops.driver.libvirt.libvirt_driver.'
+                   'LibvirtNode._get_snapshot', return_value=snapshot)
+
+        def revert(name, resume=None):
+            disk = self.node.disk_devices[0]
+            disk.volume = volume
+            disk.save()
+        self.patch('devops.driver.libvirt.libvirt_driver.'
+                   'LibvirtNode._revert_external_snapshot',
+                   side_effect=revert)
+
+        self.node.revert('test1')
+
+        assert self.node.disk_devices[0].volume == volume
+        assert not self.node.get_volumes(pk=overlay.pk).exists()
+        assert self.node.get_volume(pk=volume.pk).exists()
+
+
+class TestLibvirtEnvironmentClone(TestLibvirtNodeSnapshotBase):
+
+    def setUp(self):
+        super(TestLibvirtEnvironmentClone, self).setUp()
+
+        self.snap_volumes_mock = self.patch(
+            'devops.driver.libvirt.libvirt_driver.'
+            'LibvirtNode.get_snapshot_volumes')
+        self.snap_volumes_mock.return_value = {
+            'sda': '/default-pool/tenv_tnode_tvol'}
+
+    def test_clone(self):
+        self.node.snapshot_stats = {'test1': {'memory_size': 1024}}
+        self.node.placement = [[0]]
+        self.node.save()
+        clone = self.env.clone('tenv_clone', snapshot='test1', start=False)
+
+        self.snap_volumes_mock.assert_called_once_with('test1')
+
+        ap = clone.get_address_pool(name='test_ap')
+        assert ap.net != self.ap.net
+        assert ap.ip_network.prefixlen == 24
+        assert ap.get_ip('l2_network_device') == str(ap.ip_network[1])
+
+        l2_net_dev = clone.get_env_l2_network_device(name='test_l2_net_dev')
+        assert l2_net_dev.address_pool == ap
+        assert l2_net_dev.uuid != self.l2_net_dev.uuid
+        assert l2_net_dev.forward.mode == 'nat'
+
+        node = clone.get_node(name='tnode')
+        assert node.exists()
+        assert node.uuid != self.node.uuid
+        assert node.snapshot_stats == {}
+        assert node.placement == []
+        interface = node.interfaces[0]
+        assert interface.label == 'eth0'
+        assert interface.mac_address != self.interface.mac_address
+
+        volume = node.get_volume(name='tvol')
+        assert volume.base_image == '/default-pool/tenv_tnode_tvol'
+        assert volume.format == 'qcow2'
+        assert volume.get_path() == '/default-pool/tenv_clone_tnode_tvol'
+        assert node.disk_devices[0].target_dev == 'sda'
+
+    def test_erase_cloned(self):
+        assert self.volume.get_path() == '/default-pool/tenv_tnode_tvol'
+        clone = self.env.clone('tenv_clone', snapshot='test1', start=False)
+
+        # Volumes of the clone would lose their backing store
+        with self.assertRaises(DevopsError):
+            self.env.erase()
+        assert self.volume.exists()
+        assert Environment.objects.filter(name='tenv').exists()
+
+        clone.erase()
+        self.env.erase()
+        assert not Environment.objects.filter(name='tenv').exists()
+
+    def test_clone_failed(self):
+        self.snap_volumes_mock.side_effect = DevopsError('internal')
+
+        with self.assertRaises(DevopsError):
+            self.env.clone('tenv_clone', snapshot='test1', start=False)
+
+        assert not Environment.objects.filter(name='tenv_clone').exists()
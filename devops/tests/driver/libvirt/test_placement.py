@@ -0,0 +1,162 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from devops.driver.libvirt import libvirt_placement
+from devops.error import DevopsError
+
+
+CAPABILITIES = """
+<capabilities>
+  <host>
+    <topology>
+      <cells num="2">
+        <cell id="0">
+          <memory unit="KiB">8388608</memory>
+          <pages unit="KiB" size="4">2097152</pages>
+          <pages unit="KiB" size="2048">512</pages>
+          <cpus num="4">
+            <cpu id="0" socket_id="0" core_id="0" siblings="0,2"/>
+            <cpu id="1" socket_id="0" core_id="1" siblings="1,3"/>
+            <cpu id="2" socket_id="0" core_id="0" siblings="0,2"/>
+            <cpu id="3" socket_id="0" core_id="1" siblings="1,3"/>
+          </cpus>
+        </cell>
+        <cell id="1">
+          <memory unit="KiB">8388608</memory>
+          <pages unit="KiB" size="4">2097152</pages>
+          <pages unit="KiB" size="2048">0</pages>
+          <cpus num="4">
+            <cpu id="4" socket_id="1" core_id="0" siblings="4,6"/>
+            <cpu id="5" socket_id="1" core_id="1" siblings="5,7"/>
+            <cpu id="6" socket_id="1" core_id="0" siblings="4,6"/>
+            <cpu id="7" socket_id="1" core_id="1" siblings="5,7"/>
+          </cpus>
+        </cell>
+      </cells>
+    </topology>
+  </host>
+</capabilities>
+"""
+
+
+class TestLibvirtPlacement(unittest.TestCase):
+
+    def setUp(self):
+        self.cells = libvirt_placement.get_host_cells(
+            ET.fromstring(CAPABILITIES))
+
+    def test_cpuset(self):
+        assert libvirt_placement.parse_cpuset('0-3,^2,6') == {0, 1, 3, 6}
+        assert libvirt_placement.parse_cpuset('') == set()
+        assert libvirt_placement.format_cpuset([7, 0, 1, 2, 5]) == '0-2,5,7'
+
+    def test_host_cells(self):
+        assert self.cells == [
+            dict(id=0, cpus=[0, 1, 2, 3], memory=8388608,
+                 pages={4: 2097152, 2048: 512}),
+            dict(id=1, cpus=[4, 5, 6, 7], memory=8388608,
+                 pages={4: 2097152, 2048: 0}),
+        ]
+
+    def test_pinned_cpus(self):
+        xml = ET.fromstring("""
+            <domain>
+              <cputune>
+                <vcpupin vcpu="0" cpuset="1"/>
+                <vcpupin vcpu="1" cpuset="4-5"/>
+                <emulatorpin cpuset="0-7"/>
+              </cputune>
+            </domain>""")
+        assert libvirt_placement.get_pinned_cpus(xml) == {1, 4, 5}
+
+    def test_reserved_memory(self):
+        xml = ET.fromstring("""
+            <domain>
+              <memory unit="KiB">2097152</memory>
+              <numatune>
+                <memory mode="strict" nodeset="0-1"/>
+              </numatune>
+            </domain>""")
+        assert libvirt_placement.get_reserved_memory(xml) == {0: 1024, 1: 1024}
+
+        xml = ET.fromstring("""
+            <domain>
+              <memory unit="GiB">3</memory>
+              <cpu>
+                <numa>
+                  <cell id="0" cpus="0" memory="1" unit="GiB"/>
+                  <cell id="1" cpus="1" memory="2048" unit="MiB"/>
+                </numa>
+              </cpu>
+              <numatune>
+                <memory mode="strict" nodeset="0-1"/>
+                <memnode cellid="0" mode="strict" nodeset="1"/>
+                <memnode cellid="1" mode="strict" nodeset="1"/>
+              </numatune>
+            </domain>""")
+        assert libvirt_placement.get_reserved_memory(xml) == {1: 3072}
+
+        assert libvirt_placement.get_reserved_memory(
+            ET.fromstring('<domain><memory>1024</memory></domain>')) == {}
+
+    def test_guest_cells(self):
+        assert libvirt_placement.get_guest_cells(2, 1024, []) == [
+            dict(vcpus=[0, 1], memory=1024)]
+        assert libvirt_placement.get_guest_cells(
+            4, 2048, [dict(cpus='0,1', memory=1024),
+                      dict(cpus='2,3', memory=1024)]) == [
+            dict(vcpus=[0, 1], memory=1024),
+            dict(vcpus=[2, 3], memory=1024)]
+
+    def test_plan_spreads_cells(self):
+        guest_cells = libvirt_placement.get_guest_cells(
+            4, 2048, [dict(cpus='0,1', memory=1024),
+                      dict(cpus='2,3', memory=1024)])
+        placement = libvirt_placement.plan_placement(
+            self.cells, guest_cells, pinned={0, 4})
+        assert placement == [
+            dict(cell=0, host_cell=0, vcpus=[0, 1], cpus=[1, 2],
+                 memory=1024),
+            dict(cell=1, host_cell=1, vcpus=[2, 3], cpus=[5, 6],
+                 memory=1024),
+        ]
+
+    def test_plan_prefers_free_cell(self):
+        placement = libvirt_placement.plan_placement(
+            self.cells, [dict(vcpus=[0, 1], memory=1024)],
+            pinned={0, 1, 2})
+        assert placement[0]['host_cell'] == 1
+        assert placement[0]['cpus'] == [4, 5]
+
+    def test_plan_memory(self):
+        placement = libvirt_placement.plan_placement(
+            self.cells, [dict(vcpus=[0], memory=1024)],
+            free_memory={0: 512, 1: 2048})
+        assert placement[0]['host_cell'] == 1
+
+        with pytest.raises(DevopsError):
+            libvirt_placement.plan_placement(
+                self.cells, [dict(vcpus=[0], memory=4096)],
+                free_memory={0: 512, 1: 2048})
+
+    def test_plan_no_free_cpus(self):
+        with pytest.raises(DevopsError):
+            libvirt_placement.plan_placement(
+                self.cells, [dict(vcpus=[0, 1, 2], memory=1024)],
+                pinned={0, 1, 4, 5})
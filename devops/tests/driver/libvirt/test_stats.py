@@ -0,0 +1,88 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from devops.driver.libvirt import libvirt_stats
+from devops.tests.driver.libvirt.base import LibvirtTestCase
+
+
+class TestDomainStatsCollector(LibvirtTestCase):
+
+    def setUp(self):
+        super(TestDomainStatsCollector, self).setUp()
+        self.time_mock = self.patch(
+            'devops.driver.libvirt.libvirt_stats.time.time')
+        self.dom = mock.Mock()
+        self.dom.UUIDString.return_value = 'uuid1'
+        self.conn = mock.Mock()
+        self.collector = libvirt_stats.DomainStatsCollector(
+            self.conn, {'uuid1': {'env': 'env1', 'node': 'admin'}},
+            history=2)
+
+    def stats(self, cpu, rd_bytes, rd_reqs, rd_times, rx_bytes):
+        return {
+            'cpu.time': cpu,
+            'vcpu.current': 1,
+            'vcpu.0.time': cpu,
+            'balloon.current': 1024,
+            'block.count': 1,
+            'block.0.name': 'vda',
+            'block.0.rd.bytes': rd_bytes,
+            'block.0.rd.reqs': rd_reqs,
+            'block.0.rd.times': rd_times,
+            'net.count': 1,
+            'net.0.name': 'vnet0',
+            'net.0.rx.bytes': rx_bytes,
+        }
+
+    def sample(self, now, *args):
+        self.time_mock.return_value = now
+        self.conn.getAllDomainStats.return_value = [
+            (self.dom, self.stats(*args))]
+        self.collector.sample()
+
+    def test_rates(self):
+        self.sample(100, 0, 0, 0, 0, 0)
+        assert self.collector.get_history('uuid1') == []
+
+        self.sample(102, 10 ** 9, 4096, 4, 4 * 10 ** 6, 2048)
+        history = self.collector.get_history('uuid1')
+        assert len(history) == 1
+        assert history[0]['timestamp'] == 102
+        assert history[0]['cpu_usage'] == 0.5
+        assert history[0]['memory_current'] == 1024 ** 2
+        assert history[0]['block']['vda']['rd_bytes_rate'] == 2048
+        assert history[0]['block']['vda']['rd_iops'] == 2
+        assert history[0]['block']['vda']['rd_latency'] == 0.001
+        assert history[0]['net']['vnet0']['rx_bytes_rate'] == 1024
+
+        self.sample(104, 0, 0, 0, 0, 0)
+        self.sample(106, 0, 0, 0, 0, 0)
+        history = self.collector.get_history('uuid1')
+        assert len(history) == 2
+        assert history[0]['cpu_usage'] is None
+        assert history[1]['cpu_usage'] == 0
+
+    def test_metrics(self):
+        self.sample(100, 0, 0, 0, 0, 0)
+        self.sample(101, 10 ** 9, 0, 0, 0, 0)
+
+        metrics = self.collector.metrics()
+        assert ('devops_domain_cpu_usage_ratio', mock.ANY,
+                {'env': 'env1', 'node': 'admin', 'uuid': 'uuid1'},
+                1.0) in metrics
+        assert ('devops_domain_block_read_bytes_rate', mock.ANY,
+                {'env': 'env1', 'node': 'admin', 'uuid': 'uuid1',
+                 'device': 'vda'}, 0.0) in metrics
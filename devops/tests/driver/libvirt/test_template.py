@@ -14,12 +14,15 @@
 
 import collections
 import os
+import tempfile
 
 import mock
 from netaddr import IPAddress
 import yaml
 
+from devops.driver.libvirt.libvirt_driver import LibvirtManager
 from devops.error import DevopsObjNotFound
+from devops.helpers import scheduler
 from devops.models import AddressPool
 from devops.models import Environment
 from devops.models import Group
@@ -552,3 +555,149 @@ class TestLibvirtTemplate(LibvirtTestCase):
 
         with self.assertRaises(DevopsObjNotFound):
             node.get_volume(name='other-volume')
+
+
+HOST_XML = """<?xml version="1.0"?>
+<node>
+  <cpu>
+    <mhz>2000</mhz>
+    <model>i686</model>
+    <nodes>1</nodes>
+    <sockets>1</sockets>
+    <cores>4</cores>
+    <threads>1</threads>
+  </cpu>
+  <memory>8388608</memory>
+  <pool type="dir">
+    <name>default-pool</name>
+    <target>
+      <path>/default-pool</path>
+    </target>
+  </pool>
+</node>
+"""
+
+
+class TestLibvirtDistributedTemplate(LibvirtTestCase):
+
+    def setUp(self):
+        super(TestLibvirtDistributedTemplate, self).setUp()
+
+        # speed up retry
+        self.sleep_mock = self.patch('devops.helpers.retry.sleep')
+
+        # mock open
+        self.open_mock = mock.mock_open(read_data='image_data')
+        self.patch('devops.driver.libvirt.libvirt_driver.open',
+                   self.open_mock, create=True)
+
+        self.os_mock = self.patch('devops.helpers.helpers.os')
+        self.os_mock.urandom = os.urandom
+        Size = collections.namedtuple('Size', ['st_size'])
+        self.os_mock.stat.side_effect = {
+            '/tmp/admin.iso': Size(st_size=500),
+        }.get
+
+        # the test driver has no host interfaces
+        self.patch('libvirt.virConnect.interfaceDefineXML')
+        self.iface_lookup_mock = self.patch(
+            'libvirt.virConnect.interfaceLookupByName')
+        self.iface_lookup_mock.return_value.isActive.return_value = False
+        self.host_call_mock = self.patch(
+            'devops.driver.libvirt.libvirt_driver.LibvirtDriver.host_call',
+            autospec=True)
+
+        # the second host is a test driver started from its own file
+        fd, path = tempfile.mkstemp(suffix='.xml')
+        os.write(fd, HOST_XML.encode('utf-8'))
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        self.host2 = 'test://{0}'.format(path)
+        conn = LibvirtManager.get_connection(self.host2)
+        self.addCleanup(LibvirtManager.connections.pop, self.host2)
+        self.addCleanup(LibvirtManager.event_watchers.pop, self.host2, None)
+        caps_patcher = mock.patch.object(conn, 'getCapabilities')
+        caps_patcher.start().return_value = self.caps_mock.return_value
+        self.addCleanup(caps_patcher.stop)
+
+        hosts = [
+            {'connection_string': 'test:///default', 'uplink': 'eth1',
+             'memory': 4096, 'vcpu': 4, 'disk': 10},
+            {'name': 'second', 'connection_string': self.host2,
+             'uplink': 'eth2', 'memory': 8192, 'vcpu': 4, 'disk': 100},
+        ]
+        self.full_conf = scheduler.distribute_config(
+            yaml.load(ENV_TMPLT), hosts)
+        self.env = Environment.create_environment(self.full_conf)
+
+    def get_bridge(self, name):
+        return self.env.get_env_l2_network_device(name=name).bridge_name()
+
+    def test_life_cycle(self):
+        self.env.define()
+        self.env.start()
+
+        conn1 = LibvirtManager.get_connection('test:///default')
+        conn2 = LibvirtManager.get_connection(self.host2)
+        for conn, networks, domains in (
+                (conn1,
+                 ['admin', 'management', 'private', 'public', 'storage',
+                  'uplink_host1'],
+                 ['admin']),
+                (conn2,
+                 ['admin_second', 'management_second', 'private_second',
+                  'public_second', 'storage_second', 'uplink_second'],
+                 ['slave-01', 'slave-02'])):
+            assert sorted(net.name() for net in conn.listAllNetworks()) == [
+                'test_env_{0}'.format(name) for name in networks]
+            for net in conn.listAllNetworks():
+                assert net.isActive()
+            assert sorted(dom.name() for dom in conn.listAllDomains()) == [
+                'test_env_{0}'.format(name) for name in domains]
+            for dom in conn.listAllDomains():
+                assert dom.isActive()
+
+        # every bridge is wired on the host of its network
+        calls = set((driver.connection_string, tuple(cmd))
+                    for (driver, cmd), _ in self.host_call_mock.call_args_list)
+        uplink1 = self.get_bridge('uplink_host1')
+        uplink2 = self.get_bridge('uplink_second')
+        assert calls == set([
+            ('test:///default',
+             ('sudo', 'ip', 'link', 'set', 'dev', 'eth1', 'up', 'master',
+              uplink1)),
+            (self.host2,
+             ('sudo', 'ip', 'link', 'set', 'dev', 'eth2', 'up', 'master',
+              uplink2)),
+        ] + [
+            ('test:///default',
+             ('sudo', 'ip', 'link', 'set', 'dev',
+              '{0}.{1}'.format(uplink1, vlan), 'up', 'master',
+              self.get_bridge(name)))
+            for vlan, name in enumerate(
+                ['admin', 'management', 'private', 'public', 'storage'],
+                start=1000)
+        ] + [
+            (self.host2,
+             ('sudo', 'ip', 'link', 'set', 'dev',
+              '{0}.{1}'.format(uplink2, vlan), 'up', 'master',
+              self.get_bridge('{0}_second'.format(name))))
+            for vlan, name in enumerate(
+                ['admin', 'management', 'private', 'public', 'storage'],
+                start=1000)
+        ])
+
+        # tagged interfaces of both uplinks are started
+        ifaces = set(call[0][1] for call in
+                     self.iface_lookup_mock.call_args_list)
+        assert ifaces == set(
+            '{0}.{1}'.format(uplink, vlan)
+            for uplink in (uplink1, uplink2)
+            for vlan in range(1000, 1005))
+
+        self.env.erase()
+
+        assert len(conn1.listAllNetworks()) == 0
+        assert len(conn1.listAllDomains()) == 0
+        assert len(conn2.listAllNetworks()) == 0
+        assert len(conn2.listAllDomains()) == 0
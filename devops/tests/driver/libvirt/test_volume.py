@@ -14,6 +14,7 @@
 
 import collections
 
+import libvirt
 import mock
 import pytest
 
@@ -140,6 +141,34 @@ class TestLibvirtVolume(LibvirtTestCase):
 </volume>
 """
 
+    def test_tuning(self):
+        volume = self.node.add_volume(
+            name='test_volume',
+            capacity=512,
+            cache='none',
+            io='native',
+            discard='unmap',
+            preallocation='metadata',
+        )
+
+        create_xml = libvirt.virStoragePool.createXML
+        with mock.patch.object(
+                libvirt.virStoragePool, 'createXML', autospec=True,
+                side_effect=lambda pool, xml, flags: create_xml(pool, xml, 0)
+        ) as create_mock:
+            volume.define()
+            child = volume.create_child('test_child')
+            child.define()
+
+        assert create_mock.call_args_list[0][0][2] == (
+            libvirt.VIR_STORAGE_VOL_CREATE_PREALLOC_METADATA)
+        # Overlay is created without preallocation
+        assert create_mock.call_args_list[1][0][2] == 0
+        assert child.cache == 'none'
+        assert child.io == 'native'
+        assert child.discard == 'unmap'
+        assert child.preallocation == 'metadata'
+
     def test_source_image(self):
         volume = self.node.add_volume(
             name='test_volume',
@@ -158,3 +187,199 @@ class TestLibvirtVolume(LibvirtTestCase):
         volume.fill_from_exist()
         assert volume.get_capacity() == 500
         assert volume.get_format() == 'qcow2'
+
+    def _enable_base_image_cache(self):
+        self.patch('devops.driver.libvirt.libvirt_driver.file_lock')
+        self.patch('devops.driver.libvirt.libvirt_driver.get_file_checksum',
+                   return_value='0a1b2c')
+        self.d.base_image_cache = True
+        self.d.save()
+
+    def test_base_image_cache(self):
+        self._enable_base_image_cache()
+
+        volume1 = self.node.add_volume(
+            name='test_volume1',
+            source_image='/tmp/admin.iso',
+            format='raw',
+        )
+        volume2 = self.node.add_volume(
+            name='test_volume2',
+            source_image='/tmp/admin.iso',
+            format='raw',
+        )
+
+        volume1.define()
+        volume2.define()
+
+        assert self.libvirt_vol_up_mock.call_count == 1
+        for volume in (volume1, volume2):
+            assert volume.exists()
+            assert volume.format == 'qcow2'
+            assert volume.base_image == (
+                '/default-pool/devops_base_raw_0a1b2c')
+        assert volume2.get_path() == (
+            '/default-pool/test_env_test_node_test_volume2')
+
+    @pytest.mark.xfail(reason="need libvirtd >= 1.2.12")
+    def test_base_image_cleanup(self):
+        self._enable_base_image_cache()
+
+        volume = self.node.add_volume(
+            name='test_volume',
+            source_image='/tmp/admin.iso',
+        )
+        volume.define()
+
+        base_path = '/default-pool/devops_base_qcow2_0a1b2c'
+        assert self.d.get_base_images() == {base_path: 1}
+        assert self.d.cleanup_base_images() == []
+
+        volume.erase()
+
+        assert self.d.get_base_images() == {base_path: 0}
+        assert self.d.cleanup_base_images() == [base_path]
+        assert self.d.get_base_images() == {}
+
+    def test_base_image_cleanup_locked(self):
+        lock_mock = self.patch(
+            'devops.driver.libvirt.libvirt_driver.file_lock')
+        base_path = '/default-pool/devops_base_qcow2_0a1b2c'
+        volumes = {base_path: (base_path, 'devops_base_qcow2_0a1b2c', None)}
+        # An overlay is created by another process before the lock
+        overlay_path = '/default-pool/test_env_test_node_test_volume'
+        get_backings_mock = self.patch(
+            'devops.driver.libvirt.libvirt_driver.LibvirtDriver.'
+            '_get_volume_backings',
+            side_effect=[volumes, dict(volumes, **{overlay_path: (
+                overlay_path, 'test_env_test_node_test_volume',
+                base_path)})])
+        lookup_mock = self.patch('libvirt.virConnect.storageVolLookupByKey')
+        lookup_mock.return_value.name.return_value = (
+            'devops_base_qcow2_0a1b2c')
+
+        assert self.d.cleanup_base_images() == []
+
+        # Only volumes created since the listing are queried again
+        get_backings_mock.assert_called_with(known=volumes)
+        assert get_backings_mock.call_count == 2
+        lock_mock.assert_called_once_with(mock.ANY)
+        assert lock_mock.call_args[0][0].endswith(
+            'devops_base_qcow2_0a1b2c.lock')
+        assert not lookup_mock.return_value.delete.called
+
+    def _add_storage_pool(self, name):
+        conn = self.d.conn
+        pool = conn.storagePoolCreateXML(
+            "<pool type='dir'><name>{0}</name>"
+            "<target><path>/{0}</path></target></pool>".format(name), 0)
+
+        def cleanup():
+            for vol in pool.listAllVolumes():
+                vol.delete()
+            pool.destroy()
+
+        self.addCleanup(cleanup)
+
+    def _setup_storage_pools(self, policy):
+        self._add_storage_pool('pool1')
+        self._add_storage_pool('pool2')
+        patcher = mock.patch.dict(self.d._storage_pool_weights, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.d.storage_pools = [{'name': 'pool1', 'weight': 2}, 'pool2']
+        self.d.storage_pool_policy = policy
+        self.d.save()
+
+    def test_storage_pools_round_robin(self):
+        self._setup_storage_pools('round-robin')
+
+        pools = []
+        for idx in range(6):
+            volume = self.node.add_volume(
+                name='test_volume{0}'.format(idx), capacity=512)
+            volume.define()
+            assert volume.get_path() == '/{0}/{1}'.format(
+                volume.storage_pool, volume.get_name())
+            pools.append(volume.storage_pool)
+
+        assert pools == ['pool1', 'pool2', 'pool1'] * 2
+
+        child = volume.create_child('test_child')
+        child.define()
+        assert child.storage_pool == volume.storage_pool
+        assert child.get_path() == '/pool1/test_env_test_node_test_child'
+
+    def test_storage_pools_node(self):
+        self._setup_storage_pools('node')
+        node2 = self.group.add_node(
+            name='test_node2',
+            role='default',
+            architecture='i686',
+            hypervisor='test',
+        )
+
+        for node in (self.node, node2):
+            for idx in range(2):
+                node.add_volume(
+                    name='test_volume{0}'.format(idx), capacity=512).define()
+
+        assert [v.storage_pool for v in self.node.get_volumes()] == [
+            'pool1', 'pool1']
+        assert [v.storage_pool for v in node2.get_volumes()] == [
+            'pool2', 'pool2']
+
+    def test_storage_pools_least_used(self):
+        self._setup_storage_pools('least-used')
+
+        pools = []
+        for idx in range(3):
+            volume = self.node.add_volume(
+                name='test_volume{0}'.format(idx), capacity=512)
+            volume.define()
+            pools.append(volume.storage_pool)
+
+        assert sorted(pools) == ['pool1', 'pool1', 'pool2']
+
+    def test_ephemeral(self):
+        self.patch('devops.driver.libvirt.libvirt_driver.file_lock')
+        free_memory_patcher = mock.patch.object(
+            self.d.conn, 'getFreeMemory', return_value=8 * 1024 ** 3)
+        free_memory_patcher.start()
+        self.addCleanup(free_memory_patcher.stop)
+
+        volume = self.node.add_volume(
+            name='test_volume',
+            capacity=1,
+            cache='none',
+            io='native',
+            ephemeral=True,
+        )
+        volume.define()
+
+        pool = self.d.conn.storagePoolLookupByName('devops_ephemeral')
+        assert volume.storage_pool == 'devops_ephemeral'
+        assert volume.get_path() == (
+            '/dev/shm/fuel-devops/test_env_test_node_test_volume')
+        assert volume.cache == 'writeback'
+        assert volume.io is None
+
+        child = volume.create_child('test_child')
+        child.define()
+        assert child.storage_pool == 'devops_ephemeral'
+        assert pool.numOfVolumes() == 2
+
+        # 8 GiB free - 4 GiB reserve is not enough
+        big_volume = self.node.add_volume(
+            name='test_big_volume',
+            capacity=5,
+            ephemeral=True,
+        )
+        big_volume.define()
+        assert big_volume.storage_pool == 'default-pool'
+
+        child.erase()
+        assert self.d.conn.storagePoolLookupByName('devops_ephemeral')
+        volume.erase()
+        with pytest.raises(libvirt.libvirtError):
+            self.d.conn.storagePoolLookupByName('devops_ephemeral')
@@ -13,6 +13,7 @@
 #    under the License.
 
 from unittest import TestCase
+import xml.etree.ElementTree as ET
 
 from netaddr import IPNetwork
 
@@ -277,6 +278,42 @@ class TestVolumeXml(BaseTestXMLBuilder):
                        '    </backingStore>\n'
                        '</volume>\n')
 
+    def test_storage_pool(self):
+        xml = self.xml_builder.build_storage_pool_xml(
+            'test_pool', '/dev/shm/test')
+        assert xml == ('<?xml version="1.0" encoding="utf-8"?>\n'
+                       '<pool type="dir">\n'
+                       '    <name>test_pool</name>\n'
+                       '    <target>\n'
+                       '        <path>/dev/shm/test</path>\n'
+                       '        <permissions>\n'
+                       '            <mode>0755</mode>\n'
+                       '        </permissions>\n'
+                       '    </target>\n'
+                       '</pool>\n')
+
+    def test_cluster_size(self):
+        xml = self.xml_builder.build_volume_xml(
+            name='test_name',
+            capacity=1048576,
+            vol_format='qcow2',
+            backing_store_path=None,
+            backing_store_format=None,
+            cluster_size=1024,
+        )
+        assert xml == ('<?xml version="1.0" encoding="utf-8"?>\n'
+                       '<volume>\n'
+                       '    <name>test_name</name>\n'
+                       '    <capacity>1048576</capacity>\n'
+                       '    <target>\n'
+                       '        <format type="qcow2"/>\n'
+                       '        <permissions>\n'
+                       '            <mode>0644</mode>\n'
+                       '        </permissions>\n'
+                       '        <clusterSize unit="KiB">1024</clusterSize>\n'
+                       '    </target>\n'
+                       '</volume>\n')
+
 
 class TestSnapshotXml(BaseTestXMLBuilder):
 
@@ -623,6 +660,134 @@ class TestNodeXml(BaseTestXMLBuilder):
 </domain>
 """
 
+    def test_disk_tuning(self):
+        disk_devices = [
+            dict(
+                disk_type='file',
+                disk_device='disk',
+                disk_volume_format='qcow2',
+                disk_volume_path='/tmp/volume.img',
+                disk_bus='virtio',
+                disk_target_dev='vda',
+                disk_serial='ca9dcfe5a48540f39537eb3cbd96f370',
+                disk_cache='none',
+                disk_io='native',
+                disk_discard='unmap',
+                disk_iothread=1,
+            ),
+        ]
+        xml = self.xml_builder.build_node_xml(
+            name='test_name',
+            hypervisor='test_description',
+            use_host_cpu=False,
+            vcpu=2,
+            memory=1024,
+            use_hugepages=False,
+            hpet=True,
+            os_type='hvm',
+            architecture='x86_64',
+            boot=['hd'],
+            reboot_timeout=None,
+            bootmenu_timeout=0,
+            emulator='/usr/bin/qemu-kvm',
+            has_vnc=False,
+            vnc_password=None,
+            local_disk_devices=disk_devices,
+            interfaces=[],
+            acpi=False,
+            numa=[],
+            iothreads=2,
+        )
+
+        assert '    <vcpu>2</vcpu>\n    <iothreads>2</iothreads>\n' in xml
+        assert ('<driver cache="none" discard="unmap" io="native" '
+                'iothread="1" type="qcow2"/>') in xml
+
+    def test_interface_driver(self):
+        interfaces = [
+            dict(
+                interface_type='network',
+                interface_mac_address='64:70:74:90:bc:84',
+                interface_network_name='test_admin',
+                interface_target_dev='virnet132',
+                interface_model='virtio',
+                interface_filter='test_filter1',
+                interface_driver=dict(name='vhost', queues=4,
+                                      rx_queue_size=1024),
+            ),
+        ]
+        xml = self.xml_builder.build_node_xml(
+            name='test_name',
+            hypervisor='test_description',
+            use_host_cpu=False,
+            vcpu=4,
+            memory=1024,
+            use_hugepages=False,
+            hpet=True,
+            os_type='hvm',
+            architecture='x86_64',
+            boot=['hd'],
+            reboot_timeout=None,
+            bootmenu_timeout=0,
+            emulator='/usr/bin/qemu-kvm',
+            has_vnc=False,
+            vnc_password=None,
+            local_disk_devices=[],
+            interfaces=interfaces,
+            acpi=False,
+            numa=[],
+        )
+
+        assert """
+            <model type="virtio"/>
+            <driver name="vhost" queues="4" rx_queue_size="1024"/>
+            <filterref filter="test_filter1"/>
+""" in xml
+
+    def test_placement(self):
+        xml = self.xml_builder.build_node_xml(
+            name='test_name',
+            hypervisor='test_description',
+            use_host_cpu=False,
+            vcpu=4,
+            memory=2048,
+            use_hugepages=True,
+            hpet=True,
+            os_type='hvm',
+            architecture='x86_64',
+            boot=['hd'],
+            reboot_timeout=None,
+            bootmenu_timeout=0,
+            emulator='/usr/bin/qemu-kvm',
+            has_vnc=False,
+            vnc_password=None,
+            local_disk_devices=[],
+            interfaces=[],
+            acpi=False,
+            numa=[dict(cpus='0,1', memory=1024),
+                  dict(cpus='2,3', memory=1024)],
+            placement=[
+                dict(cell=0, host_cell=0, vcpus=[0, 1], cpus=[1, 2],
+                     memory=1024),
+                dict(cell=1, host_cell=1, vcpus=[2, 3], cpus=[5, 6],
+                     memory=1024),
+            ],
+            hugepage_size=2048,
+        )
+
+        domain = ET.fromstring(xml.encode('utf-8'))
+        assert [(pin.get('vcpu'), pin.get('cpuset'))
+                for pin in domain.findall('cputune/vcpupin')] == [
+            ('0', '1'), ('1', '2'), ('2', '5'), ('3', '6')]
+        assert domain.find('cputune/emulatorpin').get('cpuset') == '1-2,5-6'
+        assert domain.find('numatune/memory').attrib == dict(
+            mode='strict', nodeset='0-1')
+        assert [(memnode.get('cellid'), memnode.get('nodeset'))
+                for memnode in domain.findall('numatune/memnode')] == [
+            ('0', '0'), ('1', '1')]
+        assert domain.find('memoryBacking/hugepages/page').attrib == dict(
+            size='2048', unit='KiB', nodeset='0-1')
+
 
 class TestNWfilterXml(BaseTestXMLBuilder):
 
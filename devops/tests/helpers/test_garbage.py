@@ -0,0 +1,77 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from devops.helpers import garbage
+
+
+class TestGarbage(unittest.TestCase):
+
+    def setUp(self):
+        self.memory_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.memory_dir)
+
+        self.driver = mock.Mock()
+        self.driver.get_garbage.side_effect = lambda known, nodes, min_age: [
+            {'type': 'volume', 'path': '/pool/env_node_vol.snap', 'size': 10}]
+        self.driver.get_snapshot_memory_files.return_value = {
+            self.path('snapshot-memory-env_node.used')}
+
+    def path(self, name):
+        return os.path.join(self.memory_dir, name)
+
+    def add_file(self, name, age=7200):
+        with open(self.path(name), 'w') as f:
+            f.write('memory')
+        mtime = time.time() - age
+        os.utime(self.path(name), (mtime, mtime))
+
+    def test_find_garbage(self):
+        self.add_file('snapshot-memory-env_node.used')
+        self.add_file('snapshot-memory-env_node.orphan')
+        self.add_file('snapshot-memory-env_node.new', age=0)
+        self.add_file('other_file')
+
+        items = garbage.find_garbage([self.driver, self.driver],
+                                     {'/pool/env_node_vol'}, {'env': ['node']},
+                                     memory_dir=self.memory_dir)
+
+        assert items == [
+            {'type': 'volume', 'path': '/pool/env_node_vol.snap', 'size': 10,
+             'driver': self.driver},
+            {'type': 'memory',
+             'path': self.path('snapshot-memory-env_node.orphan'),
+             'size': 6, 'driver': None},
+        ]
+        self.driver.get_garbage.assert_called_with(
+            {'/pool/env_node_vol'}, {'env': ['node']}, min_age=3600)
+
+    def test_remove_garbage(self):
+        self.add_file('snapshot-memory-env_node.orphan')
+        self.driver.remove_garbage.side_effect = Exception('busy')
+        items = garbage.find_garbage([self.driver], set(), {},
+                                     memory_dir=self.memory_dir)
+
+        removed = garbage.remove_garbage(items, threads=2)
+
+        assert removed == [items[1]]
+        assert not os.path.exists(self.path('snapshot-memory-env_node.orphan'))
+        self.driver.remove_garbage.assert_called_once_with(items[0])
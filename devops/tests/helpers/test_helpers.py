@@ -349,3 +349,33 @@ class TestHelpersHelpers(unittest.TestCase):
         self.assertEqual(result, 'single')
         result = helpers.underscored('m', 'u', 'l', 't', 'i', 'p', 'l', 'e')
         self.assertEqual(result, 'm_u_l_t_i_p_l_e')
+
+    def test_run_parallel(self):
+        result = helpers.run_parallel(lambda x: x * 2, xrange(5))
+        self.assertEqual(result, [0, 2, 4, 6, 8])
+
+        calls = []
+
+        def func(x):
+            calls.append(x)
+            if x == 1:
+                raise error.DevopsError('failed')
+
+        with self.assertRaises(error.DevopsError):
+            helpers.run_parallel(func, [0, 1, 2], threads=2)
+        self.assertEqual(sorted(calls), [0, 1, 2])
+
+    def test_format_prometheus(self):
+        result = helpers.format_prometheus([
+            ('b_metric', 'Second', {'node': 'admin', 'env': 'e"1'}, 2),
+            ('a_metric', 'First', {'node': 'admin'}, 0.5),
+            ('a_metric', 'First', {'node': 'slave'}, None),
+        ])
+        self.assertEqual(
+            result,
+            '# HELP a_metric First\n'
+            '# TYPE a_metric gauge\n'
+            'a_metric{node="admin"} 0.5\n'
+            '# HELP b_metric Second\n'
+            '# TYPE b_metric gauge\n'
+            'b_metric{env="e\\"1",node="admin"} 2\n')
@@ -0,0 +1,77 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+
+import mock
+
+from devops.helpers import reconcile
+
+
+class TestReconcile(unittest.TestCase):
+
+    def setUp(self):
+        self.driver = mock.Mock(params={'connection_string': 'qemu:///'})
+        self.driver.name = 'devops.driver.libvirt'
+        self.driver.get_drift.side_effect = lambda groups: [
+            dict(kind='orphan', object='nwfilter', host='qemu:///',
+                 env='env', name='env_net', detail='', repair='remove',
+                 stage=3),
+            dict(kind='orphan', object='domain', host='qemu:///',
+                 env='env', name='env_node', detail='', repair='remove',
+                 stage=0),
+            dict(kind='mismatch', object='network', host='qemu:///',
+                 env='env', name='env_admin', detail='', repair='update-uuid',
+                 record=self.record, uuid='new-uuid'),
+            dict(kind='missing', object='volume', host='qemu:///',
+                 env='env', name='/pool/env_node_vol', detail='',
+                 repair=None),
+        ]
+        self.record = mock.Mock(uuid='old-uuid')
+        self.groups = [mock.Mock(driver=self.driver),
+                       mock.Mock(driver=self.driver)]
+
+    def test_find_drift(self):
+        drift = reconcile.find_drift(iter(self.groups))
+
+        assert [(item['object'], item['name']) for item in drift] == [
+            ('domain', 'env_node'),
+            ('network', 'env_admin'),
+            ('nwfilter', 'env_net'),
+            ('volume', '/pool/env_node_vol'),
+        ]
+        assert all(item['driver'] is self.driver for item in drift)
+        self.driver.get_drift.assert_called_once_with(self.groups)
+
+    def test_repair_drift(self):
+        calls = []
+        self.driver.repair_drift.side_effect = lambda item: calls.append(
+            item['name'])
+        drift = reconcile.find_drift(self.groups)
+
+        repaired = reconcile.repair_drift(drift, threads=2)
+
+        assert [item['name'] for item in repaired] == [
+            'env_admin', 'env_node', 'env_net']
+        assert calls == ['env_node', 'env_net']
+        assert self.record.uuid == 'new-uuid'
+        self.record.save.assert_called_once_with()
+
+    def test_repair_drift_failed(self):
+        self.driver.repair_drift.side_effect = Exception('busy')
+        self.record.save.side_effect = Exception('locked')
+        drift = reconcile.find_drift(self.groups)
+
+        assert reconcile.repair_drift(drift) == []
+        assert self.driver.repair_drift.call_count == 2
@@ -0,0 +1,167 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+
+from devops.error import DevopsError
+from devops.helpers import scheduler
+
+
+def make_node(name, memory, vcpu=1, disk=10, networks=('admin',)):
+    return {
+        'name': name,
+        'role': 'fuel_slave',
+        'params': {
+            'memory': memory,
+            'vcpu': vcpu,
+            'volumes': [{'name': 'system', 'capacity': disk}],
+            'interfaces': [{'label': 'eth{0}'.format(idx),
+                            'l2_network_device': network}
+                           for idx, network in enumerate(networks)],
+        },
+    }
+
+
+def make_config(nodes):
+    return {'template': {'devops_settings': {
+        'env_name': 'test_env',
+        'address_pools': {},
+        'groups': [{
+            'name': 'default',
+            'driver': {
+                'name': 'devops.driver.libvirt',
+                'params': {'connection_string': 'qemu:///system',
+                           'storage_pool_name': 'default'},
+            },
+            'network_pools': {'fuelweb_admin': 'fuelweb_admin-pool01'},
+            'l2_network_devices': {
+                'admin': {'address_pool': 'fuelweb_admin-pool01',
+                          'dhcp': False,
+                          'forward': {'mode': 'nat'}},
+                'public': {'address_pool': 'public-pool01',
+                           'dhcp': False,
+                           'forward': {'mode': 'nat'}},
+            },
+            'nodes': nodes,
+        }],
+    }}}
+
+
+HOSTS = [
+    {'connection_string': 'test:///host1', 'uplink': 'eth1',
+     'memory': 4096, 'vcpu': 4, 'disk': 100},
+    {'name': 'second', 'connection_string': 'test:///host2',
+     'uplink': 'eth2', 'memory': 4096, 'vcpu': 4, 'disk': 100},
+]
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_node_requirements(self):
+        assert scheduler.get_node_requirements({'name': 'n'}) == dict(
+            memory=1024, vcpu=1, disk=0)
+        assert scheduler.get_node_requirements(
+            make_node('n', 2048, vcpu=2, disk=50)) == dict(
+            memory=2048, vcpu=2, disk=50)
+
+    def test_first_fit_decreasing(self):
+        nodes = [make_node('slave-01', 1024),
+                 make_node('slave-02', 3072),
+                 make_node('slave-03', 2048),
+                 make_node('slave-04', 1024)]
+        placement = scheduler.schedule_nodes(nodes, HOSTS)
+        assert [[node['name'] for node in host_nodes]
+                for host_nodes in placement] == [
+            ['slave-01', 'slave-02'], ['slave-03', 'slave-04']]
+
+    def test_unlimited_resources(self):
+        hosts = [{'connection_string': 'test:///host1', 'memory': None,
+                  'vcpu': None, 'disk': None}]
+        nodes = [make_node('slave-{0:02d}'.format(idx), 8192)
+                 for idx in range(3)]
+        assert scheduler.schedule_nodes(nodes, hosts) == [nodes]
+
+    def test_no_resources(self):
+        with self.assertRaises(DevopsError):
+            scheduler.schedule_nodes([make_node('slave-01', 1024, vcpu=8)],
+                                     HOSTS)
+
+    def test_distribute_single_host(self):
+        config = make_config([make_node('admin', 2048),
+                              make_node('slave-01', 1024)])
+        result = scheduler.distribute_config(config, HOSTS)
+
+        groups = result['template']['devops_settings']['groups']
+        assert len(groups) == 1
+        assert groups[0]['driver']['params'] == {
+            'connection_string': 'test:///host1',
+            'storage_pool_name': 'default'}
+        assert groups[0]['l2_network_devices'] == config['template'][
+            'devops_settings']['groups'][0]['l2_network_devices']
+
+    def test_distribute(self):
+        config = make_config([make_node('admin', 3072),
+                              make_node('slave-01', 2048),
+                              make_node('slave-02', 1024,
+                                        networks=('admin', 'public'))])
+        result = scheduler.distribute_config(config, HOSTS, vlan_start=200)
+
+        primary, second = result['template']['devops_settings']['groups']
+        assert [node['name'] for node in primary['nodes']] == [
+            'admin', 'slave-02']
+        assert [node['name'] for node in second['nodes']] == ['slave-01']
+        assert second['name'] == 'default_second'
+        assert second['driver']['params']['connection_string'] == (
+            'test:///host2')
+        assert second['network_pools'] == primary['network_pools']
+
+        # only 'admin' is used by nodes on both hosts
+        assert primary['l2_network_devices']['uplink_host1'] == {
+            'vlan_ifaces': [200],
+            'parent_iface': {'phys_dev': 'eth1'}}
+        assert primary['l2_network_devices']['admin']['parent_iface'] == {
+            'l2_net_dev': 'uplink_host1', 'tag': 200}
+        assert 'parent_iface' not in primary['l2_network_devices']['public']
+        assert second['l2_network_devices'] == {
+            'uplink_second': {
+                'vlan_ifaces': [200],
+                'parent_iface': {'phys_dev': 'eth2'}},
+            'admin_second': {
+                'replica_of': 'admin',
+                'address_pool': 'fuelweb_admin-pool01',
+                'parent_iface': {'l2_net_dev': 'uplink_second',
+                                 'tag': 200}},
+        }
+        assert second['nodes'][0]['params']['interfaces'][0][
+            'l2_network_device'] == 'admin_second'
+
+        # source template is not changed
+        assert 'uplink_host1' not in config['template']['devops_settings'][
+            'groups'][0]['l2_network_devices']
+
+    def test_distribute_no_uplink(self):
+        hosts = [dict(host, uplink=None) for host in HOSTS]
+        config = make_config([make_node('admin', 3072),
+                              make_node('slave-01', 2048)])
+        with self.assertRaises(DevopsError):
+            scheduler.distribute_config(config, hosts)
+
+    def test_distribute_connected_device(self):
+        config = make_config([make_node('admin', 3072),
+                              make_node('slave-01', 2048)])
+        config['template']['devops_settings']['groups'][0][
+            'l2_network_devices']['admin']['parent_iface'] = {
+            'phys_dev': 'eth3'}
+        with self.assertRaises(DevopsError):
+            scheduler.distribute_config(config, HOSTS)
@@ -0,0 +1,138 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from devops.error import DevopsError
+from devops.error import DevopsObjNotFound
+from devops.helpers import warm_pool
+
+
+class TestWarmPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pools_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.pools_dir)
+
+        self.envs = {'myenv': mock.Mock()}
+        self.envs['myenv'].clone.side_effect = self.clone
+
+        def get(name):
+            if name not in self.envs:
+                raise DevopsObjNotFound(mock.Mock, name=name)
+            return self.envs[name]
+
+        patcher = mock.patch.object(warm_pool, 'Environment')
+        self.environment_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.environment_mock.get.side_effect = get
+        patcher = mock.patch.object(warm_pool, 'sync_time')
+        self.sync_time_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(warm_pool, 'connection')
+        self.connection_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.pool = warm_pool.WarmPool('ci', pools_dir=self.pools_dir)
+
+    def clone(self, name, snapshot, start):
+        env = mock.Mock()
+        env.get_nodes.return_value = []
+        self.envs[name] = env
+        return env
+
+    def states(self):
+        return {name: member['state']
+                for name, member in self.pool.get_members().items()}
+
+    def test_fill_lease_release(self):
+        self.pool.configure(source='myenv', snapshot='deployed', size=2)
+        assert self.pool.maintain() == [('ci-1', 'create'),
+                                        ('ci-2', 'create')]
+        self.envs['myenv'].clone.assert_called_with(
+            'ci-2', snapshot='deployed', start=True)
+        self.envs['ci-1'].snapshot.assert_called_once_with('deployed')
+        self.envs['ci-1'].revert.assert_called_once_with(
+            'deployed', flag=False, resume=True)
+        assert self.connection_mock.close.call_count == 2
+        assert self.states() == {'ci-1': 'ready', 'ci-2': 'ready'}
+
+        first = self.pool.lease(owner='job1')
+        second = self.pool.lease(owner='job2')
+        assert {first, second} == {'ci-1', 'ci-2'}
+        with self.assertRaises(DevopsError):
+            self.pool.lease()
+
+        self.pool.release(first)
+        with self.assertRaises(DevopsError):
+            self.pool.release(first)
+        self.envs[first].revert.reset_mock()
+        assert self.pool.maintain() == [(first, 'recycle')]
+        self.envs[first].revert.assert_called_once_with(
+            'deployed', flag=False, resume=True)
+        assert self.states() == {first: 'ready', second: 'leased'}
+
+    def test_broken_and_resize(self):
+        self.pool.configure(source='myenv', snapshot='deployed', size=1,
+                            timesync=False)
+        self.pool.maintain()
+        self.envs['ci-1'].revert.side_effect = Exception('revert failed')
+        self.pool.release(self.pool.lease())
+
+        self.pool.maintain()
+        assert self.states() == {'ci-1': 'broken'}
+        assert not self.sync_time_mock.called
+
+        self.pool.configure(size=2)
+        self.pool.maintain()
+        self.envs['ci-1'].erase.assert_called_once_with()
+        assert self.states() == {'ci-2': 'ready', 'ci-3': 'ready'}
+
+        self.pool.configure(size=1)
+        self.pool.maintain()
+        assert self.states() == {'ci-3': 'ready'}
+
+    def test_new_snapshot(self):
+        self.pool.configure(source='myenv', snapshot='deployed', size=1)
+        self.pool.maintain()
+        self.pool.lease()
+
+        self.pool.configure(snapshot='updated')
+        self.pool.maintain()
+        assert self.states() == {'ci-1': 'leased', 'ci-2': 'ready'}
+
+        self.pool.release('ci-1')
+        self.pool.maintain()
+        self.envs['ci-1'].erase.assert_called_once_with()
+        assert self.states() == {'ci-2': 'ready'}
+
+    def test_interrupted(self):
+        self.pool.configure(source='myenv', snapshot='deployed', size=1)
+        with self.pool._state() as state:
+            state['members']['ci-1'] = dict(
+                state='preparing', pid=2 ** 22 + 1, since=0, owner=None,
+                generation=state['generation'])
+
+        self.pool.maintain()
+        assert self.states() == {'ci-2': 'ready'}
+
+    def test_not_configured(self):
+        with self.assertRaises(DevopsError):
+            self.pool.lease()
+        with self.assertRaises(DevopsError):
+            self.pool.configure(size=2)
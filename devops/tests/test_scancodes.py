@@ -37,3 +37,27 @@ class TestScancodes(unittest.TestCase):
     def test_wait(self):
         codes = scancodes.from_string("a<Wait>b")
         self.assertEqual([(0x1e,), ('wait',), (0x30,)], codes)
+
+    def test_wait_seconds(self):
+        codes = scancodes.from_string("a<Wait5>b<Wait0.5>")
+        self.assertEqual([(0x1e,), ('wait', 5.0), (0x30,), ('wait', 0.5)],
+                         codes)
+
+    def test_unclosed_special(self):
+        codes = scancodes.from_string("a<b")
+        self.assertEqual([(0x1e,), (0x2a, 0x33), (0x30,)], codes)
+
+    def test_batches(self):
+        batches = scancodes.to_batches(
+            scancodes.from_string('abBC<Wait>aa<KillX>x<Enter>y'))
+        self.assertEqual([(0x1e, 0x30), (0x2a, 0x30, 0x2e), ('wait',),
+                          (0x1e,), (0x1e,), (0x1d, 0x38, 0x0e),
+                          (0x2d, 0x1c), (0x15,)], batches)
+
+    def test_batches_max_keys(self):
+        batches = scancodes.to_batches(scancodes.from_string('abcde'),
+                                       max_keys=2)
+        self.assertEqual([(0x1e, 0x30), (0x2e, 0x20), (0x12,)], batches)
+        batches = scancodes.to_batches(scancodes.from_string('AB'),
+                                       max_keys=2)
+        self.assertEqual([(0x2a, 0x1e), (0x2a, 0x30)], batches)
@@ -47,6 +47,7 @@ class TestSnaphotList(BaseShellTestCase):
         node = mock.Mock()
         node.name = "node"
         node.get_snapshots.return_value = snaps
+        node.get_chain_depth.return_value = 2
 
         env = mock_get_env.return_value
         env.get_nodes.return_value = [node, node]
@@ -55,12 +56,12 @@ class TestSnaphotList(BaseShellTestCase):
 
         mock_print.assert_called_once_with(
             columns=[
-                ('snap_3', '2015-11-28 00:00:00', 'node, node'),
-                ('snap_2', '2015-11-29 00:00:00', 'node, node'),
-                ('snap_1', '2015-11-30 00:00:00', 'node, node'),
-                ('snap_0', '2015-12-01 00:00:00', 'node, node')
+                ('snap_3', '2015-11-28 00:00:00', 2, 'node, node'),
+                ('snap_2', '2015-11-29 00:00:00', 2, 'node, node'),
+                ('snap_1', '2015-11-30 00:00:00', 2, 'node, node'),
+                ('snap_0', '2015-12-01 00:00:00', 2, 'node, node')
             ],
-            headers=('SNAPSHOT', 'CREATED', 'NODES-NAMES')
+            headers=('SNAPSHOT', 'CREATED', 'DEPTH', 'NODES-NAMES')
         )
 
 
@@ -0,0 +1,96 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Benchmark of keystrokes per second sent to a node
+
+Each sendKey call is simulated as a call which takes the RPC round trip
+time plus the key hold time, which is 100 ms by default in QEMU.
+
+    python samples/send_keys_benchmark.py [rpc_ms] [hold_ms]
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+
+from devops.helpers import scancodes
+
+KERNEL_CMD = (
+    "<Wait>\n"
+    "<Esc>\n"
+    "<Wait>\n"
+    "vmlinuz initrd=initrd.img ks=cdrom:/ks.cfg\n"
+    " ip=10.109.0.2\n"
+    " netmask=255.255.255.0\n"
+    " gw=10.109.0.1\n"
+    " dns1=8.8.8.8\n"
+    " hostname=nailgun.test.domain.local\n"
+    " dhcp_interface=eth0\n"
+    " admin_interface=eth0\n"
+    " showmenu=no\n"
+    " wait_for_external_config=yes\n"
+    " build_images=0\n"
+    " <Enter>\n"
+)
+
+
+def legacy_from_string(s):
+    scancodes_list = []
+    while len(s) > 0:
+        if s[0] == '<' and s.find('>') > 0:
+            special_end = s.find('>') + 1
+            codes = scancodes.SPECIALS.get(s[0:special_end])
+            s = s[special_end:]
+        else:
+            codes = scancodes.SCANCODES.get(s[0])
+            s = s[1:]
+        codes = scancodes.iterable(codes)
+        if len(codes) > 0:
+            scancodes_list.append(codes)
+    return scancodes_list
+
+
+def measure(func, repeat=1000):
+    start = time.time()
+    for _ in range(repeat):
+        func()
+    return (time.time() - start) / repeat
+
+
+def main(rpc_ms=1.0, hold_ms=100.0):
+    text = KERNEL_CMD * 10
+    print('Tokenizer, {0} chars:'.format(len(text)))
+    print('  legacy  {0:.3f} ms'.format(
+        measure(lambda: legacy_from_string(text), 100) * 1000))
+    print('  regex   {0:.3f} ms (cached: {1:.3f} ms)'.format(
+        measure(lambda: (scancodes._cache.clear(),
+                         scancodes.from_string(text)), 100) * 1000,
+        measure(lambda: scancodes.from_string(text)) * 1000))
+
+    codes = scancodes.from_string(KERNEL_CMD)
+    keys = len([c for c in codes if not isinstance(c[0], str)])
+    print('Kernel command line, {0} keys, {1} ms per call:'.format(
+        keys, rpc_ms + hold_ms))
+    for batch_size in (1, 4, 8, scancodes.MAX_KEYS):
+        calls = len([c for c in scancodes.to_batches(codes, batch_size)
+                     if not isinstance(c[0], str)])
+        seconds = calls * (rpc_ms + hold_ms) / 1000
+        print('  batch {0:2d}: {1:3d} sendKey calls, {2:6.2f} s, '
+              '{3:6.1f} keys/s'.format(batch_size, calls, seconds,
+                                       keys / seconds))
+
+
+if __name__ == '__main__':
+    main(*[float(arg) for arg in sys.argv[1:3]])